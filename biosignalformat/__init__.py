@@ -1,9 +1,22 @@
 #!/usr/bin/python
+from hashing import *
+from catalog import *
 from base import *
+from compression import *
+from encoding import *
+from mapping import *
+from cache import *
+from store import *
+from asyncread import *
 from datatype import *
+from events import *
 from archiver import *
 from structure import *
 from calculated import *
+from pyramid import *
+from features import *
+from spectral import *
+from wavelet import *
 from plugins import *
 
 #===================================================================================================
@@ -2,8 +2,34 @@
 import os
 import sys
 import shutil
-from plumbum import local as local_cmd
-from plumbum import ProcessExecutionError
+import struct
+import time
+import mmap
+import copy
+import zlib
+import zipfile
+import collections
+import threading
+
+
+class LocalCommands(object):
+    """Stands for plumbum's local machine, importing plumbum on first use: it is slow to import,
+    and only the providers which run external tools need it."""
+    def __getattr__(self, name):
+        from plumbum import local
+        return getattr(local, name)
+
+    def __getitem__(self, name):
+        from plumbum import local
+        return local[name]
+
+local_cmd = LocalCommands()
+
+
+def process_error():
+    """Returns plumbum's ProcessExecutionError (see LocalCommands)."""
+    from plumbum import ProcessExecutionError
+    return ProcessExecutionError
 
 class SevenZipArchiveProvider(object):
     TemporalFileName = ".temp_arch_file"
@@ -29,6 +55,10 @@ class SevenZipArchiveProvider(object):
         command = self.sevenzip["x"][self.archivename]["-so"]["/".join(filename)]
         return command()
 
+    def list(self):
+        """Returns the names of the files inside the archive."""
+        return ArchiveListing.parseSevenZip(self.sevenzip["l"]["-slt"][self.archivename]())
+
 
 class ZipArchiveProvider(object):
     TemporalDirName = ".temp_arch_dir"
@@ -50,7 +80,7 @@ class ZipArchiveProvider(object):
         command = self.zip["../" + self.archivename]["-u"]["-m"]["-r"]["."]
         try:
             command()
-        except ProcessExecutionError as e:
+        except process_error() as e:
             if e.retcode != 12: #Nothing to do
                 raise e
         local_cmd.cwd.chdir("./..")
@@ -67,56 +97,380 @@ class ZipArchiveProvider(object):
         command = self.unzip["-p"][self.archivename]["/".join(filename)]
         return command()
 
+    def list(self):
+        """Returns the names of the files inside the archive."""
+        return [name for name in self.unzip["-Z1"][self.archivename]().splitlines() if not name.endswith("/")]
+
+class ZipFileArchiveProvider(object):
+    CompactionRatio = 0.25
+    PendingSuffix = ".pending"
+    HeaderLengthsOffset = 26 #Of the name and extra field lengths in a local file header
+    """Provides a simple interface to add, and update files to an archive format.
+    The archive is kept open in-process, so no external tool is launched per member.
+    The central directory lives in memory. New members are appended after the end of the
+    archive, leaving its central directory untouched, and a new one is appended by force_write
+    or close. Meanwhile, a pending file next to the archive records where the archive ended, so
+    an update which was interrupted is cut away when the archive is opened again. Replaced or
+    removed members and previous central directories leave unused bytes behind, which are
+    reclaimed by force_write when they exceed CompactionRatio of the archive size."""
+    def __init__(self, archivename, compression=zipfile.ZIP_DEFLATED):
+        self.archivename = archivename
+        self.compression = compression
+        self.members = None
+        self.file = None
+        self.modified = False
+        self.mapping = None
+        self.lock = threading.RLock()
+        self.open()
+
+    def open(self):
+        """Opens the archive, reading its central directory once. A file which is not a zip archive
+        is refused, so it is never appended to."""
+        if self.file is None:
+            self.recover()
+            exists = os.path.exists(self.archivename) and os.path.getsize(self.archivename) > 0
+            if exists and not zipfile.is_zipfile(self.archivename):
+                raise zipfile.BadZipfile("%s is not a zip archive" % self.archivename)
+            self.members = collections.OrderedDict()
+            if exists:
+                with zipfile.ZipFile(self.archivename, "r", allowZip64=True) as archive:
+                    for info in archive.infolist():
+                        self.members[info.filename] = info
+            self.file = open(self.archivename, "r+b" if exists else "w+b")
+            self.modified = False
+        return self.file
+
+    def recover(self):
+        """Cuts the archive to the length it had before an update which was not written."""
+        pendingname = self.archivename + self.PendingSuffix
+        if os.path.exists(pendingname):
+            with open(pendingname, "r") as f:
+                length = int(f.read())
+            if os.path.exists(self.archivename):
+                with open(self.archivename, "r+b") as f:
+                    f.truncate(length)
+            os.remove(pendingname)
+
+    def begin(self):
+        """Records the length of the archive before its first change since it was written."""
+        if not self.modified:
+            self.file.seek(0, 2)
+            self.writeSynced(self.archivename + self.PendingSuffix, str(self.file.tell()))
+            self.modified = True
+
+    @classmethod
+    def writeSynced(cls, filename, content):
+        """Writes a small file atomically and durably."""
+        with open(filename + ".tmp", "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(filename + ".tmp", filename)
+
+    def close(self):
+        """Writes the central directory if the archive changed, and closes it."""
+        with self.lock:
+            if self.file is not None:
+                self.commit()
+                self.file.close()
+                self.file = None
+            self.mapping = None
+
+    def commit(self):
+        """Appends the central directory of the current members, once the members are on disk, and
+        drops the pending file. A new archive gets an empty central directory."""
+        self.file.seek(0, 2)
+        if not self.modified and self.file.tell() > 0:
+            return
+        self.begin()
+        self.writeDirectory(self.file, self.members.values())
+        os.remove(self.archivename + self.PendingSuffix)
+        self.modified = False
+
+    @classmethod
+    def writeDirectory(cls, target, members):
+        """Appends a central directory of the given members to a file, and syncs it."""
+        directory = zipfile.ZipFile(target, "w", allowZip64=True)
+        directory.filelist = list(members)
+        directory.close()
+        target.flush()
+        os.fsync(target.fileno())
+
+    def add(self, filename, content):
+        """Writes a file inside the archive. Notes that filename is an list-compatible object."""
+        name = "/".join(filename)
+        info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        info.compress_type = self.compression
+        info.external_attr = 0o600 << 16
+        info.file_size = len(content)
+        info.CRC = zlib.crc32(content) & 0xffffffff
+        if self.compression == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+            content = compressor.compress(content) + compressor.flush()
+        info.compress_size = len(content)
+        with self.lock:
+            self.begin()
+            self.file.seek(0, 2)
+            info.header_offset = self.file.tell()
+            self.file.write(info.FileHeader())
+            self.file.write(content)
+            self.file.flush()
+            self.members.pop(name, None)
+            self.members[name] = info
+
+    def remove(self, filename):
+        """Removes a file inside the archive. Notes that filename is an list-compatible object."""
+        name = "/".join(filename)
+        with self.lock:
+            if name not in self.members:
+                raise KeyError("There is no item named %r in the archive" % name)
+            self.begin()
+            del self.members[name]
+
+    def read(self, filename):
+        """Reads a file inside the archive. Notes that filename is an list-compatible object.
+        Reads are serialized, because the members share the file of the archive."""
+        name = "/".join(filename)
+        with self.lock:
+            info = self.members.get(name)
+            if info is None:
+                raise KeyError("There is no item named %r in the archive" % name)
+            self.file.seek(self.dataOffset(info))
+            content = self.file.read(info.compress_size)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            content = zlib.decompress(content, -15)
+        elif info.compress_type != zipfile.ZIP_STORED:
+            raise zipfile.BadZipfile("Unsupported compression method %d for %r" % (info.compress_type, name))
+        if zlib.crc32(content) & 0xffffffff != info.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %r" % name)
+        return content
+
+    def dataOffset(self, info):
+        """Returns where the data of a member starts, reading the lengths of its local header, which
+        may differ from the ones of the central directory."""
+        self.file.seek(info.header_offset + self.HeaderLengthsOffset)
+        namelength, extralength = struct.unpack("<HH", self.file.read(4))
+        return info.header_offset + zipfile.sizeFileHeader + namelength + extralength
+
+    def list(self):
+        """Returns the names of the files inside the archive."""
+        return list(self.members.keys())
+
+    def map(self, filename):
+        """Returns a (buffer, offset, size) tuple locating a member inside a read-only memory map
+        of the archive. Only members stored without compression can be mapped, otherwise None."""
+        with self.lock:
+            info = self.members.get("/".join(filename))
+            if info is None or info.compress_type != zipfile.ZIP_STORED:
+                return None
+            offset = self.dataOffset(info)
+            return self.remap(offset + info.file_size), offset, info.file_size
+
+    def remap(self, size):
+        """Maps the archive again when the current map does not reach the requested size."""
+        if self.mapping is None or len(self.mapping) < size:
+            with open(self.archivename, "rb") as f:
+                self.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.mapping
+
+    def garbage(self):
+        """Counts the bytes of the archive which belong neither to a member nor to its central
+        directory: replaced or removed members, and the central directories of previous writes."""
+        used = zipfile.sizeEndCentDir
+        for info in self.members.values():
+            used += zipfile.sizeFileHeader + zipfile.sizeCentralDir + 2 * len(info.filename) + info.compress_size
+        return os.path.getsize(self.archivename) - used
+
+    def force_write(self):
+        """Makes the archive consistent on disk, compacting it if it is worth it."""
+        with self.lock:
+            self.commit()
+            if self.garbage() > self.CompactionRatio * os.path.getsize(self.archivename):
+                self.compact()
+
+    def compact(self):
+        """Rewrites the archive without its unused bytes, copying the members without compressing
+        them again, and replaces it once the copy is on disk."""
+        tempname = self.archivename + ".compact"
+        members = collections.OrderedDict()
+        with open(tempname, "wb") as target:
+            for name, info in self.members.items():
+                self.file.seek(self.dataOffset(info))
+                content = self.file.read(info.compress_size)
+                info = copy.copy(info)
+                info.header_offset = target.tell()
+                info.flag_bits &= ~0x08 #The sizes are written in the header, not after the data
+                info.extra = ""
+                target.write(info.FileHeader())
+                target.write(content)
+                members[name] = info
+            self.writeDirectory(target, members.values())
+        self.file.close()
+        os.rename(tempname, self.archivename)
+        self.file = open(self.archivename, "r+b")
+        self.members = members
+        self.mapping = None
+
 ArchiveProvider = SevenZipArchiveProvider
 
 class XArchiveProvider(object):
     TemporalFileName = ".temp_arch_file"
     TemporalDirName = ".temp_arch_dir"
-    """Provides a simple interface to add, and update files to an archive format."""
+    FlushingSuffix = ".flushing"
+    FlushSize = 1024*1024*200
+    """Provides a simple interface to add, and update files to an archive format.
+    Files are staged in a temporal directory, whose size is accounted as they are added. When it
+    exceeds FlushSize, the staged files are moved aside and compressed into the archive by a
+    background thread, while new files are staged again (double buffering). Reads look in the
+    staged files, then in the ones being compressed, and finally in the archive."""
     def __init__(self, archivename, filetype="zip"):
         self.archivename = archivename
         self.temporaldirname = self.TemporalDirName + "_" + os.path.basename(archivename)
+        self.flushingdirname = self.temporaldirname + self.FlushingSuffix
         self.sevenzip = local_cmd["7za"]
         self.filetype = filetype
+        self.lock = threading.RLock()
+        self.staged = {}
+        self.stagedSize = 0
+        self.flusher = None
+        self.flushError = None
 
     def add(self, filename, content):
         """Writes a file inside the archive. Notes that filename is an list-compatible object."""
         tempfilename = "/".join([self.temporaldirname] + filename)
-        if not os.path.exists(os.path.dirname(tempfilename)):
-            os.makedirs(os.path.dirname(tempfilename))
-        with open(tempfilename, "w") as f:
-            f.write(content)
-        if self.get_size(self.temporaldirname) > 1024*1024*200:
-            self.force_write()
+        with self.lock:
+            if not os.path.exists(os.path.dirname(tempfilename)):
+                os.makedirs(os.path.dirname(tempfilename))
+            with open(tempfilename, "w") as f:
+                f.write(content)
+            self.stagedSize += len(content) - self.staged.get(tempfilename, 0)
+            self.staged[tempfilename] = len(content)
+        if self.stagedSize > self.FlushSize:
+            self.flush(background=True)
+
+    def flush(self, background=False):
+        """Compresses the staged files into the archive. In background, only the previous flush is
+        waited for, so the files added meanwhile are staged again. The files of a failed flush are
+        kept aside, and compressed again with the staged ones by the next flush."""
+        self.wait()
+        with self.lock:
+            if os.path.exists(self.temporaldirname):
+                if os.path.exists(self.flushingdirname):
+                    self.merge(self.temporaldirname, self.flushingdirname)
+                else:
+                    os.rename(self.temporaldirname, self.flushingdirname)
+            self.staged = {}
+            self.stagedSize = 0
+        if not os.path.exists(self.flushingdirname):
+            return
+        if background:
+            self.flusher = threading.Thread(target=self.compress)
+            self.flusher.daemon = True
+            self.flusher.start()
+        else:
+            self.compress()
+            self.wait()
+
+    def compress(self):
+        """Adds the files being flushed to the archive, and drops them."""
+        try:
+            command = self.sevenzip["a"][os.path.abspath(self.archivename)]["-r"]["-t"+self.filetype]
+            process = command.popen(cwd=self.flushingdirname)
+            stdout, stderr = process.communicate()
+            if process.returncode != 0:
+                raise process_error()(command.formulate(), process.returncode, stdout, stderr)
+        except Exception as e:
+            self.flushError = e
+            return
+        with self.lock:
+            shutil.rmtree(self.flushingdirname)
+
+    @classmethod
+    def merge(cls, source, target):
+        """Moves the files of a directory into another one, replacing the ones with the same name."""
+        for dirpath, dirnames, filenames in os.walk(source):
+            destination = os.path.join(target, os.path.relpath(dirpath, source))
+            if not os.path.exists(destination):
+                os.makedirs(destination)
+            for f in filenames:
+                os.rename(os.path.join(dirpath, f), os.path.join(destination, f))
+        shutil.rmtree(source)
+
+    def wait(self):
+        """Waits for the background flush, raising its error if it failed."""
+        if self.flusher is not None:
+            self.flusher.join()
+            self.flusher = None
+        if self.flushError is not None:
+            error, self.flushError = self.flushError, None
+            raise error
 
     def force_write(self):
-        if not os.path.exists(self.temporaldirname):
-            os.makedirs(self.temporaldirname)
-        local_cmd.cwd.chdir("./" + self.temporaldirname)
-        command = self.sevenzip["a"]["../" + self.archivename]["-r"]["-t"+self.filetype]
-        command()
-        local_cmd.cwd.chdir("./..")
-        shutil.rmtree(self.temporaldirname)
+        self.flush()
 
     def remove(self, filename):
         """Removes a file inside the archive. Notes that filename is an list-compatible object."""
-        command = self.sevenzip["d"][self.archivename]["/".join(filename)]
-        command()
+        self.wait()
+        temp_name = "/".join([self.temporaldirname] + filename)
+        with self.lock:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+                self.stagedSize -= self.staged.pop(temp_name, 0)
+            flushing_name = os.path.join(self.flushingdirname, *filename)
+            if os.path.exists(flushing_name):
+                os.remove(flushing_name) #Left by a failed flush
+        if os.path.exists(self.archivename):
+            command = self.sevenzip["d"][self.archivename]["/".join(filename)]
+            command()
 
     def read(self, filename):
-        temp_name = os.path.join(self.temporaldirname, filename)
-        if os.path.exists(temp_name):
-            return open(temp_name, "r").read()
-        content = ""
         """Reads a file inside the archive. Notes that filename is an list-compatible object."""
+        with self.lock:
+            for dirname in [self.temporaldirname, self.flushingdirname]:
+                temp_name = os.path.join(dirname, *filename)
+                if os.path.exists(temp_name):
+                    with open(temp_name, "r") as f:
+                        return f.read()
         command = self.sevenzip["x"][self.archivename]["-so"]["/".join(filename)]
         return command()
 
+    def list(self):
+        """Returns the names of the files inside the archive, including the ones waiting to be written."""
+        names = set()
+        if os.path.exists(self.archivename):
+            names.update(ArchiveListing.parseSevenZip(self.sevenzip["l"]["-slt"][self.archivename]()))
+        with self.lock:
+            for dirname in [self.flushingdirname, self.temporaldirname]:
+                for dirpath, dirnames, filenames in os.walk(dirname):
+                    relative = os.path.relpath(dirpath, dirname)
+                    names.update(f if relative == "." else relative.replace(os.sep, "/") + "/" + f for f in filenames)
+        return list(names)
+
+
+class ArchiveListing(object):
+    """Directory tree of the names of the files inside an archive. It is built the first time it is used."""
+    def __init__(self, archiver):
+        self.archiver = archiver
+        self.tree = None
+
+    def children(self, dirpath, prefix=""):
+        """Returns the names inside a like-list directory path which start with prefix."""
+        if self.tree is None:
+            self.tree = {}
+            for name in self.archiver.list():
+                parts = name.split("/")
+                for i in range(len(parts)):
+                    self.tree.setdefault(tuple(parts[:i]), set()).add(parts[i])
+        return sorted(name for name in self.tree.get(tuple(dirpath), ()) if name.startswith(prefix))
+
     @classmethod
-    def get_size(cls, start_path = '.'):
-        total_size = 0
-        for dirpath, dirnames, filenames in os.walk(start_path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                total_size += os.path.getsize(fp)
-        return total_size
+    def parseSevenZip(cls, output):
+        """Extracts the file names of the technical listing (-slt) of 7za."""
+        names = []
+        path = None
+        for line in output.splitlines():
+            if line.startswith("Path = "):
+                path = line[len("Path = "):]
+            elif line.startswith("Attributes = ") and path is not None and "D" not in line[len("Attributes = "):].split(" ")[0]:
+                names.append(path.replace("\\", "/"))
+        return names
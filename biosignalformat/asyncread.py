@@ -0,0 +1,176 @@
+#!/usr/bin/python
+import sys
+import time
+import Queue
+import threading
+
+
+class CancelledRead(Exception):
+    pass
+
+
+class ReadFuture(object):
+    """Result of a read which runs in an AsyncReader. Concurrent requests for the same read share
+    its future, each one holding a reference: cancel drops a reference, and the read is cancelled
+    when no request waits for it anymore, unless it already started."""
+    def __init__(self, children=None):
+        super(ReadFuture, self).__init__()
+        self.condition = threading.Condition()
+        self.state = "pending"
+        self.value = None
+        self.error = None
+        self.references = 0
+        self.callbacks = []
+        self.children = children or []
+
+    def result(self, timeout=None):
+        """Waits for the read, returning its value or raising its error."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.state in ("pending", "running"):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("The read did not finish in %s seconds!" % timeout)
+                self.condition.wait(remaining)
+        if self.state == "cancelled":
+            raise CancelledRead()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def done(self):
+        return self.state in ("done", "cancelled")
+
+    def cancelled(self):
+        return self.state == "cancelled"
+
+    def cancel(self):
+        """Drops a request of the read. Returns True if the read was cancelled."""
+        with self.condition:
+            self.references -= 1
+            if self.references > 0 or self.state != "pending":
+                return False
+            self.state = "cancelled"
+            self.condition.notify_all()
+        for child in self.children:
+            child.cancel()
+        self.runCallbacks()
+        return True
+
+    def addDoneCallback(self, callback):
+        """Calls callback(future) when the read finishes, or at once if it finished."""
+        with self.condition:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def setRunning(self):
+        """Marks the read as started. Returns False if it was cancelled."""
+        with self.condition:
+            if self.state != "pending":
+                return False
+            self.state = "running"
+            return True
+
+    def setResult(self, value, error=None):
+        with self.condition:
+            if self.state == "cancelled":
+                return
+            self.value, self.error, self.state = value, error, "done"
+            self.condition.notify_all()
+        self.runCallbacks()
+
+    def runCallbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class AsyncReader(object):
+    DefaultConcurrency = 8
+    """Runs reads in at most concurrency threads, returning ReadFutures. Reads are identified by a
+    key (e.g. a SegmentCache key), so requests which overlap share the reads in flight.
+    Python 2 has no asyncio: callers wait on the futures, or chain work with addDoneCallback."""
+    def __init__(self, concurrency=DefaultConcurrency):
+        super(AsyncReader, self).__init__()
+        self.concurrency = concurrency
+        self.queue = Queue.Queue()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, key, function, *args):
+        """Returns the future of function(*args), sharing the one in flight with the same key."""
+        with self.lock:
+            future = self.inflight.get(key)
+            if future is None or future.cancelled():
+                future = ReadFuture()
+                self.inflight[key] = future
+                self.queue.put((key, future, function, args))
+                self.start()
+            future.references += 1
+        return future
+
+    def gather(self, futures, combine=list):
+        """Returns a future of combine(values of futures). Cancelling it cancels its requests."""
+        gathered = ReadFuture(futures)
+        gathered.references = 1
+        remaining = [len(futures)]
+        def finished(future):
+            with self.lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            errors = [f.error or CancelledRead() for f in futures if f.error is not None or f.cancelled()]
+            if errors:
+                gathered.setResult(None, errors[0])
+                return
+            try:
+                gathered.setResult(combine([f.value for f in futures]))
+            except Exception:
+                gathered.setResult(None, sys.exc_info()[1])
+        if not futures:
+            remaining[0] = 1
+            finished(None)
+        for future in futures:
+            future.addDoneCallback(finished)
+        return gathered
+
+    def start(self):
+        while len(self.threads) < self.concurrency:
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            key, future, function, args = self.queue.get()
+            if future.setRunning():
+                try:
+                    value, error = function(*args), None
+                except Exception:
+                    value, error = None, sys.exc_info()[1]
+            with self.lock:
+                if self.inflight.get(key) is future:
+                    del self.inflight[key]
+            if future.state == "running":
+                future.setResult(value, error)
+
+AsyncReader.Default = AsyncReader()
+
+
+class AsyncArchiveProvider(object):
+    """Wraps an archive provider, so read returns a ReadFuture of the file content. Concurrent
+    reads of the same file share it. The other methods are the ones of the wrapped provider."""
+    def __init__(self, archiver, reader=None):
+        super(AsyncArchiveProvider, self).__init__()
+        self.archiver = archiver
+        self.reader = reader or AsyncReader.Default
+
+    def read(self, filename):
+        return self.reader.submit((id(self.archiver), tuple(filename)), self.archiver.read, filename)
+
+    def __getattr__(self, name):
+        return getattr(self.archiver, name)
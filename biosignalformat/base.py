@@ -4,7 +4,8 @@ import sys
 import uuid
 import collections
 import ujson as json
-import hashlib
+from catalog import Catalog
+from hashing import MerkleHasher
 
 class BaseFile(object):
     MetadataFileName = ".metadata"
@@ -16,10 +17,41 @@ class BaseFile(object):
         self.objectHash = ""
         self.calculatedInformation = {}
         self._archiver = None
+        self.dirty = True
+        self.writtenHash = None
+        self.writtenMetadata = None
+        self.listing = None
+        self.catalog = None
 
     def write(self, dirpath=None):
-        """Writes the information the metadata file, using a like-list directory path. """
+        """Writes the information the metadata file, using a like-list directory path, if the node
+        changed since it was written or read. Returns the number of written archive members."""
+        self.updateHash()
+        if not self.isDirty():
+            return 0
         self.writeMetadata(dirpath)
+        return 1
+
+    def markDirty(self):
+        """Forces the next write of the node, e.g. after adding or removing children."""
+        self.dirty = True
+
+    def isDirty(self):
+        """Checks if the node, its metadata or its hash changed since it was written or read."""
+        return self.dirty or self.objectHash != self.writtenHash or self.metadataSnapshot() != self.writtenMetadata
+
+    def isStored(self):
+        """Checks if the metadata of the node was written or read, i.e. if it is in the archive. A node
+        removed before its first write has no metadata to remove, although its samples may be stored."""
+        return self.writtenMetadata is not None
+
+    def markClean(self):
+        self.dirty = False
+        self.writtenHash = self.objectHash
+        self.writtenMetadata = self.metadataSnapshot()
+
+    def metadataSnapshot(self):
+        return json.dumps(self.metadata, sort_keys=True)
 
     def remove(self, dirpath=None):
         """Removes the information inside the archive provider, with a like-list directory path. """
@@ -31,14 +63,57 @@ class BaseFile(object):
         self.metadata.setdefault(".dataHash", None)
         self.metadata.setdefault(".calculatedInformation", None)
 
-    def readMetadata(self, dirpath=[]):
-        """Removes the metadata inside the archive provider, with a like-list directory path. """
-        self.metadata = json.loads(self.archiver.read(dirpath + [self.MetadataFileName]))
+    def readMetadata(self, dirpath=None):
+        """Reads the metadata inside the archive provider, with a like-list directory path. """
+        if dirpath is None:
+            dirpath = self.pathname
+        return self.loadMetadata(json.loads(self.archiver.read(dirpath + [self.MetadataFileName])))
+
+    def loadMetadata(self, metadata):
+        """Takes the metadata as it is stored in the archive (see addMetadataInfo)."""
+        self.metadata = dict(metadata)
         self.objectHash = self.metadata.pop(".dataHash")
-        self.objectHash = self.metadata.pop(".uniqueID")
-        self.calculatedInformation = {key: [] for key in self.metadata.pop(".calculatedInformation")}
+        self.uniqueID = self.metadata.pop(".uniqueID")
+        calculated = self.metadata.pop(".calculatedInformation") or {}
+        self.calculatedInformation = dict(calculated) if isinstance(calculated, dict) else dict.fromkeys(calculated)
+        self.markClean()
         return self.metadata
 
+    def openChildren(self, child_class, parent_attribute):
+        """Reads the metadata of the children of an opened node (see Experiment.open), which are
+        found by their child_class.Prefix in the catalog or, if there is none, in the archive listing."""
+        if self.catalog is not None:
+            nodes = Catalog.children(self.catalog, child_class.Prefix)
+        else:
+            nodes = [{"name": name} for name in self.listing.children(self.pathname, child_class.Prefix)]
+        children = []
+        for node in nodes:
+            child = child_class()
+            setattr(child, parent_attribute, self)
+            child.uniqueID = node["name"][len(child_class.Prefix):]
+            child.listing = self.listing
+            if "metadata" in node:
+                child.catalog = node
+                child.loadMetadata(node["metadata"])
+            else:
+                child.readMetadata()
+            child.setOpened()
+            children.append(child)
+        return children
+
+    def catalogNode(self):
+        """Describes the node and its children for the catalog (see Catalog)."""
+        metadata = self.metadata.copy()
+        self.addMetadataInfo(metadata)
+        return {"name": self.pathname[-1] if self.pathname else "", "metadata": metadata, "children": self.catalogChildren()}
+
+    def catalogChildren(self):
+        return []
+
+    def setOpened(self):
+        """Prepares a node read from the archive, so its children are read when they are first used."""
+        pass
+
     def writeMetadata(self, dirpath=None):
         """Write the metadata inside the archive provider, with a like-list directory path. """
         self.updateHash()
@@ -47,6 +122,7 @@ class BaseFile(object):
         metadata = self.metadata.copy()
         self.addMetadataInfo(metadata)
         self.archiver.add(dirpath + [self.MetadataFileName], json.dumps(metadata, indent=4))
+        self.markClean()
 
     def removeMetadata(self, dirpath=None):
         """Removes the metadata inside the archive provider, with a like-list directory path. """
@@ -58,7 +134,14 @@ class BaseFile(object):
         """Adds additional information to metadata before writing in the file."""
         metadata[".dataHash"] = self.objectHash
         metadata[".uniqueID"] = self.uniqueID
-        metadata[".calculatedInformation"] = list(self.calculatedInformation.keys())
+        metadata[".calculatedInformation"] = dict(self.calculatedInformation)
+
+    def addCalculatedInformation(self, key, kind):
+        """Lists derived data stored under the node, with the Type of the class which removes it
+        (see AdditionalData.removeDerived)."""
+        if self.calculatedInformation.get(key) != kind:
+            self.calculatedInformation[key] = kind
+            self.markDirty()
 
     def writeCalculatedInformation(self, dirpath=[]):
         for key, values in self.calculatedInformation.values():
@@ -72,11 +155,16 @@ class BaseFile(object):
     def updateHash(self):
         return ""
 
+    def computeHash(self):
+        """Returns the hash the node should have, from the hashes of its children (see MerkleHasher)."""
+        return self.objectHash
+
+    def childNodes(self):
+        return []
+
     def hash_me(self, data):
-        hasher = hashlib.sha224('ripemd160')
-        hasher.update(self.uniqueID)
-        hasher.update(data)
-        self.objectHash = hasher.hexdigest()
+        hasher = MerkleHasher.Default
+        self.objectHash = hasher.combine(self.uniqueID, [hasher.digest(data)])
         return self.objectHash
 
     @property
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+import os
+import threading
+import collections
+
+
+class SegmentCache(object):
+    DefaultBudget = 256*1024*1024
+    """LRU cache of decoded segments, bounded by the number of bytes of the cached arrays.
+    Entries are keyed by (archive, segment path, content hash), so a rewritten segment never
+    matches an old entry. Keys are also grouped by (archive, segment path), so a segment is invalidated
+    without scanning the entries. The shared instance is used by every SegmentedData of the process."""
+    def __init__(self, budget=DefaultBudget):
+        super(SegmentCache, self).__init__()
+        self.budget = budget
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.segments = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def key(self, archiver, filename, contentHash):
+        """Builds the key of a segment."""
+        return (os.path.abspath(archiver.archivename), "/".join(filename), contentHash)
+
+    def get(self, key):
+        """Returns the cached array, or None, updating the hit/miss counters."""
+        with self.lock:
+            values = self.entries.pop(key, None)
+            if values is None:
+                self.misses += 1
+                return None
+            self.entries[key] = values
+            self.hits += 1
+            return values
+
+    def put(self, key, values):
+        """Caches a decoded segment, which is made read-only because it is shared."""
+        values.flags.writeable = False
+        with self.lock:
+            self.discard(key)
+            if values.nbytes > self.budget:
+                return values
+            self.entries[key] = values
+            self.segments.setdefault(key[:2], set()).add(key)
+            self.size += values.nbytes
+            self.evict()
+        return values
+
+    def evict(self):
+        """Drops the least recently used entries until the cache fits in its budget."""
+        with self.lock:
+            while self.size > self.budget:
+                oldkey, oldvalues = self.entries.popitem(last=False)
+                self.size -= oldvalues.nbytes
+                self.forget(oldkey)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            values = self.entries.pop(key, None)
+            if values is not None:
+                self.size -= values.nbytes
+                self.forget(key)
+
+    def forget(self, key):
+        keys = self.segments.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.segments[key[:2]]
+
+    def invalidate(self, archiver, filename):
+        """Drops every entry of a segment, whatever its content hash."""
+        segment = self.key(archiver, filename, None)[:2]
+        with self.lock:
+            for key in list(self.segments.get(segment, ())):
+                self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.segments.clear()
+            self.size = 0
+
+    def resize(self, budget):
+        """Changes the byte budget, evicting entries if needed."""
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    @property
+    def statistics(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+            "entries": len(self.entries), "bytes": self.size, "budget": self.budget}
+
+SegmentCache.Shared = SegmentCache()
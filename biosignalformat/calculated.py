@@ -3,13 +3,18 @@ import os
 import sys
 import uuid
 import ujson as json
-import hashlib
 from base import BaseFile
+from datatype import SegmentedData, StoredData
 
 
 class AdditionalData(BaseFile):
     Preffix = "AdditionalData"
-    """Represents data which was calculated and stored."""
+    Type = None
+    Types = {}
+    """Represents data which was calculated and stored. targetHash is the hash of the parent
+    the data was calculated from: it is calculated again only when the parent hash changes.
+    Each kind of derived data has a Type, which is recorded in the calculatedInformation of the
+    parent, and a class registered for it (see registerType), which removes it."""
     def __init__(self, parent, metadata={}):
         super(AdditionalData, self).__init__(metadata)
         self.parent = None
@@ -20,16 +25,42 @@ class AdditionalData(BaseFile):
 
     def setParent(self, parent):
         self.parent = parent
-        self.removeHash = parent.objectHash
+
+    @classmethod
+    def registerType(cls, data_class):
+        """Registers the class which removes the derived data of data_class.Type."""
+        cls.Types[data_class.Type] = data_class
+        return data_class
+
+    @classmethod
+    def removeStored(cls, parent, key):
+        """Removes the derived data listed as key in the calculatedInformation of parent."""
+        raise Exception("Not implemented!")
+
+    @classmethod
+    def removeDerived(cls, parent):
+        """Removes every derived data of a node, each one by the class registered for its Type.
+        Keys listed before types were recorded are features, except "pyramid"."""
+        for key, kind in list(parent.calculatedInformation.items()):
+            if kind is None:
+                kind = "pyramid" if key == "pyramid" else "feature"
+            cls.Types[kind].removeStored(parent, key)
+            parent.calculatedInformation.pop(key, None)
 
     def calculate(self):
         return []
 
     def getData(self):
-        if self.targetHash != self.parent.objectHash:
+        if self.isStale():
             self.setData(self.calculate())
+            self.targetHash = self.parent.objectHash
         return self.data
 
+    def isStale(self):
+        """Checks if the data was calculated from other content of the parent."""
+        self.parent.updateHash()
+        return self.targetHash != self.parent.objectHash
+
     def setData(self, data):
         self.data = data
 
@@ -42,6 +73,12 @@ class AdditionalData(BaseFile):
         metadata.pop(".dataHash")
         metadata[".targetHash"] = self.targetHash
 
+    def loadMetadata(self, metadata):
+        metadata = dict(metadata)
+        self.targetHash = metadata.pop(".targetHash", None)
+        metadata.setdefault(".dataHash", "")
+        return super(AdditionalData, self).loadMetadata(metadata)
+
     @property
     def archiver(self):
         return self.parent.archiver
@@ -61,12 +98,19 @@ class GenericAdditionalData(AdditionalData):
     def __init__(self, parent, file_name, metadata={}):
         super(GenericAdditionalData, self).__init__(parent, metadata)
         self.file_name = file_name
+        self.data = None
 
     def getData(self, *args):
+        """Returns the stored data, calculating and writing it first if it is stale."""
         if self.data is None:
             self.data = self.createDataHandler()
-        if self.targetHash != self.parent.objectHash:
+        if self.isStale():
             self.setData(self.calculate())
+            self.targetHash = self.parent.objectHash
+            self.write()
+        return self.readData(*args)
+
+    def readData(self, *args):
         return self.data.get(*args)
 
     def setData(self, data):
@@ -99,4 +143,7 @@ class StoredAdditionalData(GenericAdditionalData):
         super(StoredAdditionalData, self).__init__(parent, file_name, metadata)
 
     def createDataHandler(self):
-        return GenericData(self, self.pathname + [self.file_name])
+        return StoredData(self, self.pathname + [self.file_name])
+
+    def readData(self):
+        return json.loads(self.data.get())
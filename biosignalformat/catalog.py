@@ -0,0 +1,35 @@
+#!/usr/bin/python
+import ujson as json
+
+
+class Catalog(object):
+    FileName = ".catalog"
+    Version = 1
+    """Describes a whole experiment in a single member at the root of the archive: the tree of
+    nodes with their stored metadata and, for each channel, its sample count, sampling rate and
+    segment count. A reader opens and browses it with one member read (see Experiment.open), and
+    Experiment.write keeps it up to date in the same archive update. Segment indexes are left in
+    their own members, so the catalog grows with the number of nodes, not with their samples.
+    A node is a dict with "name", "metadata" and "children" keys."""
+    def __init__(self, root):
+        super(Catalog, self).__init__()
+        self.root = root
+
+    @classmethod
+    def read(cls, archiver):
+        """Returns the catalog of an archive, or None if it lacks it or has an unknown version."""
+        try:
+            content = json.loads(archiver.read([cls.FileName]))
+        except Exception:
+            return None
+        if content.get("version") != cls.Version:
+            return None
+        return cls(content["experiment"])
+
+    def write(self, archiver):
+        archiver.add([self.FileName], json.dumps({"version": self.Version, "experiment": self.root}))
+
+    @classmethod
+    def children(cls, node, prefix=""):
+        """Returns the child nodes whose names start with prefix."""
+        return [child for child in node["children"] if child["name"].startswith(prefix)]
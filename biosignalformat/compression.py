@@ -0,0 +1,155 @@
+#!/usr/bin/python
+import bz2
+import zlib
+import numpy as np
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+class Codec(object):
+    Name = "none"
+    Code = 0
+    DefaultLevel = None
+    """Compresses the payload of a segment. Subclasses are registered in CodecRegistry.Default."""
+    def __init__(self, level=None):
+        super(Codec, self).__init__()
+        self.level = self.DefaultLevel if level is None else level
+
+    def compress(self, strdata):
+        return strdata
+
+    def decompress(self, strdata):
+        return strdata
+
+
+class ZlibCodec(Codec):
+    Name = "zlib"
+    Code = 1
+    DefaultLevel = 6
+
+    def compress(self, strdata):
+        return zlib.compress(strdata, self.level)
+
+    def decompress(self, strdata):
+        return zlib.decompress(strdata)
+
+
+class LzmaCodec(Codec):
+    Name = "lzma"
+    Code = 2
+    DefaultLevel = 6
+
+    def compress(self, strdata):
+        if lzma is None:
+            raise Exception("LZMA compression needs the lzma module (backports.lzma in Python 2)!")
+        return lzma.compress(strdata, preset=self.level)
+
+    def decompress(self, strdata):
+        if lzma is None:
+            raise Exception("LZMA compression needs the lzma module (backports.lzma in Python 2)!")
+        return lzma.decompress(strdata)
+
+
+class Bz2Codec(Codec):
+    Name = "bz2"
+    Code = 3
+    DefaultLevel = 9
+
+    def compress(self, strdata):
+        return bz2.compress(strdata, self.level)
+
+    def decompress(self, strdata):
+        return bz2.decompress(strdata)
+
+
+class SegmentFilter(object):
+    Name = "none"
+    Code = 0
+    """Rearranges the typed values of a segment before compressing them, without losing information."""
+    def apply(self, values):
+        return values.tostring()
+
+    def revert(self, strdata, dtype):
+        return strdata
+
+
+class ShuffleFilter(SegmentFilter):
+    Name = "shuffle"
+    Code = 1
+    """Groups the i-th byte of every value together. In slowly varying signals, the most
+    significant bytes barely change, so they become long runs which compress well."""
+    def apply(self, values):
+        return values.view(np.uint8).reshape(-1, values.itemsize).T.tostring()
+
+    def revert(self, strdata, dtype):
+        itemsize = np.dtype(dtype).itemsize
+        return np.frombuffer(strdata, dtype=np.uint8).reshape(itemsize, -1).T.tostring()
+
+
+class DeltaShuffleFilter(ShuffleFilter):
+    Name = "delta-shuffle"
+    Code = 2
+    """Stores the difference between consecutive values, and shuffles their bytes. The difference is
+    computed over the bit patterns as unsigned integers, so it is exact for float values too."""
+    def apply(self, values):
+        bits = values.view("<u%d" % values.itemsize)
+        deltas = np.empty_like(bits)
+        deltas[:1] = bits[:1]
+        np.subtract(bits[1:], bits[:-1], out=deltas[1:])
+        return super(DeltaShuffleFilter, self).apply(deltas)
+
+    def revert(self, strdata, dtype):
+        itemsize = np.dtype(dtype).itemsize
+        deltas = np.frombuffer(super(DeltaShuffleFilter, self).revert(strdata, dtype), dtype="<u%d" % itemsize)
+        return np.cumsum(deltas, dtype=deltas.dtype).tostring()
+
+
+class CodecRegistry(object):
+    """Keeps the available codecs and filters. A codec specification is a string like
+    "[filter+]codec[:level]", for example "zlib:1" for fast writes, or "delta-shuffle+lzma:9"
+    for maximum compression. The filter and the codec are identified in the segment header by
+    a single byte: the codec code in the lower nibble and the filter code in the upper one."""
+    def __init__(self):
+        super(CodecRegistry, self).__init__()
+        self.codecs = {}
+        self.filters = {}
+
+    def register(self, codec_class):
+        self.codecs[codec_class.Name] = codec_class
+        self.codecs[codec_class.Code] = codec_class
+
+    def registerFilter(self, filter_class):
+        self.filters[filter_class.Name] = filter_class
+        self.filters[filter_class.Code] = filter_class
+
+    def parse(self, specification):
+        """Returns the (filter, codec) instances of a codec specification."""
+        specification = specification or "none"
+        filter_name, _, codec_name = specification.rpartition("+")
+        codec_name, _, level = codec_name.partition(":")
+        if filter_name not in self.filters and filter_name:
+            raise Exception("Unknown segment filter: " + filter_name)
+        if codec_name not in self.codecs:
+            raise Exception("Unknown segment codec: " + codec_name)
+        return self.filters[filter_name or "none"](), self.codecs[codec_name](int(level) if level else None)
+
+    def code(self, specification):
+        """Returns the header byte of a codec specification."""
+        segment_filter, codec = self.parse(specification)
+        return codec.Code | (segment_filter.Code << 4)
+
+    def fromCode(self, code):
+        """Returns the (filter, codec) instances of a header byte."""
+        return self.filters[code >> 4](), self.codecs[code & 0x0F]()
+
+CodecRegistry.Default = CodecRegistry()
+for codec_class in [Codec, ZlibCodec, LzmaCodec, Bz2Codec]:
+    CodecRegistry.Default.register(codec_class)
+for filter_class in [SegmentFilter, ShuffleFilter, DeltaShuffleFilter]:
+    CodecRegistry.Default.registerFilter(filter_class)
+del codec_class, filter_class
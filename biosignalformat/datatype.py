@@ -3,7 +3,13 @@ import os
 import sys
 import uuid
 import ujson as json
-import hashlib
+import numpy as np
+from encoding import SegmentEncoder
+from hashing import MerkleHasher
+from store import SegmentStore
+from asyncread import AsyncReader
+from mapping import SegmentMapper
+from cache import SegmentCache
 
 class StoredData(object):
     def __init__(self, parent, file_name):
@@ -17,6 +23,7 @@ class StoredData(object):
         else:
             strdata = json.dumps(data)
         self.archiver.add(self.file_name, strdata)
+        self.hash(strdata)
         strdata = None
 
     def get(self):
@@ -27,38 +34,312 @@ class StoredData(object):
         return self.parent.archiver
 
     def hash(self, strdata):
-        hasher = hashlib.sha224('ripemd160')
-        hasher.update(strdata)
-        self.objectHash = hasher.hexdigest()
+        self.objectHash = MerkleHasher.Default.digest(strdata)
+
+
+class SegmentIndex(object):
+    """Describes the layout of a SegmentedData: its sample count and, for each segment,
+    the first sample, sample count, size in bytes, data type and digest (see MerkleHasher).
+    Content-addressed segments are stored by digest in the SegmentStore of the archive; otherwise
+    (as in older archives) they are stored next to the index."""
+    def __init__(self, segment_size, length=0, segments=None, addressed=False):
+        super(SegmentIndex, self).__init__()
+        self.segment_size = segment_size
+        self.length = length
+        self.segments = segments or []
+        self.addressed = addressed
+
+    def append(self, count, strdata, dtype, digest=None):
+        """Registers the next segment. Its digest is computed unless it is given."""
+        self.segments.append([self.length, count, len(strdata), dtype, digest or MerkleHasher.Default.digest(strdata)])
+        self.length += count
+
+    @property
+    def digests(self):
+        return [segment[4] for segment in self.segments]
+
+    def locate(self, start, end):
+        """Returns a (segment, first, last) tuple for each segment overlapping samples start..end."""
+        start = max(int(start), 0)
+        end = min(int(end), self.length - 1)
+        if start > end:
+            return []
+        return [(i, max(start - self.segments[i][0], 0), min(end - self.segments[i][0], self.segments[i][1] - 1))
+            for i in range(start // self.segment_size, end // self.segment_size + 1)]
+
+    def asDict(self):
+        return {"length": self.length, "segment-size": self.segment_size, "segments": self.segments,
+            "content-addressed": self.addressed}
+
+    @classmethod
+    def fromDict(cls, o):
+        return SegmentIndex(o["segment-size"], o["length"], o["segments"], o.get("content-addressed", False))
 
 
 class SegmentedData(StoredData):
-    def __init__(self, segment_size, parent, file_name):
+    IndexFileName = ".index"
+    ContentAddressed = True
+    def __init__(self, segment_size, parent, file_name, dtype="float64", scale=1.0, codec=None, addressed=None):
         super(SegmentedData, self).__init__(parent, file_name)
         self.segment_size = segment_size
-        self.data_length = 0
+        self.dtype = dtype
+        self.scale = scale
+        self.codec = codec
+        self.addressed = self.ContentAddressed if addressed is None else addressed
+        self.mapper = SegmentMapper.Default
+        self.cache = SegmentCache.Shared
+        self.hasher = MerkleHasher.Default
+        self.index = None
 
     def set(self, data):
-        hasher = hashlib.sha224('ripemd160')
-        maxlen = self.segment_size
-        self.data_length = len(data)
-        segment_number = int(round(len(data)*1.0/maxlen))+1
-        #segments = [data[maxlen*i:maxlen*(i+1)] for i in range(segment_number)]
-        for i in range(segment_number):
-            strdata = json.dumps(data[maxlen*i:maxlen*(i+1)])
-            self.archiver.add(self.file_name + ["SEGMENT-" + str(i)], strdata)
-            hasher.update(strdata)
-            strdata = None
-        self.objectHash = hasher.hexdigest()
+        """Stores the samples. data is a list-compatible object, or an iterator of chunks of samples."""
+        writer = self.openWriter()
+        if hasattr(data, "__len__"):
+            writer.append(data)
+        else:
+            for chunk in data:
+                writer.append(chunk)
+        writer.close()
+
+    def openWriter(self):
+        """Returns a SegmentedDataWriter, which replaces the samples when it is closed."""
+        return SegmentedDataWriter(self)
+
+    def setSegment(self, i, data):
+        """Replaces the samples of segment i, which must keep their count, encoding them with the
+        current dtype, scale and codec. Only that segment is written and hashed again: the hash of
+        the data is combined from the digests kept in the index."""
+        index = self.getIndex()
+        start, count = index.segments[i][:2]
+        data = np.asarray(data, dtype=np.float64).ravel()
+        if len(data) != count:
+            raise Exception("Segment %d must have %d samples, not %d!" % (i, count, len(data)))
+        strdata = SegmentEncoder.encode(data, self.dtype, self.scale, self.codec)
+        digest = self.hasher.digest(strdata)
+        if index.addressed:
+            self.store.add(strdata, digest)
+            self.releaseSegment(index, i)
+        else:
+            self.archiver.add(self.segmentName(i), strdata)
+            self.mapper.invalidate(self.archiver, self.segmentName(i))
+            self.cache.invalidate(self.archiver, self.segmentName(i))
+        index.segments[i] = [start, count, len(strdata), self.dtype, digest]
+        self.archiver.add(self.file_name + [self.IndexFileName], json.dumps(index.asDict()))
+        self.objectHash = self.computeHash()
+
+    def computeHash(self):
+        """Returns the hash of the samples, combined from the digests of the segments."""
+        return self.hasher.combine("", self.getIndex().digests)
+
+    def remove(self):
+        """Removes the segments (or their references) and the segment index inside the archive provider."""
+        self.releaseSegments(self.getIndex())
+        try:
+            self.archiver.remove(self.file_name + [self.IndexFileName])
+        except Exception:
+            pass #Older archives have no index
+        self.index = SegmentIndex(self.segment_size)
 
     def get(self, start = 0, end = None):
-        maxlen = self.segment_size
-        end = end or self.data_length - 1
-        startSegment = int(start/maxlen)
-        startOffset = int(start%maxlen)
-        endSegment = int(end/maxlen)
-        data = [None] * (end-start+1)
-        return [ v for i in range(startSegment, endSegment)
-            for v in json.loads(self.archiver.read(self.file_name + ["SEGMENT-" + str(i)]))
-                [(startOffset if i == startSegment else 0):]
-        ]
+        """Returns samples start..end (both included, end defaults to the last sample). When they
+        lie in a single segment, the result is a view of the mapped segment; otherwise, the
+        segment views are concatenated."""
+        return self.joinViews(self.getViews(start, end))
+
+    def readInto(self, target, start = 0):
+        """Copies samples start..start+len(target)-1 into target (e.g. a row of a block), segment by
+        segment, without intermediate arrays. Samples before 0 or after the last one are skipped.
+        Returns the number of copied samples."""
+        if start < 0:
+            target, start = target[-start:], 0
+        position = 0
+        for i, first, last in self.getIndex().locate(start, start + len(target) - 1):
+            target[position:position + last - first + 1] = self.readSegment(i)[first:last + 1]
+            position += last - first + 1
+        return position
+
+    def take(self, positions, fill = np.nan):
+        """Returns the samples at an array of positions, as an array of the same shape (e.g. the epochs
+        of a channel). The positions are grouped by segment, so each segment is decoded once and
+        copied with a single indexing. Positions before 0 or after the last sample get fill."""
+        index = self.getIndex()
+        positions = np.asarray(positions, dtype="int64")
+        values = np.empty(positions.shape)
+        values.fill(fill)
+        flat, target = positions.ravel(), values.reshape(-1)
+        valid = np.flatnonzero((flat >= 0) & (flat < index.length))
+        firsts = np.array([segment[0] for segment in index.segments], dtype="int64")
+        segments = np.searchsorted(firsts, flat[valid], "right") - 1
+        order = np.argsort(segments, kind="mergesort")
+        valid, segments = valid[order], segments[order]
+        touched = np.unique(segments)
+        bounds = np.searchsorted(segments, np.append(touched, len(firsts)))
+        for i, begin, end in zip(touched, bounds[:-1], bounds[1:]):
+            chosen = valid[begin:end]
+            target[chosen] = self.readSegment(i)[flat[chosen] - firsts[i]]
+        return values
+
+    def aget(self, start = 0, end = None, reader = None):
+        """Returns a ReadFuture of samples start..end (see get). The segments are read and decoded
+        in the threads of reader (AsyncReader.Default), and overlapping requests share them."""
+        reader = reader or AsyncReader.Default
+        index = self.getIndex()
+        if end is None:
+            end = index.length - 1
+        located = index.locate(start, end)
+        futures = [reader.submit(self.cache.key(self.archiver, self.segmentName(i), index.segments[i][4]), self.readSegment, i)
+            for i, first, last in located]
+        return reader.gather(futures, lambda segments:
+            self.joinViews([values[first:last + 1] for values, (i, first, last) in zip(segments, located)]))
+
+    @staticmethod
+    def joinViews(views):
+        if len(views) == 1:
+            return views[0]
+        if not views:
+            return np.zeros(0)
+        return np.concatenate(views)
+
+    def getViews(self, start = 0, end = None):
+        """Returns samples start..end as a list of arrays, one per overlapping segment."""
+        if end is None:
+            end = self.data_length - 1
+        return [self.readSegment(i)[first:last + 1] for i, first, last in self.getIndex().locate(start, end)]
+
+    def readSegment(self, i):
+        """Returns a decoded segment, from the shared cache or from a memory map of it whenever it is possible."""
+        key = self.cache.key(self.archiver, self.segmentName(i), self.getIndex().segments[i][4])
+        values = self.cache.get(key)
+        if values is not None:
+            return values
+        mapped = self.mapper.map(self.archiver, self.segmentName(i))
+        if mapped is None:
+            values = SegmentEncoder.decode(self.archiver.read(self.segmentName(i)))
+        else:
+            values = SegmentEncoder.decode(*mapped)
+        return self.cache.put(key, values)
+
+    def getIndex(self):
+        """Returns the segment index, reading it from the archive the first time."""
+        if self.index is None:
+            try:
+                self.index = SegmentIndex.fromDict(json.loads(self.archiver.read(self.file_name + [self.IndexFileName])))
+            except Exception:
+                self.index = self.rebuildIndex()
+        return self.index
+
+    def rebuildIndex(self):
+        """Creates the index of older archives, which lack it, trying the segments one by one."""
+        index = SegmentIndex(self.segment_size)
+        i = 0
+        while True:
+            try:
+                strdata = self.archiver.read(self.segmentName(i))
+                length, dtype = len(SegmentEncoder.decode(strdata)), SegmentEncoder.dataType(strdata)
+            except Exception:
+                return index #Missing, which some providers return as empty or garbled output
+            index.append(length, strdata, dtype)
+            i += 1
+
+    def releaseSegments(self, index, keep=0):
+        """Removes the segments of an index from keep onwards, or drops their references."""
+        for i in range(keep, len(index.segments)):
+            self.releaseSegment(index, i)
+
+    def releaseSegment(self, index, i):
+        if index.addressed:
+            name = self.store.path(index.segments[i][4])
+            if not self.store.release(index.segments[i][4]):
+                return
+        else:
+            name = self.file_name + ["SEGMENT-" + str(i)]
+            self.archiver.remove(name)
+        self.mapper.invalidate(self.archiver, name)
+        self.cache.invalidate(self.archiver, name)
+
+    def segmentName(self, i):
+        """Returns the path of segment i inside the archive."""
+        if self.index is not None and self.index.addressed:
+            return self.store.path(self.index.segments[i][4])
+        return self.file_name + ["SEGMENT-" + str(i)]
+
+    @property
+    def store(self):
+        return SegmentStore.of(self.archiver)
+
+    @property
+    def data_length(self):
+        return self.getIndex().length
+
+
+class SegmentedDataWriter(object):
+    """Writes the samples of a SegmentedData as they arrive, cutting a segment each time
+    segment_size samples are buffered, so the memory in use stays near one segment."""
+    def __init__(self, target):
+        super(SegmentedDataWriter, self).__init__()
+        self.target = target
+        self.index = SegmentIndex(target.segment_size, addressed=target.addressed)
+        self.buffer = np.empty(target.segment_size)
+        self.buffered = 0
+
+    def append(self, chunk):
+        """Adds samples at the end. chunk is a list-compatible object or a single sample."""
+        chunk = np.asarray(chunk, dtype=np.float64).ravel()
+        position = 0
+        while position < len(chunk):
+            count = min(len(chunk) - position, len(self.buffer) - self.buffered)
+            self.buffer[self.buffered:self.buffered + count] = chunk[position:position + count]
+            self.buffered += count
+            position += count
+            if self.buffered == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        """Writes the buffered samples as the next segment."""
+        if self.buffered == 0:
+            return
+        count = self.buffered
+        self.buffered = 0
+        self.write(SegmentEncoder.encode(self.buffer[:count], self.target.dtype, self.target.scale, self.target.codec), count)
+
+    def appendEncoded(self, strdata, count, digest=None):
+        """Adds a segment of count samples already encoded with the dtype, scale and codec of the target
+        (e.g. by another process, which may compute its digest too). Every segment but the last must
+        have segment_size samples."""
+        if self.buffered:
+            raise Exception("Cannot add an encoded segment after samples which do not fill a segment!")
+        self.write(strdata, count, digest)
+
+    def write(self, strdata, count, digest=None):
+        target = self.target
+        digest = digest or target.hasher.digest(strdata)
+        if self.index.addressed:
+            target.store.add(strdata, digest)
+        else:
+            name = target.file_name + ["SEGMENT-" + str(len(self.index.segments))]
+            target.archiver.add(name, strdata)
+            target.mapper.invalidate(target.archiver, name)
+            target.cache.invalidate(target.archiver, name)
+        self.index.append(count, strdata, target.dtype, digest)
+
+    def close(self):
+        """Writes the last segment and the segment index, releasing the segments it replaces.
+        Content-addressed segments are released after the new ones are added, so the segments
+        which did not change are never removed."""
+        self.flush()
+        target = self.target
+        previous = target.getIndex()
+        if previous.addressed or self.index.addressed:
+            target.releaseSegments(previous)
+        else:
+            target.releaseSegments(previous, keep=len(self.index.segments))
+        target.archiver.add(target.file_name + [target.IndexFileName], json.dumps(self.index.asDict()))
+        target.index = self.index
+        target.objectHash = target.computeHash()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
@@ -0,0 +1,83 @@
+#!/usr/bin/python
+import struct
+import ujson as json
+import numpy as np
+from compression import CodecRegistry
+
+
+class SegmentEncoder(object):
+    """Encodes a segment of samples as a small header followed by typed little-endian values.
+    Header layout: magic, version, dtype code, codec code, reserved, sample count and scale.
+    Samples are stored as round(value/scale) for integer types and value/scale for float types.
+    The values can be filtered and compressed with a codec specification (see CodecRegistry)."""
+    Magic = "BIFS"
+    Version = 1
+    Header = struct.Struct("<4sBBBBQd")
+    DataTypes = {
+        "float32": (1, "<f4"),
+        "float64": (2, "<f8"),
+        "int16": (3, "<i2"),
+        "int32": (4, "<i4"),
+    }
+    DataTypeCodes = dict((code, (name, fmt)) for name, (code, fmt) in DataTypes.items())
+
+    @classmethod
+    def encode(cls, data, dtype="float64", scale=1.0, codec=None):
+        """Returns the binary representation of a list-compatible object of samples."""
+        code, fmt = cls.DataTypes[dtype]
+        values = np.asarray(data, dtype=np.float64)
+        if scale != 1.0:
+            values = values / scale
+        if fmt[1] == "i":
+            info = np.iinfo(fmt)
+            values = np.clip(np.rint(values), info.min, info.max)
+        segment_filter, compressor = CodecRegistry.Default.parse(codec)
+        codec_code = compressor.Code | (segment_filter.Code << 4)
+        header = cls.Header.pack(cls.Magic, cls.Version, code, codec_code, 0, len(values), scale)
+        return header + compressor.compress(segment_filter.apply(values.astype(fmt)))
+
+    @classmethod
+    def decode(cls, strdata, offset=0, size=None):
+        """Returns the samples of an encoded segment as a NumPy array. Old JSON segments are accepted.
+        strdata can be any buffer (e.g. a memory map), in which case the segment starts at offset.
+        Uncompressed float segments without scale are returned as read-only views of that buffer."""
+        if size is None:
+            size = len(strdata) - offset
+        if not cls.isBinary(strdata[offset:offset + len(cls.Magic)]):
+            return np.array(json.loads(strdata[offset:offset + size]), dtype=np.float64)
+        magic, version, code, codec, reserved, length, scale = cls.Header.unpack_from(strdata, offset)
+        name, fmt = cls.DataTypeCodes[code]
+        if codec:
+            strdata = cls.uncompress(strdata, offset, size)
+            offset = 0
+        values = np.frombuffer(strdata, dtype=fmt, count=length, offset=offset + cls.Header.size)
+        if fmt[1] == "i" or scale != 1.0:
+            values = values * scale
+        return values
+
+    @classmethod
+    def uncompress(cls, strdata, offset=0, size=None):
+        """Returns the segment without filter nor compression, which can be decoded as a view."""
+        if size is None:
+            size = len(strdata) - offset
+        if not cls.isBinary(strdata[offset:offset + len(cls.Magic)]):
+            return strdata[offset:offset + size]
+        magic, version, code, codec, reserved, length, scale = cls.Header.unpack_from(strdata, offset)
+        if not codec:
+            return strdata[offset:offset + size]
+        segment_filter, compressor = CodecRegistry.Default.fromCode(codec)
+        payload = compressor.decompress(strdata[offset + cls.Header.size:offset + size])
+        payload = segment_filter.revert(payload, cls.DataTypeCodes[code][1])
+        return cls.Header.pack(magic, version, code, 0, reserved, length, scale) + payload
+
+    @classmethod
+    def dataType(cls, strdata, offset=0):
+        """Returns the data type name of an encoded segment, or "json" for old JSON segments."""
+        if not cls.isBinary(strdata[offset:offset + len(cls.Magic)]):
+            return "json"
+        return cls.DataTypeCodes[cls.Header.unpack_from(strdata, offset)[2]][0]
+
+    @classmethod
+    def isBinary(cls, strdata):
+        """Distinguishes encoded segments from JSON segments of older archives."""
+        return strdata[:len(cls.Magic)] == cls.Magic
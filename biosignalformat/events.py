@@ -0,0 +1,194 @@
+#!/usr/bin/python
+import numpy as np
+import ujson as json
+
+
+class SessionEvent(object):
+    """docstring for SessionEvent"""
+    def __init__(self, time=0, event_name="Unknown", description=""):
+        super(SessionEvent, self).__init__()
+        self.time = time
+        self.event_name = event_name
+        self.description = description
+
+    def asDict(self):
+        return {"time": self.time, "event_name": self.event_name, "description": self.description}
+
+    @classmethod
+    def toJson(cls, event_list):
+        return [o.asDict() for o in event_list]
+
+    @classmethod
+    def fromJson(cls, event_json_list):
+        return [SessionEvent(**o) for o in event_json_list]
+
+
+class EventStore(object):
+    FileName = ".events"
+    LegacyFileName = ".event"
+    Columns = [("times", "<f8"), ("names", "<i4"), ("descriptions", "<i4")]
+    """Events of a session as columns: their times, sorted, and the codes of their names and
+    descriptions in tables of distinct values. They are stored in a single file, as a line with a JSON
+    header followed by the bytes of each column. Time ranges are found by binary search, and the events
+    of a name through an index of their positions, so a query costs log n plus its results.
+    Stored events are read when they are first used, and added events are merged into the columns
+    on the next query. Sessions written as a JSON list of events (LegacyFileName) are read too."""
+    def __init__(self, parent=None, stored=False):
+        super(EventStore, self).__init__()
+        self.parent = parent
+        self.stored = stored
+        self.legacy = False
+        self.dirty = not stored
+        self.columns = None
+        self.tables = None
+        self.codes = None
+        self.pending = []
+        self.byName = None
+
+    @classmethod
+    def fromEvents(cls, parent, events):
+        store = cls(parent)
+        for event in events:
+            store.append(event)
+        return store
+
+    def load(self):
+        """Reads the stored columns the first time they are needed."""
+        if self.columns is not None:
+            return
+        self.columns = dict((name, np.zeros(0, dtype)) for name, dtype in self.Columns)
+        self.tables = {"names": [], "descriptions": [""]}
+        self.codes = {"names": {}, "descriptions": {"": 0}}
+        if not self.stored:
+            return
+        archiver, path = self.parent.archiver, self.parent.pathname
+        try:
+            strdata = archiver.read(path + [self.FileName])
+        except Exception:
+            self.legacy = True
+            for event in SessionEvent.fromJson(json.loads(archiver.read(path + [self.LegacyFileName]))):
+                self.append(event)
+            return
+        offset = strdata.index("\n") + 1
+        header = json.loads(strdata[:offset])
+        self.tables = header["tables"]
+        self.codes = dict((table, dict((value, code) for code, value in enumerate(values))) for table, values in self.tables.items())
+        for name, dtype in self.Columns:
+            self.columns[name] = np.frombuffer(strdata, dtype, header["count"], offset)
+            offset += self.columns[name].nbytes
+
+    def code(self, table, value):
+        codes = self.codes[table]
+        if value not in codes:
+            codes[value] = len(self.tables[table])
+            self.tables[table].append(value)
+        return codes[value]
+
+    def append(self, event):
+        self.load()
+        self.pending.append((event.time, self.code("names", event.event_name), self.code("descriptions", event.description)))
+        self.dirty = True
+
+    def merge(self):
+        """Sorts the added events into the columns: only they are sorted, and they are inserted after
+        the events with the same time, so an append/query loop does not sort the columns again."""
+        self.load()
+        if not self.pending:
+            return
+        added = [np.asarray(values, dtype) for (name, dtype), values in zip(self.Columns, zip(*self.pending))]
+        self.pending = []
+        order = np.argsort(added[0], kind="mergesort")
+        positions = np.searchsorted(self.columns["times"], added[0][order], "right")
+        self.columns = dict((name, np.insert(self.columns[name], positions, values[order])) for (name, dtype), values in zip(self.Columns, added))
+        self.byName = None
+
+    def event(self, i):
+        return SessionEvent(float(self.columns["times"][i]), self.tables["names"][self.columns["names"][i]],
+            self.tables["descriptions"][self.columns["descriptions"][i]])
+
+    def __len__(self):
+        self.merge()
+        return len(self.columns["times"])
+
+    def __getitem__(self, i):
+        self.merge()
+        if isinstance(i, slice):
+            return [self.event(j) for j in range(*i.indices(len(self)))]
+        if not -len(self) <= i < len(self):
+            raise IndexError("event index out of range")
+        return self.event(i % len(self))
+
+    def __iter__(self):
+        self.merge()
+        return (self.event(i) for i in range(len(self)))
+
+    def eventsBetween(self, start, end):
+        """Returns the events from time start to end (both included), sorted by time."""
+        first, last = self.between(self.times, start, end)
+        return [self.event(i) for i in range(first, last)]
+
+    def eventsOfType(self, name, start=None, end=None):
+        """Returns the events with the given name, optionally from time start to end, sorted by time."""
+        positions, times = self.ofType(name)
+        first, last = self.between(times, start, end)
+        return [self.event(i) for i in positions[first:last]]
+
+    def timesOfType(self, name):
+        """Returns the sorted times of the events with the given name, as an array."""
+        return self.ofType(name)[1]
+
+    def ofType(self, name):
+        """Returns the positions and times of the events with the given name, indexing every name the first time."""
+        self.merge()
+        if self.byName is None:
+            codes = self.columns["names"]
+            order = np.argsort(codes, kind="mergesort")
+            bounds = np.searchsorted(codes[order], np.arange(len(self.tables["names"]) + 1))
+            self.byName = dict((value, (order[bounds[code]:bounds[code + 1]], self.columns["times"][order[bounds[code]:bounds[code + 1]]]))
+                for code, value in enumerate(self.tables["names"]))
+        empty = np.zeros(0, "int64"), np.zeros(0)
+        return self.byName.get(name, empty)
+
+    @staticmethod
+    def between(times, start, end):
+        first = 0 if start is None else np.searchsorted(times, start, "left")
+        last = len(times) if end is None else np.searchsorted(times, end, "right")
+        return first, last
+
+    @property
+    def times(self):
+        """Sorted times of every event, as an array."""
+        self.merge()
+        return self.columns["times"]
+
+    @property
+    def names(self):
+        self.merge()
+        return list(self.tables["names"])
+
+    def write(self):
+        """Writes the columns if the events changed, replacing a legacy list of events. Returns the
+        number of written archive members."""
+        if not self.dirty and not self.legacy:
+            return 0
+        self.merge()
+        archiver, path = self.parent.archiver, self.parent.pathname
+        header = json.dumps({"count": len(self.columns["times"]), "tables": self.tables})
+        archiver.add(path + [self.FileName], "".join([header, "\n"] + [self.columns[name].astype(dtype).tostring() for name, dtype in self.Columns]))
+        written = 1
+        if self.legacy:
+            archiver.remove(path + [self.LegacyFileName])
+            self.legacy = False
+        self.stored = True
+        self.dirty = False
+        return written
+
+    def remove(self):
+        if self.columns is None and self.stored:
+            self.load()
+        archiver, path = self.parent.archiver, self.parent.pathname
+        if self.legacy:
+            archiver.remove(path + [self.LegacyFileName])
+        elif self.stored:
+            archiver.remove(path + [self.FileName])
+        self.stored = self.legacy = False
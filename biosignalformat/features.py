@@ -0,0 +1,162 @@
+#!/usr/bin/python
+import collections
+import numpy as np
+import ujson as json
+from hashing import MerkleHasher
+from calculated import AdditionalData, GenericAdditionalData
+from datatype import SegmentedData, StoredData
+
+
+def calculate_feature(function, samples, metadata, parameters):
+    return function(samples, metadata, **parameters)
+
+
+class Feature(object):
+    SegmentLength = 4096
+    """A value derived from the samples of a node: function(samples, metadata, **parameters), where
+    samples are the ones returned by the getData of the node. It returns a JSON value or, if the
+    feature is segmented, an array, which is stored as a SegmentedData."""
+    def __init__(self, name, function, segmented=False, segment_length=SegmentLength):
+        super(Feature, self).__init__()
+        self.name = name
+        self.function = function
+        self.segmented = segmented
+        self.segment_length = segment_length
+
+    def key(self, parameters):
+        """Returns the uniqueID of the FeatureData with the given parameters."""
+        hasher = MerkleHasher.Default
+        return "%s-%s" % (self.name, hasher.digest(json.dumps(parameters, sort_keys=True))[:16])
+
+
+class FeatureData(GenericAdditionalData):
+    Type = "feature"
+    """Stored value of a Feature of a node, with the parameters it was calculated with. It is
+    stored under the node and listed in its calculatedInformation (see Channel.remove)."""
+    def __init__(self, parent, key, segmented=False, feature=None, parameters={}):
+        super(FeatureData, self).__init__(parent, "data")
+        self.uniqueID = key
+        self.feature = feature
+        self.parameters = parameters
+        self.segmented = segmented
+        self.metadata = {"feature": feature.name if feature else None, "parameters": parameters, "segmented": segmented}
+
+    @classmethod
+    def open(cls, parent, key):
+        """Returns the stored FeatureData of a node, whatever its feature."""
+        node = cls(parent, key)
+        node.readMetadata()
+        node.segmented = node.metadata.get("segmented", False)
+        node.parameters = node.metadata.get("parameters", {})
+        return node
+
+    @classmethod
+    def removeStored(cls, parent, key):
+        cls.open(parent, key).remove()
+
+    def calculate(self):
+        return calculate_feature(self.feature.function, self.parent.getData(), dict(self.parent.metadata), self.parameters)
+
+    def createDataHandler(self):
+        if self.segmented:
+            segment_length = self.feature.segment_length if self.feature else Feature.SegmentLength
+            return SegmentedData(segment_length, self, self.pathname + [self.file_name])
+        return StoredData(self, self.pathname + [self.file_name])
+
+    def readData(self, *args):
+        if self.segmented:
+            return self.data.get(*args)
+        return json.loads(self.data.get())
+
+    def store(self, value):
+        """Writes a value calculated from the current content of the parent."""
+        if self.data is None:
+            self.data = self.createDataHandler()
+        self.setData(np.asarray(value) if self.segmented else value)
+        self.targetHash = self.parent.objectHash
+        self.write()
+        self.parent.addCalculatedInformation(self.uniqueID, self.Type)
+
+    def getData(self, *args):
+        if self.data is None:
+            self.data = self.createDataHandler()
+        if self.isStale():
+            self.store(self.calculate())
+        return self.readData(*args)
+
+    def remove(self):
+        super(FeatureData, self).remove()
+        if self.data is None:
+            self.data = self.createDataHandler()
+        if self.segmented:
+            self.data.remove()
+        else:
+            self.archiver.remove(self.data.file_name)
+
+
+class FeatureRegistry(object):
+    """Keeps the features by name. A feature of a node is calculated once for each set of
+    parameters and stored under the node, so it is read back (also from another process or
+    session) until the hash of the node changes."""
+    def __init__(self):
+        super(FeatureRegistry, self).__init__()
+        self.features = {}
+
+    def register(self, name, function, segmented=False, segment_length=Feature.SegmentLength):
+        """Registers function as the feature name (see Feature). Returns the Feature."""
+        self.features[name] = Feature(name, function, segmented, segment_length)
+        return self.features[name]
+
+    def node(self, parent, name, **parameters):
+        """Returns the FeatureData of a node, with its stored metadata if it was calculated."""
+        feature = self.features[name]
+        node = FeatureData(parent, feature.key(parameters), feature.segmented, feature, parameters)
+        try:
+            node.readMetadata()
+        except Exception:
+            pass
+        return node
+
+    def get(self, parent, name, **parameters):
+        """Returns the feature of a node, calculating it if it is not stored or it is stale."""
+        return self.node(parent, name, **parameters).getData()
+
+    def compute(self, parents, name, workers=1, window=None, **parameters):
+        """Calculates the stale features of many nodes, in a process pool of the given workers
+        (the feature function must be a module-level function). Samples are read in this process,
+        and at most window nodes are in flight. Returns the values, in the order of parents."""
+        nodes = [self.node(parent, name, **parameters) for parent in parents]
+        stale = [node for node in nodes if node.isStale()]
+        if workers > 1 and len(stale) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            try:
+                pending = collections.deque()
+                for node in stale:
+                    pending.append((node, pool.apply_async(calculate_feature, self.arguments(node))))
+                    if len(pending) >= (window or 2*workers):
+                        node, result = pending.popleft()
+                        node.store(result.get())
+                while pending:
+                    node, result = pending.popleft()
+                    node.store(result.get())
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for node in stale:
+                node.store(calculate_feature(*self.arguments(node)))
+        return [node.getData() for node in nodes]
+
+    def arguments(self, node):
+        return node.feature.function, node.parent.getData(), dict(node.parent.metadata), node.parameters
+
+    def remove(self, parent):
+        """Removes the stored features of a node (see AdditionalData.removeDerived for any derived data)."""
+        for key, kind in list(parent.calculatedInformation.items()):
+            if kind == FeatureData.Type:
+                FeatureData.removeStored(parent, key)
+                del parent.calculatedInformation[key]
+
+FeatureRegistry.Default = FeatureRegistry()
+AdditionalData.registerType(FeatureData)
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+import hashlib
+
+
+class MerkleHasher(object):
+    Algorithm = "sha224"
+    Batch = 64
+    """Computes the content hashes of an experiment as a Merkle tree. The leaves are the digests of
+    the encoded segments, which are kept in the segment index. A channel hashes the digests of its
+    segments, and sessions, subjects and experiments hash the hashes of their children, so changing
+    one segment re-hashes only that segment and its path up to the experiment. Archives are
+    verified or compared segment by segment, without decoding any segment.
+    With workers > 1, many digests are computed at once in threads (hashlib releases the GIL)."""
+    def __init__(self, workers=1):
+        super(MerkleHasher, self).__init__()
+        self.workers = workers
+
+    def digest(self, strdata):
+        """Returns the digest of an encoded segment, or of any other string."""
+        return hashlib.new(self.Algorithm, strdata).hexdigest()
+
+    def digestMany(self, strdatas):
+        """Returns the digests of an iterable of strings, taking at most Batch strings at once."""
+        pool = None
+        if self.workers > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.workers)
+        digests = []
+        try:
+            batch = []
+            for strdata in strdatas:
+                batch.append(strdata)
+                if len(batch) == self.Batch:
+                    digests += pool.map(self.digest, batch) if pool else [self.digest(s) for s in batch]
+                    batch = []
+            digests += pool.map(self.digest, batch) if pool else [self.digest(s) for s in batch]
+        finally:
+            if pool is not None:
+                pool.close()
+        return digests
+
+    def combine(self, label, digests):
+        """Returns the hash of a node given the hashes of its children. label (e.g. the uniqueID
+        of the node) makes nodes with the same children differ."""
+        hasher = hashlib.new(self.Algorithm)
+        hasher.update(label)
+        for digest in digests:
+            hasher.update("/")
+            hasher.update(digest or "")
+        return hasher.hexdigest()
+
+    def verify(self, experiment):
+        """Checks the stored segments against the digests of their indexes, and the hash of every
+        loaded node against the hashes of its children. Returns the paths which do not match."""
+        mismatches = []
+        self.verifyNode(experiment, mismatches)
+        return mismatches
+
+    def verifyNode(self, node, mismatches):
+        for child in node.childNodes():
+            self.verifyNode(child, mismatches)
+        data = getattr(node, "data", None)
+        if data is not None and hasattr(data, "getIndex"):
+            segments = data.getIndex().segments
+            stored = self.digestMany(data.archiver.read(data.segmentName(i)) for i in range(len(segments)))
+            mismatches += [data.segmentName(i) for i, digest in enumerate(stored) if digest != segments[i][4]]
+        if node.objectHash != node.computeHash():
+            mismatches.append(node.pathname)
+
+    def diff(self, experiment, other):
+        """Compares two experiments, descending only into the nodes whose hashes differ. Returns the
+        paths of the differing segments, of the nodes found in only one of them, and of the nodes
+        which differ by themselves (e.g. by uniqueID)."""
+        differences = []
+        self.diffNode(experiment, other, differences)
+        return differences
+
+    def diffNode(self, node, other, differences):
+        if node.objectHash == other.objectHash:
+            return
+        found = len(differences)
+        data, other_data = getattr(node, "data", None), getattr(other, "data", None)
+        if data is not None and other_data is not None:
+            segments, other_segments = data.getIndex().segments, other_data.getIndex().segments
+            for i in range(max(len(segments), len(other_segments))):
+                if i >= len(segments) or i >= len(other_segments) or segments[i][4] != other_segments[i][4]:
+                    differences.append(data.segmentName(i))
+        children = dict((child.pathname[-1], child) for child in node.childNodes())
+        other_children = dict((child.pathname[-1], child) for child in other.childNodes())
+        for name in sorted(set(children) | set(other_children)):
+            if name in children and name in other_children:
+                self.diffNode(children[name], other_children[name], differences)
+            else:
+                differences.append((children.get(name) or other_children[name]).pathname)
+        if len(differences) == found:
+            differences.append(node.pathname)
+
+MerkleHasher.Default = MerkleHasher()
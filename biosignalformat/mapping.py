@@ -0,0 +1,76 @@
+#!/usr/bin/python
+import os
+import mmap
+import shutil
+from encoding import SegmentEncoder
+
+
+class SegmentMapper(object):
+    SidecarSuffix = ".cache"
+    """Provides read-only memory maps of encoded segments.
+    Archivers which are able to map their own members (see ZipFileArchiveProvider.map) are
+    used directly. Otherwise, with sidecar, each segment is extracted once into an uncompressed
+    sidecar directory next to the archive, and mapped from there in later reads. The sidecar files
+    are kept in a directory named after the size and modification time of the archive, so a
+    rewritten archive is never read from stale copies, and the directories of its previous versions
+    are removed. Sidecars are disabled by default. When they cannot be written (e.g. a read-only
+    location or a full disk), the segment is not mapped, so it is decoded in memory."""
+    def __init__(self, sidecar=False):
+        super(SegmentMapper, self).__init__()
+        self.sidecar = sidecar
+
+    def map(self, archiver, filename):
+        """Returns a (buffer, offset, size) tuple for a segment, or None if it cannot be mapped."""
+        if hasattr(archiver, "map"):
+            mapped = archiver.map(filename)
+            if mapped is not None:
+                return mapped
+        if not self.sidecar:
+            return None
+        try:
+            directory = self.sidecarDirectory(archiver)
+            path = os.path.join(directory, *filename)
+            if not os.path.exists(path):
+                if not os.path.isdir(directory):
+                    self.createDirectory(directory)
+                self.store(path, SegmentEncoder.uncompress(archiver.read(filename)))
+            with open(path, "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except EnvironmentError:
+            return None
+        return mapping, 0, len(mapping)
+
+    def invalidate(self, archiver, filename):
+        """Forgets the sidecar copy of a segment, normally because it was rewritten."""
+        try:
+            path = self.sidecarPath(archiver, filename)
+            if os.path.exists(path):
+                os.remove(path)
+        except EnvironmentError:
+            pass
+
+    def store(self, path, content):
+        """Writes a sidecar file atomically, so concurrent readers never see a partial segment."""
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        temppath = path + ".tmp"
+        with open(temppath, "wb") as f:
+            f.write(content)
+        os.rename(temppath, path)
+
+    def createDirectory(self, directory):
+        """Creates the sidecar directory of a version of an archive, removing the ones of its previous versions."""
+        base = os.path.dirname(directory)
+        if os.path.isdir(base):
+            for name in os.listdir(base):
+                shutil.rmtree(os.path.join(base, name), ignore_errors=True)
+        os.makedirs(directory)
+
+    def sidecarDirectory(self, archiver):
+        stat = os.stat(archiver.archivename)
+        return os.path.join(archiver.archivename + self.SidecarSuffix, "%d-%r" % (stat.st_size, stat.st_mtime))
+
+    def sidecarPath(self, archiver, filename):
+        return os.path.join(self.sidecarDirectory(archiver), *filename)
+
+SegmentMapper.Default = SegmentMapper()
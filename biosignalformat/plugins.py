@@ -1,40 +1,141 @@
 #!/usr/bin/python
 import os
 import sys
+import imp
 import ujson as json
 
 
 class PluginStructure(object):
-    """Provides tools for a plugin architecture."""
+    ManifestFileName = ".manifest.json"
+    ManifestVersion = 2
+    CompiledExtensions = (".pyc", ".pyo")
+    """Provides tools for a plugin architecture. The plugins of plugin_folder and the names they
+    export are kept in a manifest, cached in the folder and checked against the modification times
+    of the plugin files and of the other files of the folder (e.g. order.json), so plugins are found
+    without listing directories and imported only when they are first used. The manifest is rebuilt
+    (importing every plugin) when one of them changes."""
     def __init__(self, plugin_folder = "./plugins", main_module="__init__"):
         super(PluginStructure, self).__init__()
         self.plugin_folder = plugin_folder
         self.main_module = main_module
         self.plugins = {}
+        self.manifest = None
 
     def search_all_plugins(self, autoload=False):
-        possible_plugins = os.listdir(self.plugin_folder)
-        possible_order = os.path.join(self.plugin_folder, "order.json")
-        if os.path.exists(possible_order):
-            possible_plugins = json.loads(open(possible_order, "r"))
-        for possible_plugin in possible_plugins:
+        for possible_plugin in self.get_manifest()["order"]:
             self.search_plugin(possible_plugin, autoload)
         return self.plugins
 
     def search_plugin(self, possible_plugin, autoload=False):
-        location = os.path.join(self.plugin_folder, possible_plugin)
-        if not os.path.isdir(location) or not self.main_module + ".py" in os.listdir(location):
+        if possible_plugin not in self.get_manifest()["plugins"]:
             return None
         if autoload:
-            sys.path.append(os.path.realpath(self.plugin_folder))
-            try:
-                sys.modules[__name__ + "." + possible_plugin] = __import__(possible_plugin)
-            finally:
-                del sys.path[-1]
-            return sys.modules[__name__ + "." + possible_plugin]
-        return True
+            self.plugins[possible_plugin] = self.load_plugin(possible_plugin)
+        else:
+            self.plugins.setdefault(possible_plugin, True)
+        return self.plugins[possible_plugin]
+
+    def search_export(self, name, autoload=False):
+        """Returns the first plugin (in the manifest order) which exports a name, e.g. an importer."""
+        manifest = self.get_manifest()
+        for possible_plugin in manifest["order"]:
+            if name in manifest["plugins"][possible_plugin]["exports"]:
+                return self.search_plugin(possible_plugin, autoload)
+        return None
+
+    def load_plugin(self, possible_plugin):
+        """Imports a plugin as a package from plugin_folder, without changing sys.path."""
+        name = __name__ + "." + possible_plugin
+        if name not in sys.modules:
+            module = sys.modules.get(possible_plugin)
+            if module is None:
+                found = imp.find_module(possible_plugin, [os.path.realpath(self.plugin_folder)])
+                try:
+                    module = imp.load_module(possible_plugin, *found)
+                finally:
+                    if found[0] is not None:
+                        found[0].close()
+            sys.modules[name] = module
+        return sys.modules[name]
 
     def load_all(self):
         plugins = self.search_all_plugins(autoload=True)
 
+    def get_manifest(self):
+        """Returns the manifest, reading the cached one if it is current, or building it."""
+        if self.manifest is None:
+            try:
+                with open(os.path.join(self.plugin_folder, self.ManifestFileName), "r") as f:
+                    manifest = json.loads(f.read())
+                if self.is_current(manifest):
+                    self.manifest = manifest
+            except Exception:
+                pass
+        if self.manifest is None:
+            self.manifest = self.build_manifest()
+            try:
+                for attempt in range(2): #Creating the file changes the mtime of the folder
+                    with open(os.path.join(self.plugin_folder, self.ManifestFileName), "w") as f:
+                        f.write(json.dumps(self.manifest, indent=4))
+                    self.manifest["mtime"] = self.mtime(self.plugin_folder)
+            except Exception:
+                pass #A read-only folder only prevents the caching
+        return self.manifest
+
+    def is_current(self, manifest):
+        """Checks the manifest against the modification times of the folder and of its files, of each
+        plugin and of its files."""
+        if manifest.get("version") != self.ManifestVersion or manifest.get("mtime") != self.mtime(self.plugin_folder):
+            return False
+        for name, mtime in manifest["inputs"].items():
+            if mtime != self.mtime(os.path.join(self.plugin_folder, name)):
+                return False
+        for possible_plugin, plugin in manifest["plugins"].items():
+            location = os.path.join(self.plugin_folder, possible_plugin)
+            if plugin["mtime"] != self.mtime(location):
+                return False
+            for name, mtime in plugin["files"].items():
+                if mtime != self.mtime(os.path.join(location, name)):
+                    return False
+        return True
+
+    def build_manifest(self):
+        """Finds the plugins and imports them, to record the names they define (e.g. importers)."""
+        manifest = {"version": self.ManifestVersion, "mtime": self.mtime(self.plugin_folder), "inputs": {}, "order": [], "plugins": {}}
+        if not os.path.isdir(self.plugin_folder):
+            return manifest
+        possible_plugins = sorted(os.listdir(self.plugin_folder))
+        manifest["inputs"] = dict((name, self.mtime(os.path.join(self.plugin_folder, name))) for name in possible_plugins
+            if name != self.ManifestFileName and os.path.isfile(os.path.join(self.plugin_folder, name)))
+        possible_order = os.path.join(self.plugin_folder, "order.json")
+        if os.path.exists(possible_order):
+            with open(possible_order, "r") as f:
+                possible_plugins = json.loads(f.read())
+        for possible_plugin in possible_plugins:
+            location = os.path.join(self.plugin_folder, possible_plugin)
+            if not os.path.isdir(location) or not self.main_module + ".py" in os.listdir(location):
+                continue
+            plugin = {}
+            try:
+                module = self.load_plugin(possible_plugin)
+                plugin["exports"] = sorted(name for name in dir(module) if not name.startswith("_") and
+                    getattr(getattr(module, name), "__module__", "").split(".")[0] == possible_plugin)
+            except Exception as e:
+                plugin["exports"] = []
+                plugin["error"] = str(e)
+            files = [name for name in os.listdir(location) if os.path.isfile(os.path.join(location, name)) and
+                not name.endswith(self.CompiledExtensions)]
+            plugin["mtime"] = self.mtime(location) #After the import, which may write .pyc files
+            plugin["files"] = dict((name, self.mtime(os.path.join(location, name))) for name in files)
+            manifest["order"].append(possible_plugin)
+            manifest["plugins"][possible_plugin] = plugin
+        return manifest
+
+    @staticmethod
+    def mtime(path):
+        try:
+            return repr(os.stat(path).st_mtime)
+        except OSError:
+            return None
+
 PluginStructure.BaseArchitecture = PluginStructure()
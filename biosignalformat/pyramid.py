@@ -0,0 +1,168 @@
+#!/usr/bin/python
+import math
+import numpy as np
+from calculated import AdditionalData, SegmentedAdditionalData
+
+
+class PyramidLevel(SegmentedAdditionalData):
+    """Level of a DecimationPyramid: the min, max and mean of each bin of 2**level samples,
+    stored as interleaved [min, max, mean] triplets."""
+    def __init__(self, parent, level):
+        super(PyramidLevel, self).__init__(parent, "data", DecimationPyramid.SegmentLength)
+        self.uniqueID = "pyramid-%d" % level
+        self.level = level
+        self.metadata = {"feature": "pyramid", "level": level, "bin-size": 2**level}
+        self.data = self.createDataHandler()
+
+    def getBins(self, first, last):
+        """Returns bins first..last as a (bins, 3) array of min, max and mean."""
+        return self.data.get(3*first, 3*last + 2).reshape(-1, 3)
+
+    def remove(self):
+        super(PyramidLevel, self).remove()
+        self.data.remove()
+
+    @property
+    def bins(self):
+        return self.data.data_length // 3
+
+
+class BinAccumulator(object):
+    """Merges pairs of consecutive bins of a level into the bins of the next level, keeping the
+    last bin until its pair arrives. Bins are (min, max, sum, count) arrays."""
+    def __init__(self):
+        super(BinAccumulator, self).__init__()
+        self.pending = None
+
+    def add(self, bins):
+        if self.pending is not None:
+            bins = [np.concatenate([p, b]) for p, b in zip(self.pending, bins)]
+        paired = len(bins[0]) // 2 * 2
+        self.pending = [b[paired:] for b in bins] if paired < len(bins[0]) else None
+        mins, maxs, sums, counts = [b[:paired] for b in bins]
+        return [np.minimum(mins[0::2], mins[1::2]), np.maximum(maxs[0::2], maxs[1::2]),
+            sums[0::2] + sums[1::2], counts[0::2] + counts[1::2]]
+
+    def finish(self):
+        pending, self.pending = self.pending, None
+        return pending
+
+
+class DecimationPyramid(object):
+    MinLevel = 4
+    TopBins = 1024
+    SegmentLength = 3*4096
+    Type = "pyramid"
+    """Min, max and mean of a channel at power-of-two levels (bins of 2**MinLevel samples up to
+    the level with at most TopBins bins), for drawing long spans without reading every sample.
+    Each level is stored as a PyramidLevel under the channel, built in a single pass over the
+    channel segments, and rebuilt when the channel hash differs from their targetHash."""
+    def __init__(self, channel):
+        super(DecimationPyramid, self).__init__()
+        self.channel = channel
+        self.top = None
+        self.validHash = None
+
+    def query(self, start, end, width, unit="samples"):
+        """Returns a (bin_size, first, block) tuple to draw samples start..end in width pixels:
+        block is a (bins, 3) array with the min, max and mean of the bins of bin_size samples
+        from sample first. The coarsest level with at least a bin per pixel is used; with fewer
+        than 2**MinLevel samples per pixel, the samples themselves are returned as bins of one.
+        With unit="seconds", start and end are times (see Session.getData)."""
+        if unit == "seconds":
+            rate = self.channel.metadata.get("sampling-rate", 0)
+            offset = self.channel.metadata.get("time-offset", 0)
+            start, end = int(round((start - offset) * rate)), int(round((end - offset) * rate))
+        start, end = max(int(start), 0), min(int(end), self.channel.data_length - 1)
+        per_pixel = (end - start + 1) / float(max(width, 1))
+        level = int(math.floor(math.log(per_pixel, 2))) if per_pixel >= 1 else 0
+        if level < self.MinLevel or not self.update():
+            values = self.channel.getData(start, end)
+            return 1, start, np.column_stack([values, values, values])
+        level = min(level, self.top)
+        size = 2**level
+        pyramid_level = PyramidLevel(self.channel, level)
+        last = min(end // size, pyramid_level.bins - 1)
+        return size, start // size * size, pyramid_level.getBins(start // size, last)
+
+    def update(self):
+        """Builds the pyramid unless it is up to date. Returns False if the channel is too short for one."""
+        self.channel.updateHash()
+        if self.validHash != self.channel.objectHash:
+            if not self.isValid():
+                self.build()
+            self.validHash = self.channel.objectHash
+        return self.top is not None
+
+    def isValid(self):
+        """Checks the stored pyramid against the channel hash."""
+        level = PyramidLevel(self.channel, self.MinLevel)
+        try:
+            level.readMetadata()
+        except Exception:
+            return False
+        self.top = level.metadata["top-level"]
+        self.channel.updateHash()
+        return level.targetHash == self.channel.objectHash
+
+    def build(self):
+        """Computes every level, reading the channel segment by segment."""
+        length = self.channel.data_length
+        stored = self.top
+        self.top = None
+        if length < 2**self.MinLevel:
+            self.removeLevels(self.MinLevel, stored)
+            return
+        top = max(self.MinLevel, int(math.ceil(math.log(length / float(self.TopBins), 2))))
+        levels = dict((level, PyramidLevel(self.channel, level)) for level in range(self.MinLevel, top + 1))
+        writers = dict((level, levels[level].data.openWriter()) for level in levels)
+        accumulators = dict((level, BinAccumulator()) for level in levels)
+        def emit(level, bins):
+            mins, maxs, sums, counts = bins
+            writers[level].append(np.column_stack([mins, maxs, sums / counts]).ravel())
+            if level < top:
+                merged = accumulators[level + 1].add(bins)
+                if len(merged[0]):
+                    emit(level + 1, merged)
+        size = 2**self.MinLevel
+        carry = np.zeros(0)
+        data = self.channel.data
+        for i in range(len(data.getIndex().segments)):
+            values = np.concatenate([carry, data.readSegment(i)])
+            full = len(values) // size * size
+            blocks = values[:full].reshape(-1, size)
+            if len(blocks):
+                emit(self.MinLevel, [blocks.min(1), blocks.max(1), blocks.sum(1), np.repeat(float(size), len(blocks))])
+            carry = values[full:]
+        if len(carry):
+            emit(self.MinLevel, [np.array([carry.min()]), np.array([carry.max()]), np.array([carry.sum()]), np.array([float(len(carry))])])
+        for level in range(self.MinLevel + 1, top + 1):
+            pending = accumulators[level].finish()
+            if pending is not None:
+                emit(level, pending)
+        for level in levels:
+            writers[level].close()
+            levels[level].targetHash = self.channel.objectHash
+            levels[level].metadata["top-level"] = top
+            levels[level].write()
+        self.removeLevels(top + 1, stored)
+        self.top = top
+        self.channel.addCalculatedInformation(self.Type, self.Type)
+
+    def remove(self):
+        """Removes the stored levels."""
+        if self.top is None:
+            self.isValid()
+        self.removeLevels(self.MinLevel, self.top)
+        self.top = None
+        self.validHash = None
+
+    @classmethod
+    def removeStored(cls, channel, key):
+        cls(channel).remove()
+
+    def removeLevels(self, first, last):
+        for level in range(first, (last or 0) + 1):
+            PyramidLevel(self.channel, level).remove()
+
+AdditionalData.registerType(DecimationPyramid)
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from calculated import AdditionalData, SegmentedAdditionalData
+
+
+def hann(window):
+    """Periodic Hann taper, as used by Welch's method."""
+    return 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(window) / window)
+
+
+class FrameStream(object):
+    """Cuts consecutive blocks of samples (e.g. the segments of a channel) into frames of window
+    samples every step samples, as if they were a single array: the samples of a frame which spans
+    two blocks are carried until the next one arrives, and when step exceeds window, the samples
+    before the next frame which lie in later blocks are skipped there. Frames are views of the
+    current block."""
+    def __init__(self, window, step):
+        super(FrameStream, self).__init__()
+        self.window = window
+        self.step = step
+        self.carry = np.zeros(0)
+        self.skip = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype="float64")
+        skipped = min(self.skip, len(values))
+        self.skip -= skipped
+        values = np.concatenate([self.carry, values[skipped:]])
+        count = (len(values) - self.window) // self.step + 1 if len(values) >= self.window else 0
+        self.carry = values[count*self.step:].copy()
+        self.skip += max(0, count*self.step - len(values))
+        itemsize = values.itemsize
+        return as_strided(values, shape=(count, self.window), strides=(self.step*itemsize, itemsize))
+
+
+class SpectralData(SegmentedAdditionalData):
+    BatchFrames = 512
+    """Base of the spectral features of a channel. Frames of window samples every step samples are
+    tapered and transformed BatchFrames at a time, in a single pass over the channel segments, so
+    a channel of any length is processed in constant memory. The result is stored under the
+    channel, and calculated again when the channel hash differs from its targetHash."""
+    def __init__(self, channel, uniqueID, window, step, segment_length, detrend=True):
+        super(SpectralData, self).__init__(channel, "data", segment_length)
+        self.uniqueID = uniqueID
+        self.window = window
+        self.step = step
+        self.detrend = detrend
+        self.taper = hann(window)
+        self.metadata = {"feature": uniqueID.split("-")[0], "window": window, "step": step,
+            "detrend": detrend, "segmented": True}
+        self.data = self.createDataHandler()
+        try:
+            self.readMetadata()
+        except Exception:
+            pass
+
+    def update(self):
+        """Calculates the feature unless it is up to date."""
+        if self.isStale():
+            with self.data.openWriter() as writer:
+                self.build(writer)
+            self.targetHash = self.parent.objectHash
+            self.write()
+            self.parent.addCalculatedInformation(self.uniqueID, self.Type)
+
+    def build(self, writer):
+        raise Exception("Not implemented!")
+
+    def periodograms(self):
+        """Yields the one-sided power spectral densities of the frames of the channel, as (frames, bins) arrays."""
+        stream = FrameStream(self.window, self.step)
+        scale = self.rate * (self.taper ** 2).sum()
+        data = self.parent.data
+        for i in range(len(data.getIndex().segments)):
+            frames = stream.add(data.readSegment(i))
+            for first in range(0, len(frames), self.BatchFrames):
+                batch = frames[first:first + self.BatchFrames]
+                if self.detrend:
+                    batch = batch - batch.mean(axis=1)[:, None]
+                spectrum = np.fft.rfft(batch * self.taper, axis=1)
+                power = (spectrum.real ** 2 + spectrum.imag ** 2) / scale
+                power[:, 1:(self.window + 1) // 2] *= 2
+                yield power
+
+    def remove(self):
+        super(SpectralData, self).remove()
+        self.data.remove()
+
+    @classmethod
+    def removeStored(cls, parent, key):
+        """Removes the feature of uniqueID key, which is made of its Type, window and step."""
+        window, step = [int(value) for value in key.split("-")[1:]]
+        cls(parent, window, step).remove()
+
+    @property
+    def rate(self):
+        return float(self.parent.metadata.get("sampling-rate") or 1.0)
+
+    @property
+    def bins(self):
+        return self.window // 2 + 1
+
+    @property
+    def frequencies(self):
+        return np.arange(self.bins) * self.rate / self.window
+
+
+class Spectrogram(SpectralData):
+    FramesPerSegment = 256
+    Type = "stft"
+    """Short-time Fourier transform of a channel: the power spectral density of each frame, with the
+    scale of WelchPSD. Frame i starts at sample i*step. The frames are stored FramesPerSegment to a
+    segment, so a time range is read without reading the rest."""
+    def __init__(self, channel, window=256, step=None, detrend=True):
+        step = step or window // 2
+        super(Spectrogram, self).__init__(channel, "%s-%d-%d" % (self.Type, window, step), window, step,
+            (window // 2 + 1) * self.FramesPerSegment, detrend)
+
+    def build(self, writer):
+        for power in self.periodograms():
+            writer.append(power.ravel())
+
+    def getFrames(self, first=0, last=None):
+        """Returns frames first..last as a (frames, bins) array."""
+        self.update()
+        last = self.frames - 1 if last is None else min(last, self.frames - 1)
+        if last < first:
+            return np.zeros((0, self.bins))
+        return self.data.get(first * self.bins, (last + 1) * self.bins - 1).reshape(-1, self.bins)
+
+    @property
+    def frames(self):
+        self.update()
+        return self.data.data_length // self.bins
+
+    @property
+    def times(self):
+        """Time of the center of each frame, in seconds."""
+        offset = self.parent.metadata.get("time-offset", 0)
+        return offset + (np.arange(self.frames) * self.step + self.window / 2.0) / self.rate
+
+
+class WelchPSD(SpectralData):
+    Type = "welch"
+    """Power spectral density of a channel by Welch's method: the mean of the periodograms of
+    Hann-tapered frames of window samples every step samples (half a window by default)."""
+    def __init__(self, channel, window=256, step=None, detrend=True):
+        step = step or window // 2
+        super(WelchPSD, self).__init__(channel, "%s-%d-%d" % (self.Type, window, step), window, step,
+            window // 2 + 1, detrend)
+
+    def build(self, writer):
+        total = np.zeros(self.bins)
+        count = 0
+        for power in self.periodograms():
+            total += power.sum(axis=0)
+            count += len(power)
+        writer.append(total / max(count, 1))
+
+    def getData(self):
+        """Returns the power spectral density at each of frequencies."""
+        self.update()
+        return self.data.get()
+
+AdditionalData.registerType(Spectrogram)
+AdditionalData.registerType(WelchPSD)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+import weakref
+import ujson as json
+
+
+class SegmentStore(object):
+    DirName = "SEGMENTS"
+    ReferencesFileName = ".references"
+    PendingFileName = ".pending"
+    IndexFileName = ".index"
+    """Keeps the segments of an archive by content: each segment is stored once, named by its digest
+    (see MerkleHasher), whatever the number of channels which refer to it. The number of references
+    of each segment is kept in the archive, and a segment is removed with its last reference.
+    The counts are written by Experiment.write, so a marker (PendingFileName) is written when they
+    first change after it: if it is found, the previous process did not write them, and they are
+    counted again from the segment indexes of the archive (see SegmentIndex). A segment without
+    references in the counts is never removed.
+    There is a single store per archive provider (see SegmentStore.of)."""
+    Stores = weakref.WeakKeyDictionary()
+
+    def __init__(self, archiver):
+        super(SegmentStore, self).__init__()
+        self.archiver = archiver
+        self.counts = None
+        self.dirty = False
+        self.pending = False
+
+    @classmethod
+    def of(cls, archiver):
+        """Returns the store of an archive provider."""
+        if archiver not in cls.Stores:
+            cls.Stores[archiver] = cls(archiver)
+        return cls.Stores[archiver]
+
+    def path(self, digest):
+        return [self.DirName, digest]
+
+    def add(self, strdata, digest):
+        """Adds a reference to a segment, writing it only if it is not stored yet. Returns its path."""
+        counts = self.getCounts()
+        if not counts.get(digest):
+            self.archiver.add(self.path(digest), strdata)
+        counts[digest] = counts.get(digest, 0) + 1
+        self.markDirty()
+        return self.path(digest)
+
+    def release(self, digest):
+        """Drops a reference to a segment, removing it when it was the last one. Returns True if it was removed."""
+        counts = self.getCounts()
+        if counts.get(digest, 0) <= 0:
+            return False #Unknown references: keeping an unused segment is safer than losing a used one
+        counts[digest] -= 1
+        self.markDirty()
+        if counts[digest] > 0:
+            return False
+        del counts[digest]
+        self.archiver.remove(self.path(digest))
+        return True
+
+    def references(self, digest):
+        return self.getCounts().get(digest, 0)
+
+    def markDirty(self):
+        """Records that the counts changed, writing the marker the first time after they were written."""
+        self.dirty = True
+        if not self.pending:
+            self.archiver.add([self.DirName, self.PendingFileName], "")
+            self.pending = True
+
+    def getCounts(self):
+        """Returns the reference counts, reading them from the archive the first time. They are counted
+        from the segment indexes if they are missing or were left pending."""
+        if self.counts is None:
+            try:
+                self.counts = json.loads(self.archiver.read([self.DirName, self.ReferencesFileName]))
+            except Exception:
+                self.counts = None
+            if self.counts is None or self.isPending():
+                self.counts = self.countReferences()
+                self.dirty = True
+        return self.counts
+
+    def isPending(self):
+        try:
+            self.archiver.read([self.DirName, self.PendingFileName])
+        except Exception:
+            return False
+        self.pending = True
+        return True
+
+    def countReferences(self):
+        """Counts the references of every content-addressed segment index of the archive."""
+        counts = {}
+        for name in self.archiver.list():
+            if name.split("/")[-1] != self.IndexFileName:
+                continue
+            index = json.loads(self.archiver.read(name.split("/")))
+            if index.get("content-addressed"):
+                for segment in index["segments"]:
+                    counts[segment[4]] = counts.get(segment[4], 0) + 1
+        return counts
+
+    def write(self):
+        """Writes the reference counts if they changed, and drops the marker. Returns the number of
+        written archive members."""
+        if not self.dirty:
+            return 0
+        self.archiver.add([self.DirName, self.ReferencesFileName], json.dumps(self.counts, sort_keys=True))
+        if self.pending:
+            self.archiver.remove([self.DirName, self.PendingFileName])
+            self.pending = False
+        self.dirty = False
+        return 1
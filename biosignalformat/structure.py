@@ -3,9 +3,17 @@ import os
 import sys
 import uuid
 import ujson as json
-import hashlib
-from datatype import SegmentedData, StoredData
+import numpy as np
+from hashing import MerkleHasher
+from datatype import SegmentedData, SegmentIndex
 from base import BaseFile
+from archiver import ArchiveListing
+from catalog import Catalog
+from store import SegmentStore
+from asyncread import AsyncReader
+from pyramid import DecimationPyramid
+from calculated import AdditionalData
+from events import EventStore, SessionEvent
 
 
 class Experiment(BaseFile):
@@ -14,20 +22,67 @@ class Experiment(BaseFile):
         super(Experiment, self).__init__(metadata)
         self.subjects = []
         self.deletedSubjects = []
+        self.catalogWritten = False
 
     def setArchiver(self, archiver):
         self._archiver = archiver
 
+    @classmethod
+    def open(cls, archiver, catalog=True):
+        """Opens an experiment stored in an archive. Only its metadata is read: subjects, sessions
+        and channels are read when their lists are first used, and samples when getData is called.
+        If the archive has a catalog, the whole tree is read from it at once (see Catalog)."""
+        experiment = cls()
+        experiment.setArchiver(archiver)
+        experiment.listing = ArchiveListing(archiver)
+        stored = Catalog.read(archiver) if catalog else None
+        if stored is not None:
+            experiment.catalog = stored.root
+            experiment.catalogWritten = True
+            experiment.loadMetadata(stored.root["metadata"])
+        else:
+            experiment.readMetadata()
+        experiment.setOpened()
+        return experiment
+
+    @classmethod
+    def rebuildCatalog(cls, archiver):
+        """Writes the catalog of an archive which lacks it, reading every node once."""
+        experiment = cls.open(archiver, catalog=False)
+        experiment.write()
+        return experiment
+
+    def setOpened(self):
+        self._subjects = None
+
+    @property
+    def subjects(self):
+        if self._subjects is None:
+            self._subjects = self.openChildren(Subject, "experiment")
+        return self._subjects
+
+    @subjects.setter
+    def subjects(self, subjects):
+        self._subjects = subjects
+
     def write(self):
-        """Write the content inside the archive provide."""
-        super(Experiment, self).write()
-        for subject in self.subjects:
-            subject.write()
+        """Write the content inside the archive provide. Only the nodes which changed since the last
+        write are written, children first, so the parents are written with their final hashes.
+        Returns the number of written archive members."""
+        written = 0
+        for subject in self._subjects or []:
+            written += subject.write()
         for subject in self.deletedSubjects:
             subject.remove()
         self.deletedSubjects = []
-        self.writeMetadata()
+        written += super(Experiment, self).write()
+        written += SegmentStore.of(self.archiver).write()
+        if written or not self.catalogWritten:
+            Catalog(self.catalogNode()).write(self.archiver)
+            self.catalogWritten = True
+            written += 1
         self.archiver.force_write()
+        return written
 
     def remove(self):
         """Operation not allowed at Experiment-level."""
@@ -43,15 +98,29 @@ class Experiment(BaseFile):
         """Adds a subject, recognizing it as a child XD."""
         self.subjects.append(subject)
         subject.experiment = self
+        self.markDirty()
 
     def removeSubject(self, subject):
         """Removes a subject."""
         self.subjects.remove(subject)
         self.deletedSubjects.append(subject)
+        self.markDirty()
 
     def updateHash(self):
-        """Generates a hash code with the objects."""
-        self.hash_me("-".join(child.objectHash for child in self.subjects))
+        """Generates a hash code with the objects. Children which were never read keep it unchanged."""
+        if self._subjects is not None:
+            self.objectHash = self.computeHash()
+
+    def computeHash(self):
+        return MerkleHasher.Default.combine(self.uniqueID, [child.objectHash for child in self.subjects])
+
+    def childNodes(self):
+        return self.subjects
+
+    def catalogChildren(self):
+        if self._subjects is None and self.catalog is not None:
+            return self.catalog["children"]
+        return [subject.catalogNode() for subject in self.subjects]
 
     def defaultMetadataValues(self):
         """Fills the minimum neccesary metadata values."""
@@ -61,6 +130,7 @@ class Experiment(BaseFile):
 
 
 class Subject(BaseFile):
+    Prefix = "SUBJECT-"
     """Represents a subject experiment in the sense of BIF."""
     def __init__(self, metadata={}):
         super(Subject, self).__init__(metadata)
@@ -68,40 +138,67 @@ class Subject(BaseFile):
         self.sessions = []
         self.deletedSessions = []
 
+    def setOpened(self):
+        self._sessions = None
+
+    @property
+    def sessions(self):
+        if self._sessions is None:
+            self._sessions = self.openChildren(Session, "subject")
+        return self._sessions
+
+    @sessions.setter
+    def sessions(self, sessions):
+        self._sessions = sessions
+
     def write(self):
-        """Write the content inside the archive provide."""
-        super(Subject, self).write()
-        for session in self.sessions:
-            session.write()
+        """Write the content inside the archive provide. Returns the number of written archive members."""
+        written = 0
+        for session in self._sessions or []:
+            written += session.write()
         for session in self.deletedSessions:
             session.remove()
-        self.deletedSession = []
-        self.writeMetadata()
+        self.deletedSessions = []
+        return written + super(Subject, self).write()
 
     def remove(self):
         """Removes the content inside the archive provide."""
-        super(Subject, self).remove()
-        for subject in self.session + self.deletedSessions:
+        if self.isStored():
+            super(Subject, self).remove()
+        for session in self.sessions + self.deletedSessions:
             session.remove()
-        self.deletedSession = []
-        self.writeMetadata()
+        self.deletedSessions = []
 
     def addSession(self, session):
         """Add a session, recognizing it as a child XD."""
         self.sessions.append(session)
         session.subject = self
+        self.markDirty()
 
     def removeSession(self, session):
         """Remove a session."""
         self.sessions.remove(session)
         self.deletedSessions.append(session)
+        self.markDirty()
 
     def updateHash(self):
-        self.hash_me("-".join(child.objectHash for child in self.sessions))
+        if self._sessions is not None:
+            self.objectHash = self.computeHash()
+
+    def computeHash(self):
+        return MerkleHasher.Default.combine(self.uniqueID, [child.objectHash for child in self.sessions])
+
+    def childNodes(self):
+        return self.sessions
+
+    def catalogChildren(self):
+        if self._sessions is None and self.catalog is not None:
+            return self.catalog["children"]
+        return [session.catalogNode() for session in self.sessions]
 
     @property
     def pathname(self):
-        return self.experiment.pathname + ["SUBJECT-" + self.uniqueID]
+        return self.experiment.pathname + [self.Prefix + self.uniqueID]
 
     @property
     def archiver(self):
@@ -117,53 +214,180 @@ class Subject(BaseFile):
 
 
 class Session(BaseFile):
-    EventFileName = ".event"
+    Prefix = "SESSION-"
     """Represents a session experiment of a subject in the sense of BIF."""
     def __init__(self, metadata={}):
         super(Session, self).__init__(metadata)
         self.subject = None
         self.channels = []
         self.deletedChannels = []
-        self.events = []
-        self.event_handler = None
+        self.events = EventStore(self)
+
+    def setOpened(self):
+        self._channels = None
+        self._events = None
+
+    @property
+    def channels(self):
+        if self._channels is None:
+            self._channels = self.openChildren(Channel, "session")
+        return self._channels
+
+    @channels.setter
+    def channels(self, channels):
+        self._channels = channels
+
+    @property
+    def events(self):
+        """EventStore of the session. It reads the stored events when they are first queried."""
+        if self._events is None:
+            if self.catalog is not None:
+                stored = self.catalog.get("event-count", 0) > 0
+            else:
+                stored = bool(self.listing.children(self.pathname, EventStore.FileName) or
+                    self.listing.children(self.pathname, EventStore.LegacyFileName))
+            self._events = EventStore(self, stored)
+        return self._events
+
+    @events.setter
+    def events(self, events):
+        self._events = events if isinstance(events, EventStore) else EventStore.fromEvents(self, events)
 
     def write(self):
-        """Write the content inside the archive provide."""
-        super(Session, self).write()
-        for channel in self.channels:
-            channel.write()
+        """Write the content inside the archive provide. Returns the number of written archive members."""
+        written = 0
+        for channel in self._channels or []:
+            written += channel.write()
         for channel in self.deletedChannels:
             channel.remove()
         self.deletedChannels = []
-        if self.event_handler is None:
-            self.event_handler = StoredData(self, self.pathname + [self.EventFileName])
-        self.event_handler.set(SessionEvent.toJson(self.events), indent=4)
+        if self._events is not None:
+            written += self._events.write()
+        return written + super(Session, self).write()
 
     def remove(self):
         """Removes the content inside the archive provide."""
-        super(Session, self).remove()
+        if self.isStored():
+            super(Session, self).remove()
         for channel in self.channels + self.deletedChannels:
             channel.remove()
         self.deletedChannels = []
-        self.writeMetadata()
-        self.events = {}
-        self.event_handler.set([])
+        self.events.remove()
 
     def addChannel(self, channel):
         """Add a channel dataset, recognizing it as a child XD."""
         self.channels.append(channel)
         channel.session = self
+        self.markDirty()
 
     def removeChannel(self, channel):
         """Remove a session."""
         self.channels.remove(channel)
         self.deletedChannels.append(channel)
+        self.markDirty()
+
+    def agetMany(self, labels, start = 0, end = None, reader = None):
+        """Returns a ReadFuture of the samples of the channels with the given labels, as a list of
+        arrays in the same order. The segments of every channel are read concurrently."""
+        reader = reader or AsyncReader.Default
+        return reader.gather([channel.agetData(start, end, reader) for channel in self.findChannels(labels)])
+
+    def getData(self, labels = None, start = 0, end = None, unit = "samples"):
+        """Returns the samples start..end of the channels with the given labels (all by default) as a
+        channels x samples array, allocated once and filled segment by segment. With unit="seconds",
+        start and end are times, mapped to samples with the sampling-rate and time-offset metadata
+        of each channel, which must share the sampling rate. Samples a channel lacks are NaN."""
+        channels = self.findChannels(labels)
+        if unit == "samples":
+            firsts = [int(start) for channel in channels]
+            count = int(end) - int(start) + 1 if end is not None else None
+        elif unit == "seconds":
+            rates = set(channel.metadata.get("sampling-rate", 0) for channel in channels)
+            rate = rates.pop() if len(rates) == 1 else 0
+            if rate <= 0:
+                raise Exception("Channels must share a known sampling rate to be read in seconds!")
+            firsts = [int(round((start - channel.metadata.get("time-offset", 0)) * rate)) for channel in channels]
+            count = int(round((end - start) * rate)) + 1 if end is not None else None
+        else:
+            raise Exception("Unknown unit: " + unit)
+        if count is None:
+            count = max([channel.data_length - first for channel, first in zip(channels, firsts)] or [0])
+        block = np.empty((len(channels), max(count, 0)))
+        block.fill(np.nan)
+        for row, channel, first in zip(block, channels, firsts):
+            channel.readInto(row, first)
+        return block
+
+    def epochs(self, event_type, tmin, tmax, labels = None, baseline = None):
+        """Returns the samples from tmin to tmax seconds around every event of a type, for the channels
+        with the given labels (all by default), as an events x channels x samples array. Sample k is
+        at tmin + k / sampling-rate from its event; samples a channel lacks are NaN. Event times are
+        in seconds, mapped to samples as in getData. With baseline=(start, end) (in seconds from the
+        event, None for the first or last sample), the mean of that window is subtracted from each
+        epoch. Each touched segment is decoded once for all the epochs (see SegmentedData.take)."""
+        channels = self.findChannels(labels)
+        rates = set(channel.metadata.get("sampling-rate", 0) for channel in channels)
+        rate = rates.pop() if len(rates) == 1 else 0
+        if rate <= 0:
+            raise Exception("Channels must share a known sampling rate to be cut in epochs!")
+        times = self.events.timesOfType(event_type)
+        first, count = int(round(tmin * rate)), int(round((tmax - tmin) * rate)) + 1
+        epochs = np.empty((len(times), len(channels), max(count, 0)))
+        for c, channel in enumerate(channels):
+            onsets = np.round((times - channel.metadata.get("time-offset", 0)) * rate).astype("int64") + first
+            epochs[:, c, :] = channel.take(onsets[:, None] + np.arange(count))
+        if baseline is not None:
+            offsets = tmin + np.arange(count) / float(rate)
+            start, end = baseline
+            window = (offsets >= (tmin if start is None else start)) & (offsets <= (tmax if end is None else end))
+            values = epochs[:, :, window]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                epochs -= (np.nansum(values, axis=2) / (~np.isnan(values)).sum(axis=2))[:, :, None]
+        return epochs
+
+    def findChannels(self, labels = None):
+        """Returns the channels with the given labels, in the same order, or all of them."""
+        if labels is None:
+            return list(self.channels)
+        channels = dict((channel.metadata.get("label"), channel) for channel in self.channels)
+        missing = [label for label in labels if label not in channels]
+        if missing:
+            raise KeyError("Unknown channel labels: " + ", ".join(missing))
+        return [channels[label] for label in labels]
 
     def addEvent(self, event_data):
         self.events.append(event_data)
 
+    def eventsBetween(self, start, end):
+        """Returns the events from time start to end (see EventStore.eventsBetween)."""
+        return self.events.eventsBetween(start, end)
+
+    def eventsOfType(self, name, start=None, end=None):
+        """Returns the events with the given name (see EventStore.eventsOfType)."""
+        return self.events.eventsOfType(name, start, end)
+
     def updateHash(self):
-        self.hash_me("-".join(child.objectHash for child in self.channels))
+        if self._channels is not None:
+            self.objectHash = self.computeHash()
+
+    def computeHash(self):
+        return MerkleHasher.Default.combine(self.uniqueID, [child.objectHash for child in self.channels])
+
+    def childNodes(self):
+        return self.channels
+
+    def catalogNode(self):
+        node = super(Session, self).catalogNode()
+        if self._events is None and self.catalog is not None:
+            node["event-count"] = self.catalog.get("event-count", 0)
+        else:
+            node["event-count"] = len(self.events)
+        return node
+
+    def catalogChildren(self):
+        if self._channels is None and self.catalog is not None:
+            return self.catalog["children"]
+        return [channel.catalogNode() for channel in self.channels]
 
     def defaultMetadataValues(self):
         """Fills the minimum neccesary metadata values."""
@@ -173,37 +397,18 @@ class Session(BaseFile):
 
     @property
     def pathname(self):
-        return self.subject.pathname + ["SESSION-" + self.uniqueID]
+        return self.subject.pathname + [self.Prefix + self.uniqueID]
 
     @property
     def archiver(self):
         return self.subject.archiver
 
-class SessionEvent(object):
-    """docstring for SessionEvent"""
-    def __init__(self, time=0, event_name="Unknown", description=""):
-        super(SessionEvent, self).__init__()
-        self.time = time
-        self.event_name = event_name
-        self.description = description
-
-    def asDict(self):
-        return {"time": self.time, "event_name": self.event_name, "description": self.description}
-
-    @classmethod
-    def toJson(cls, event_list):
-        return [o.asDict() for o in event_list]
-
-    @classmethod
-    def fromJson(cls, event_json_list):
-        return [SessionEvent(*o) for o in event_json_list]
-
-
-
-
 class Channel(BaseFile):
     DataFileName = "data"
+    Prefix = "CHANNEL-"
     SegmentMaxLength = 512*60*3
+    DataType = "float64"
+    Codec = "none"
     """Represents a session experiment of a subject in the sense of BIF.
     Why use uniqueID instead of channel name as a ID reference?
     Because in some experiments, the experimenter could have more than one data
@@ -215,29 +420,116 @@ class Channel(BaseFile):
         super(Channel, self).__init__(metadata)
         self.session = None
         self.data = None
+        self._pyramid = None
+
+    def setData(self, data, dtype=None, scale=1.0, codec=None):
+        """Stores the samples, encoded as dtype values of the given scale (see SegmentEncoder).
+        data is a list-compatible object, or an iterator of chunks of samples.
+        The codec defaults to the "codec" metadata value, or Channel.Codec (see CodecRegistry)."""
+        self.prepareData(dtype, scale, codec)
+        self.data.set(data)
+
+    def openWriter(self, dtype=None, scale=1.0, codec=None):
+        """Returns a writer which stores the samples chunk by chunk (see SegmentedDataWriter)."""
+        self.prepareData(dtype, scale, codec)
+        return self.data.openWriter()
 
-    def setData(self, data):
+    def prepareData(self, dtype=None, scale=1.0, codec=None):
         if self.data is None:
             self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
-        self.data.set(data)
+            self.data.index = SegmentIndex(self.SegmentMaxLength) #A new channel has nothing to replace
+        self.data.dtype = dtype or self.DataType
+        self.data.scale = scale
+        self.data.codec = codec or self.metadata.get("codec") or self.Codec
+        self.metadata["codec"] = self.data.codec
+        self.markDirty()
+        return self.data
 
     def getData(self, start = 0, end = None):
         if self.data is None:
             self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
         return self.data.get(start, end)
 
+    def readInto(self, target, start = 0):
+        """Copies samples from start into target (see SegmentedData.readInto)."""
+        if self.data is None:
+            self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
+        return self.data.readInto(target, start)
+
+    @property
+    def data_length(self):
+        if self.data is None:
+            self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
+        return self.data.data_length
+
+    def take(self, positions, fill = np.nan):
+        """Returns the samples at an array of positions (see SegmentedData.take)."""
+        if self.data is None:
+            self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
+        return self.data.take(positions, fill)
+
+    def agetData(self, start = 0, end = None, reader = None):
+        """Returns a ReadFuture of the samples, read without blocking the caller (see SegmentedData.aget)."""
+        if self.data is None:
+            self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
+        return self.data.aget(start, end, reader)
+
+    def setOpened(self):
+        """Wires the stored samples, without reading them."""
+        self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName], codec=self.metadata.get("codec"))
+        self.data.objectHash = self.objectHash
+
+    def catalogNode(self):
+        """Adds the sample count, sampling rate and segment count, to plan reads without opening the
+        channel. The segment index stays in its own member, which is read when the samples are."""
+        node = super(Channel, self).catalogNode()
+        node["sampling-rate"] = self.metadata.get("sampling-rate", 0)
+        if self.data is not None and self.data.index is None and self.catalog is not None:
+            for key in ["length", "segment-count"]:
+                if key in self.catalog:
+                    node[key] = self.catalog[key]
+        elif self.data is not None:
+            index = self.data.getIndex()
+            node["length"] = index.length
+            node["segment-count"] = len(index.segments)
+        return node
+
     def write(self):
-        """Write the content inside the archive provide."""
-        super(Channel, self).write()
-        self.writeMetadata()
+        """Write the content inside the archive provide. The samples are written by setData.
+        Returns the number of written archive members."""
+        return super(Channel, self).write()
+
+    @property
+    def pyramid(self):
+        """Min/max/mean decimation of the samples, for zoomed-out views (see DecimationPyramid)."""
+        if self._pyramid is None:
+            self._pyramid = DecimationPyramid(self)
+        return self._pyramid
 
     def remove(self):
         """Removes the content inside the archive provide."""
-        super(Channel, self).remove()
-        self.writeMetadata()
+        if self.isStored():
+            super(Channel, self).remove()
+        AdditionalData.removeDerived(self)
+        if self.data is None:
+            self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
+        self.data.remove()
+
+    def setSegment(self, i, data):
+        """Replaces the samples of segment i, keeping their count (see SegmentedData.setSegment)."""
+        if self.data is None:
+            self.data = SegmentedData(self.SegmentMaxLength, self, self.pathname + [self.DataFileName])
+        self.data.setSegment(i, data)
+        self.markDirty()
 
     def updateHash(self):
-        self.objectHash = self.data.objectHash
+        if self.data is not None:
+            self.objectHash = self.data.objectHash
+
+    def computeHash(self):
+        if self.data is None:
+            return self.objectHash
+        return self.data.computeHash()
 
     def defaultMetadataValues(self):
         """Fills the minimum neccesary metadata values."""
@@ -256,4 +548,4 @@ class Channel(BaseFile):
 
     @property
     def pathname(self):
-        return self.session.pathname + ["CHANNEL-" + self.uniqueID]
+        return self.session.pathname + [self.Prefix + self.uniqueID]
@@ -1,5 +1,14 @@
 #!/usr/bin/python
+import os
+import sys
+import shutil
+import hashlib
 import unittest
+import threading
+import subprocess
+import zipfile
+import numpy as np
+import ujson as json
 from biosignalformat import *
 
 class TestBaseObjects(unittest.TestCase):
@@ -74,12 +83,906 @@ class TestBaseObjects(unittest.TestCase):
         self.assertEqual(metadata["name"], "Exp!")
         self.assertEqual(metadata["description"], "blah!")
 
+    def test_MinimalStructureZipFile(self):
+        provider = ZipFileArchiveProvider("experiment003.zip")
+        experiment = Experiment({
+            "name": "Exp!",
+            "description": "blah!"
+        })
+        experiment.setArchiver(provider)
+        subject = Subject({
+            "name": "Subject001",
+            "description": "description-subject!"
+        })
+        experiment.addSubject(subject)
+        session = Session({
+            "name": "Subject001-Session001",
+            "description": "description-subject-session!"
+        })
+        subject.addSession(session)
+        channel = Channel({
+            "name": "AF8"
+        })
+        session.addChannel(channel)
+        channel.setData([c/1e-12 for c in range(500000)])
+        experiment.write()
+        metadata = experiment.readMetadata()
+        self.assertEqual(metadata["name"], "Exp!")
+        self.assertEqual(metadata["description"], "blah!")
+
+    def test_ZipFileReplaceAndRemove(self):
+        provider = ZipFileArchiveProvider("experiment004.zip")
+        provider.add(["a", "b"], "first")
+        provider.add(["a", "b"], "second")
+        provider.add(["c"], "other")
+        provider.remove(["c"])
+        provider.force_write()
+        self.assertEqual(provider.read(["a", "b"]), "second")
+        with self.assertRaises(KeyError):
+            provider.read(["c"])
+        provider.close()
+
+    def test_ZipFileRemoveOnly(self):
+        if os.path.exists("experiment025.zip"):
+            os.remove("experiment025.zip")
+        provider = ZipFileArchiveProvider("experiment025.zip")
+        for i in range(20):
+            provider.add(["d", "member-%d" % i], "x"*10)
+        provider.close()
+        provider = ZipFileArchiveProvider("experiment025.zip")
+        for i in range(15):
+            provider.remove(["d", "member-%d" % i])
+        provider.close()
+        with zipfile.ZipFile("experiment025.zip") as archive:
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(sorted(archive.namelist()), ["d/member-%d" % i for i in range(15, 20)])
+
+    def test_ZipFileInterrupted(self):
+        if os.path.exists("experiment030.zip"):
+            os.remove("experiment030.zip")
+        provider = ZipFileArchiveProvider("experiment030.zip")
+        provider.add(["a"], "first")
+        provider.add(["b"], os.urandom(1000))
+        provider.close()
+        script = "import os\nfrom biosignalformat import *\nprovider = ZipFileArchiveProvider('experiment030.zip')\n" \
+            "provider.add(['c'], os.urandom(100000))\nprovider.remove(['a'])\nos._exit(0)\n"
+        subprocess.check_call([sys.executable, "-c", script])
+        self.assertFalse(zipfile.is_zipfile("experiment030.zip"))
+        provider = ZipFileArchiveProvider("experiment030.zip")
+        self.assertEqual(sorted(provider.list()), ["a", "b"])
+        self.assertEqual(provider.read(["a"]), "first")
+        provider.add(["b"], "replaced")
+        provider.close()
+        with zipfile.ZipFile("experiment030.zip") as archive:
+            self.assertEqual(archive.testzip(), None)
+            self.assertEqual(archive.read("b"), "replaced")
+        provider = ZipFileArchiveProvider("experiment030.zip")
+        self.assertTrue(provider.garbage() > 1000)
+        provider.force_write()
+        self.assertTrue(provider.garbage() < 100)
+        self.assertEqual([provider.read([name]) for name in ["a", "b"]], ["first", "replaced"])
+        provider.close()
+
+    def test_IncrementalWrite(self):
+        provider = ZipFileArchiveProvider("experiment011.zip")
+        channel = create_channel(provider)
+        session = channel.session
+        experiment = session.subject.experiment
+        self.assertEqual(experiment.write(), 7)
+        self.assertEqual(experiment.write(), 0)
+        channel.metadata["label"] = "AF8"
+        self.assertEqual(experiment.write(), 2)
+        other = Session()
+        session.subject.addSession(other)
+        self.assertEqual(experiment.write(), 5)
+        channel.setData([1.0, 2.0])
+        self.assertEqual(experiment.write(), 6)
+        segment = channel.data.segmentName(0)
+        session.removeChannel(channel)
+        self.assertEqual(experiment.write(), 5)
+        self.assertFalse("/".join(segment) in provider.list())
+        provider.close()
+
+    def test_RemoveUnwritten(self):
+        if os.path.exists("experiment026.zip"):
+            os.remove("experiment026.zip")
+        provider = ZipFileArchiveProvider("experiment026.zip")
+        channel = create_channel(provider)
+        session = channel.session
+        experiment = session.subject.experiment
+        experiment.write()
+        members = sorted(provider.list())
+        added = Channel()
+        session.addChannel(added)
+        added.setData([1.0, 2.0])
+        session.removeChannel(added)
+        other = Session()
+        session.subject.addSession(other)
+        other.addChannel(Channel())
+        other.channels[0].setData([3.0])
+        other.addEvent(SessionEvent(time=1, event_name="Start"))
+        session.subject.removeSession(other)
+        experiment.write()
+        self.assertEqual(sorted(provider.list()), members)
+        provider.close()
+
+    def test_StagedFlush(self):
+        if os.path.exists("experiment016.7z"):
+            os.remove("experiment016.7z")
+        provider = XArchiveProvider("experiment016.7z")
+        provider.FlushSize = 1000
+        for i in range(30):
+            provider.add(["d", "f%d" % i], "x"*100)
+            self.assertTrue(provider.stagedSize <= 1000)
+        provider.add(["d", "f1"], "changed")
+        self.assertEqual(provider.read(["d", "f1"]), "changed")
+        self.assertEqual(provider.read(["d", "f29"]), "x"*100)
+        provider.force_write()
+        self.assertEqual(provider.flusher, None)
+        self.assertEqual(len(provider.list()), 30)
+        self.assertEqual(provider.read(["d", "f1"]), "changed")
+
+    def test_FailedFlush(self):
+        if os.path.exists("experiment028.7z"):
+            os.remove("experiment028.7z")
+        provider = XArchiveProvider("experiment028.7z")
+        sevenzip = provider.sevenzip
+        provider.sevenzip = local_cmd["false"]
+        provider.add(["d", "first"], "1")
+        with self.assertRaises(Exception):
+            provider.force_write()
+        provider.add(["d", "second"], "2")
+        provider.add(["d", "third"], "3")
+        provider.remove(["d", "third"])
+        self.assertEqual(provider.read(["d", "first"]), "1")
+        provider.sevenzip = sevenzip
+        provider.force_write()
+        self.assertFalse(os.path.exists(provider.flushingdirname))
+        self.assertEqual(sorted(provider.list()), ["d/first", "d/second"])
+
+    def test_OpenExperiment(self):
+        if os.path.exists("experiment012.zip"):
+            os.remove("experiment012.zip")
+        provider = ZipFileArchiveProvider("experiment012.zip")
+        channel = create_channel(provider)
+        channel.session.subject.metadata["name"] = "S01"
+        channel.session.addEvent(SessionEvent(time=3, event_name="Start"))
+        experiment = channel.session.subject.experiment
+        experiment.write()
+        provider.close()
+        provider = ZipFileArchiveProvider("experiment012.zip")
+        opened = Experiment.open(provider)
+        self.assertEqual(opened.uniqueID, experiment.uniqueID)
+        self.assertEqual(opened._subjects, None)
+        subject = opened.subjects[0]
+        self.assertEqual(subject.metadata["name"], "S01")
+        session = subject.sessions[0]
+        self.assertEqual(session.events[0].event_name, "Start")
+        reopened = session.channels[0]
+        self.assertEqual(reopened.uniqueID, channel.uniqueID)
+        self.assertEqual(reopened.data_length, 35)
+        self.assertEqual(list(reopened.getData(5, 12)), [float(c) for c in range(5, 13)])
+        self.assertEqual(opened.write(), 0)
+        provider.close()
+
+    def test_Catalog(self):
+        if os.path.exists("experiment013.zip"):
+            os.remove("experiment013.zip")
+        provider = ZipFileArchiveProvider("experiment013.zip")
+        channel = create_channel(provider)
+        channel.metadata["sampling-rate"] = 256
+        channel.session.subject.experiment.write()
+        provider.close()
+        provider = ZipFileArchiveProvider("experiment013.zip")
+        reads = []
+        read = provider.read
+        provider.read = lambda filename: reads.append(filename) or read(filename)
+        opened = Experiment.open(provider)
+        reopened = opened.subjects[0].sessions[0].channels[0]
+        self.assertEqual(reopened.metadata["sampling-rate"], 256)
+        reopened.session.metadata["name"] = "S01"
+        self.assertEqual(opened.write(), 2)
+        self.assertEqual(reads, [[Catalog.FileName]])
+        self.assertEqual(reopened.data.getIndex().locate(12, 21), [(1, 2, 9), (2, 0, 1)])
+        self.assertEqual(reads, [[Catalog.FileName], reopened.data.file_name + [SegmentedData.IndexFileName]])
+        provider.remove([Catalog.FileName])
+        provider.force_write()
+        self.assertEqual(Catalog.read(provider), None)
+        self.assertEqual(Experiment.rebuildCatalog(provider).write(), 0)
+        node = Catalog.read(provider).root["children"][0]["children"][0]["children"][0]
+        self.assertEqual((node["length"], node["segment-count"], node["sampling-rate"]), (35, 4, 256))
+        self.assertFalse("index" in node)
+        provider.close()
+
+
+class TestEncoding(unittest.TestCase):
+    def test_float_roundtrip(self):
+        data = [c/1e-12 for c in range(1000)]
+        strdata = SegmentEncoder.encode(data, "float64")
+        self.assertTrue(SegmentEncoder.isBinary(strdata))
+        self.assertEqual(list(SegmentEncoder.decode(strdata)), data)
+
+    def test_scaled_integer_roundtrip(self):
+        data = [c*0.5e-6 for c in range(-1000, 1000)]
+        strdata = SegmentEncoder.encode(data, "int16", 0.5e-6)
+        self.assertEqual(len(strdata), SegmentEncoder.Header.size + 2*len(data))
+        for original, decoded in zip(data, SegmentEncoder.decode(strdata)):
+            self.assertAlmostEqual(original, decoded)
+
+    def test_codecs(self):
+        data = np.cumsum(np.sin(np.arange(5000)/100.0))
+        plain = SegmentEncoder.encode(data)
+        for codec in ["zlib", "bz2:1", "shuffle+zlib:1", "delta-shuffle+zlib", "delta-shuffle+bz2"]:
+            strdata = SegmentEncoder.encode(data, codec=codec)
+            self.assertEqual(list(SegmentEncoder.decode(strdata)), list(data))
+            self.assertEqual(SegmentEncoder.uncompress(strdata), plain)
+            self.assertTrue(len(strdata) < len(plain))
+        integers = SegmentEncoder.encode(data, "int16", 0.01, "delta-shuffle+zlib")
+        self.assertEqual(list(SegmentEncoder.decode(integers)), list(SegmentEncoder.decode(SegmentEncoder.encode(data, "int16", 0.01))))
+        with self.assertRaises(Exception):
+            SegmentEncoder.encode(data, codec="unknown")
+
+    def test_json_segment(self):
+        self.assertEqual(list(SegmentEncoder.decode(json.dumps([1.5, 2.5]))), [1.5, 2.5])
+
+
+def create_channel(provider, data=None, segment_size=10, addressed=None):
+    """Creates a minimal experiment with a single channel, using small segments."""
+    experiment = Experiment()
+    experiment.setArchiver(provider)
+    subject = Subject()
+    experiment.addSubject(subject)
+    session = Session()
+    subject.addSession(session)
+    return add_channel(session, [float(c) for c in range(35)] if data is None else data, segment_size, addressed=addressed)
+
+def add_channel(session, data, segment_size=10, metadata=None, addressed=None):
+    """Adds a channel with the given samples to a session, using small segments."""
+    channel = Channel(metadata)
+    session.addChannel(channel)
+    channel.data = SegmentedData(segment_size, channel, channel.pathname + [channel.DataFileName], addressed=addressed)
+    channel.setData(data)
+    return channel
+
+def remove_channel(channel):
+    """Removes a channel and writes its experiment. Returns the names of the derived data left in the archive."""
+    session = channel.session
+    session.removeChannel(channel)
+    session.subject.experiment.write()
+    return [name for name in channel.archiver.list() if AdditionalData.Preffix in name]
+
+
+class TestMappedReads(unittest.TestCase):
+
+    def test_stored_members_are_views(self):
+        provider = ZipFileArchiveProvider("experiment005.zip", zipfile.ZIP_STORED)
+        channel = create_channel(provider)
+        views = channel.data.getViews(0, 25)
+        self.assertEqual(list(np.concatenate(views)), [float(c) for c in range(26)])
+        for view in views:
+            self.assertFalse(view.flags.writeable)
+        provider.close()
+
+    def test_sidecar_cache(self):
+        shutil.rmtree("experiment006.zip.cache", ignore_errors=True)
+        provider = ZipFileArchiveProvider("experiment006.zip")
+        self.assertFalse(SegmentMapper.Default.sidecar)
+        channel = create_channel(provider, addressed=False)
+        channel.data.mapper = SegmentMapper(sidecar=True)
+        channel.data.cache = SegmentCache(1)
+        self.assertEqual(list(channel.getData(3, 7)), [3.0, 4.0, 5.0, 6.0, 7.0])
+        path = channel.data.mapper.sidecarPath(provider, channel.data.segmentName(0))
+        self.assertTrue(os.path.exists(path))
+        channel.setData([0.0] * 35)
+        self.assertEqual(list(channel.getData(3, 7)), [0.0] * 5)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(len(os.listdir("experiment006.zip.cache")), 1)
+        shutil.rmtree("experiment006.zip.cache")
+        with open("experiment006.zip.cache", "w") as f:
+            f.write("not a directory")
+        self.assertEqual(list(channel.getData(3, 7)), [0.0] * 5)
+        os.remove("experiment006.zip.cache")
+        provider.close()
+
+
+class TestSegmentIndex(unittest.TestCase):
+    def test_partial_segments(self):
+        provider = ZipFileArchiveProvider("experiment007.zip")
+        channel = create_channel(provider)
+        self.assertEqual(len(channel.data.index.segments), 4)
+        self.assertEqual(list(channel.getData(8, 31)), [float(c) for c in range(8, 32)])
+        self.assertEqual(list(channel.getData(30)), [float(c) for c in range(30, 35)])
+        self.assertEqual(list(channel.getData(34, 100)), [34.0])
+        provider.close()
+
+    def test_reopened_channel(self):
+        provider = ZipFileArchiveProvider("experiment008.zip")
+        channel = create_channel(provider, addressed=False)
+        reopened = SegmentedData(10, channel, channel.pathname + [channel.DataFileName])
+        self.assertEqual(reopened.data_length, 35)
+        self.assertEqual(list(reopened.get(9, 10)), [9.0, 10.0])
+        provider.remove(channel.pathname + [channel.DataFileName, SegmentedData.IndexFileName])
+        legacy = SegmentedData(10, channel, channel.pathname + [channel.DataFileName])
+        self.assertEqual(legacy.data_length, 35)
+        self.assertEqual(legacy.index.segments, channel.data.index.segments)
+        read = provider.read
+        def read_or_empty(filename): #Like 7za, which prints nothing for a missing member
+            try:
+                return read(filename)
+            except KeyError:
+                return ""
+        provider.read = read_or_empty
+        self.assertEqual(SegmentedData(10, channel, channel.pathname + [channel.DataFileName]).data_length, 35)
+        provider.close()
+
+
+class TestSegmentStore(unittest.TestCase):
+    def test_shared_segments(self):
+        if os.path.exists("experiment015.zip"):
+            os.remove("experiment015.zip")
+        provider = ZipFileArchiveProvider("experiment015.zip")
+        channel = create_channel(provider, [0.0]*30)
+        session = channel.session
+        experiment = session.subject.experiment
+        copies = []
+        for i in range(2):
+            copy = Session()
+            session.subject.addSession(copy)
+            copies.append(Channel())
+            copy.addChannel(copies[-1])
+            copies[-1].data = SegmentedData(10, copies[-1], copies[-1].pathname + [Channel.DataFileName])
+            copies[-1].setData([0.0]*30)
+        experiment.write()
+        store = SegmentStore.of(provider)
+        digest = channel.data.index.digests[0]
+        self.assertEqual(len(set(copies[0].data.index.digests + channel.data.index.digests)), 1)
+        self.assertEqual(store.references(digest), 9)
+        self.assertEqual(len([name for name in provider.list() if name.startswith(SegmentStore.DirName + "/")]), 2)
+        session.subject.removeSession(session)
+        copies[0].session.removeChannel(copies[0])
+        experiment.write()
+        self.assertEqual(store.references(digest), 3)
+        self.assertEqual(list(copies[1].getData(8, 9)), [0.0, 0.0])
+        copies[1].setData([1.0]*30)
+        experiment.write()
+        self.assertEqual(store.references(digest), 0)
+        self.assertFalse("/".join(store.path(digest)) in provider.list())
+        provider.close()
+        reopened = SegmentStore(ZipFileArchiveProvider("experiment015.zip"))
+        self.assertEqual(reopened.getCounts(), {copies[1].data.index.digests[0]: 3})
+        reopened.archiver.close()
+
+    def test_unwritten_counts(self):
+        if os.path.exists("experiment027.zip"):
+            os.remove("experiment027.zip")
+        provider = ZipFileArchiveProvider("experiment027.zip")
+        channel = create_channel(provider, [0.0]*10)
+        channel.session.subject.experiment.write()
+        add_channel(channel.session, [0.0]*10)
+        provider.close() #Without Experiment.write, as if the process was interrupted
+        provider = ZipFileArchiveProvider("experiment027.zip")
+        store = SegmentStore.of(provider)
+        digest = channel.data.index.digests[0]
+        self.assertEqual(store.references(digest), 2)
+        self.assertFalse(store.release("unknown"))
+        opened = Experiment.open(provider)
+        session = opened.subjects[0].sessions[0]
+        session.removeChannel(session.channels[0])
+        opened.write()
+        self.assertEqual(store.references(digest), 1)
+        self.assertFalse("/".join([SegmentStore.DirName, SegmentStore.PendingFileName]) in provider.list())
+        self.assertEqual(list(SegmentEncoder.decode(provider.read(store.path(digest)))), [0.0]*10)
+        provider.close()
+
+
+class TestBlockReads(unittest.TestCase):
+    def test_session_block(self):
+        provider = ZipFileArchiveProvider("experiment018.zip")
+        channel = create_channel(provider)
+        channel.metadata.update({"label": "A", "sampling-rate": 10, "time-offset": 0})
+        other = add_channel(channel.session, [-float(c) for c in range(20)], metadata={"label": "B", "sampling-rate": 10, "time-offset": 0.5})
+        session = channel.session
+        block = session.getData(["B", "A"], 8, 11)
+        self.assertEqual(block.shape, (2, 4))
+        self.assertEqual(block.tolist(), [[-8.0, -9.0, -10.0, -11.0], [8.0, 9.0, 10.0, 11.0]])
+        block = session.getData(start=1.8, end=2.1, unit="seconds")
+        self.assertEqual(block.tolist(), [[18.0, 19.0, 20.0, 21.0], [-13.0, -14.0, -15.0, -16.0]])
+        block = session.getData(start=0.3, end=0.6, unit="seconds")
+        self.assertEqual(block[0].tolist(), [3.0, 4.0, 5.0, 6.0])
+        self.assertTrue(np.isnan(block[1, :2]).all())
+        self.assertEqual(block[1, 2:].tolist(), [-0.0, -1.0])
+        self.assertEqual(session.getData(["B"], 15).shape, (1, 5))
+        with self.assertRaises(Exception):
+            session.getData(unit="minutes")
+        provider.close()
+
+
+class TestPyramid(unittest.TestCase):
+    def test_levels_and_invalidation(self):
+        if os.path.exists("experiment019.zip"):
+            os.remove("experiment019.zip")
+        provider = ZipFileArchiveProvider("experiment019.zip")
+        data = np.sin(np.arange(5000) / 50.0) * np.arange(5000)
+        channel = create_channel(provider, data, segment_size=1000)
+        pyramid = channel.pyramid
+        pyramid.TopBins = 16
+        size, first, block = pyramid.query(0, 4999, 100)
+        self.assertEqual((size, first, block.shape), (32, 0, (157, 3)))
+        self.assertEqual(pyramid.top, 9)
+        self.assertEqual(block[0].tolist(), [data[:32].min(), data[:32].max(), data[:32].mean()])
+        self.assertAlmostEqual(block[-1, 2], data[4992:].mean())
+        size, first, block = pyramid.query(1000, 4999, 1)
+        self.assertEqual((size, first, block.shape), (512, 512, (9, 3)))
+        self.assertEqual((block[:, 0].min(), block[:, 1].max()), (data[512:].min(), data[512:].max()))
+        size, first, block = pyramid.query(10, 19, 10)
+        self.assertEqual((size, first, block[:, 1].tolist()), (1, 10, data[10:20].tolist()))
+        channel.session.subject.experiment.write()
+        self.assertTrue(DecimationPyramid(channel).isValid())
+        channel.setData(-data)
+        self.assertFalse(DecimationPyramid(channel).isValid())
+        size, first, block = pyramid.query(0, 4999, 100)
+        self.assertEqual(block[0].tolist(), [-data[:32].max(), -data[:32].min(), -data[:32].mean()])
+        self.assertEqual(remove_channel(channel), [])
+        provider.close()
+
+
+FeatureCalls = []
+
+def feature_sum(samples, metadata, scale=1.0):
+    FeatureCalls.append(scale)
+    return {"sum": float(samples.sum()) * scale, "label": metadata.get("label")}
+
+def feature_cumsum(samples, metadata):
+    return np.cumsum(samples)
+
+
+class TestFeatures(unittest.TestCase):
+    def test_cached_features(self):
+        if os.path.exists("experiment020.zip"):
+            os.remove("experiment020.zip")
+        provider = ZipFileArchiveProvider("experiment020.zip")
+        registry = FeatureRegistry()
+        registry.register("sum", feature_sum)
+        registry.register("cumsum", feature_cumsum, segmented=True, segment_length=16)
+        channel = create_channel(provider)
+        channel.metadata["label"] = "A"
+        del FeatureCalls[:]
+        self.assertEqual(registry.get(channel, "sum", scale=2.0), {"sum": 1190.0, "label": "A"})
+        self.assertEqual(registry.get(channel, "sum", scale=2.0)["sum"], 1190.0)
+        self.assertEqual(registry.get(channel, "sum")["sum"], 595.0)
+        self.assertEqual(FeatureCalls, [2.0, 1.0])
+        self.assertEqual(list(registry.get(channel, "cumsum")[-2:]), [561.0, 595.0])
+        channel.session.subject.experiment.write()
+        provider.close()
+        provider = ZipFileArchiveProvider("experiment020.zip")
+        channel = Experiment.open(provider).subjects[0].sessions[0].channels[0]
+        self.assertEqual(registry.get(channel, "sum", scale=2.0)["sum"], 1190.0)
+        self.assertEqual(FeatureCalls, [2.0, 1.0])
+        channel.setData([1.0] * 10)
+        self.assertEqual(registry.get(channel, "sum", scale=2.0)["sum"], 20.0)
+        self.assertEqual(FeatureCalls, [2.0, 1.0, 2.0])
+        self.assertEqual(remove_channel(channel), [])
+        provider.close()
+
+    def test_batch(self):
+        provider = ZipFileArchiveProvider("experiment020B.zip")
+        registry = FeatureRegistry()
+        registry.register("cumsum", feature_cumsum, segmented=True)
+        channel = create_channel(provider)
+        channels = [channel] + [add_channel(channel.session, [float(i)] * 20) for i in range(1, 5)]
+        values = registry.compute(channels, "cumsum", workers=2, window=2)
+        self.assertEqual([v[-1] for v in values], [595.0, 20.0, 40.0, 60.0, 80.0])
+        del FeatureCalls[:]
+        registry.register("sum", feature_sum)
+        registry.compute(channels, "sum")
+        registry.compute(channels, "sum")
+        self.assertEqual(len(FeatureCalls), 5)
+        provider.close()
+
+    def test_typed_removal(self):
+        if os.path.exists("experiment029.zip"):
+            os.remove("experiment029.zip")
+        provider = ZipFileArchiveProvider("experiment029.zip")
+        channel = create_channel(provider, np.sin(np.arange(4000) / 10.0), segment_size=1000)
+        channel.metadata["sampling-rate"] = 100
+        registry = FeatureRegistry()
+        registry.register("sum", feature_sum)
+        registry.get(channel, "sum")
+        Spectrogram(channel, 64).getFrames(0, 1)
+        WelchPSD(channel, 64).getData()
+        WaveletDecomposition(channel, "haar", 2).update()
+        channel.pyramid.query(0, 3999, 10)
+        channel.session.subject.experiment.write()
+        provider.close()
+        provider = ZipFileArchiveProvider("experiment029.zip")
+        session = Experiment.open(provider).subjects[0].sessions[0]
+        kinds = session.channels[0].calculatedInformation.values()
+        self.assertEqual(sorted(kinds), ["dwt", "dwt", "dwt", "feature", "pyramid", "stft", "welch"])
+        self.assertEqual(remove_channel(session.channels[0]), [])
+        provider.close()
+
+
+class TestSpectral(unittest.TestCase):
+    def test_frame_stream(self):
+        data = np.arange(1000.0)
+        for window, step, block in [(10, 100, 250), (10, 3, 7), (64, 32, 50), (5, 40, 1)]:
+            stream = FrameStream(window, step)
+            frames = np.concatenate([stream.add(data[start:start + block]) for start in range(0, len(data), block)])
+            starts = range(0, len(data) - window + 1, step)
+            self.assertEqual(list(frames[:, 0]), starts)
+            self.assertTrue(np.array_equal(frames, [data[start:start + window] for start in starts]))
+
+    def test_streamed_spectra(self):
+        if os.path.exists("experiment021.zip"):
+            os.remove("experiment021.zip")
+        provider = ZipFileArchiveProvider("experiment021.zip")
+        t = np.arange(3000) / 100.0
+        data = np.sin(2 * np.pi * 12.5 * t) + 0.1 * np.cos(2 * np.pi * 30 * t) + 1.0
+        channel = create_channel(provider, data, segment_size=250)
+        channel.metadata["sampling-rate"] = 100
+        frames = np.array([data[i:i + 64] - data[i:i + 64].mean() for i in range(0, 3000 - 63, 24)])
+        taper = hann(64)
+        expected = np.abs(np.fft.rfft(frames * taper, axis=1)) ** 2 / (100 * (taper ** 2).sum())
+        expected[:, 1:32] *= 2
+        spectrogram = Spectrogram(channel, 64, 24)
+        spectrogram.BatchFrames = 7
+        self.assertEqual(spectrogram.frames, len(frames))
+        self.assertTrue(np.allclose(spectrogram.getFrames(), expected))
+        self.assertTrue(np.allclose(spectrogram.getFrames(10, 12), expected[10:13]))
+        self.assertTrue(np.allclose(WelchPSD(channel, 64, 24).getData(), expected.mean(axis=0)))
+        welch = WelchPSD(channel, 64)
+        psd = welch.getData()
+        self.assertEqual(welch.frequencies[psd.argmax()], 12.5)
+        self.assertEqual(len(psd), 33)
+        channel.session.subject.experiment.write()
+        self.assertTrue(np.allclose(WelchPSD(channel, 64).data.get(), psd))
+        self.assertFalse(Spectrogram(channel, 64, 24).isStale())
+        channel.setData(data[:1000])
+        self.assertTrue(Spectrogram(channel, 64, 24).isStale())
+        self.assertEqual(Spectrogram(channel, 64, 24).frames, (1000 - 64) // 24 + 1)
+        self.assertEqual(remove_channel(channel), [])
+        provider.close()
+
+
+class TestWavelet(unittest.TestCase):
+    def test_streamed_decomposition(self):
+        if os.path.exists("experiment022.zip"):
+            os.remove("experiment022.zip")
+        provider = ZipFileArchiveProvider("experiment022.zip")
+        data = np.sin(np.arange(1001) / 7.0) + np.arange(1001) % 13
+        channel = create_channel(provider, data, segment_size=97)
+        expected = self.whole_signal(data, "db4", 3)
+        decomposition = WaveletDecomposition(channel, "db4", 3)
+        self.assertEqual(decomposition.names, ["d1", "d2", "d3", "a3"])
+        for name, values in zip(decomposition.names, expected):
+            self.assertTrue(np.allclose(decomposition.getBand(name), values))
+        self.assertTrue(np.allclose(decomposition.getBand("d2", 400, 599), expected[1][100:150]))
+        self.assertFalse(WaveletDecomposition(channel, "db4", 3).isStale())
+        channel.session.subject.experiment.write()
+        channel.setData(data[:500])
+        self.assertTrue(decomposition.isStale())
+        self.assertEqual(len(decomposition.getBand("d1")), len(self.whole_signal(data[:500], "db4", 1)[0]))
+        self.assertEqual(remove_channel(channel), [])
+        provider.close()
+
+    def test_short_segments(self):
+        provider = ZipFileArchiveProvider("experiment022C.zip")
+        session = create_channel(provider).session
+        for length, segment_size in [(2000, 100), (200, 3), (40, 1)]:
+            data = np.sin(np.arange(length) / 5.0) + np.arange(length) % 11
+            channel = add_channel(session, data, segment_size)
+            decomposition = WaveletDecomposition(channel, "db4")
+            self.assertTrue(2 ** decomposition.levels > segment_size)
+            expected = self.whole_signal(data, "db4", decomposition.levels)
+            for name, values in zip(decomposition.names, expected):
+                band = decomposition.getBand(name)
+                self.assertEqual(len(band), len(values))
+                self.assertTrue(np.allclose(band, values))
+        provider.close()
+
+    @staticmethod
+    def whole_signal(data, wavelet, levels):
+        """Returns the details of each level and the last approximation of a whole-signal transform."""
+        low = np.array(WaveletDecomposition.Wavelets[wavelet])
+        high = low[::-1] * (-1) ** np.arange(1, len(low) + 1)
+        bands = []
+        for level in range(levels):
+            bands.append(np.convolve(data, high)[1::2])
+            data = np.convolve(data, low)[1::2]
+        return bands + [data]
+
+    def test_batch(self):
+        provider = ZipFileArchiveProvider("experiment022B.zip")
+        channel = create_channel(provider, np.arange(300.0), segment_size=50)
+        channels = [channel] + [add_channel(channel.session, np.cos(np.arange(100 * i) / float(i)), 40) for i in range(1, 4)]
+        parallel = WaveletDecomposition.computeMany(channels, "db2", 2, workers=2)
+        for channel, decomposition in zip(channels, parallel):
+            data = channel.getData()
+            self.assertFalse(decomposition.isStale())
+            self.assertTrue(np.allclose(decomposition.getBand("a2"), np.convolve(np.convolve(data, decomposition.low)[1::2], decomposition.low)[1::2]))
+        provider.close()
+
+
+class TestEventStore(unittest.TestCase):
+    def test_queries_and_storage(self):
+        if os.path.exists("experiment023.zip"):
+            os.remove("experiment023.zip")
+        provider = ZipFileArchiveProvider("experiment023.zip")
+        session = create_channel(provider).session
+        for i in range(1000):
+            session.addEvent(SessionEvent(time=(i * 37) % 1000 / 10.0, event_name="Spike" if i % 3 else "Stage", description="N%d" % (i % 4)))
+        self.assertEqual(len(session.events), 1000)
+        self.assertEqual([event.time for event in session.eventsBetween(10, 10.5)], [10.0, 10.1, 10.2, 10.3, 10.4, 10.5])
+        stages = session.eventsOfType("Stage", 0, 2)
+        self.assertEqual([event.time for event in stages], sorted((i * 37) % 1000 / 10.0 for i in range(0, 1000, 3) if (i * 37) % 1000 <= 20))
+        self.assertEqual(set(event.event_name for event in stages), set(["Stage"]))
+        self.assertEqual(len(session.events.timesOfType("Spike")), 666)
+        self.assertEqual(session.eventsOfType("Unknown"), [])
+        session.subject.experiment.write()
+        provider.close()
+        provider = ZipFileArchiveProvider("experiment023.zip")
+        opened = Experiment.open(provider).subjects[0].sessions[0]
+        self.assertEqual(opened.events.columns, None)
+        event = opened.eventsBetween(99.9, 100)[0]
+        self.assertEqual((event.time, event.event_name, event.description), (99.9, "Stage", "N3"))
+        self.assertEqual(opened.events[-1].time, 99.9)
+        opened.addEvent(SessionEvent(time=-1, event_name="Start"))
+        self.assertEqual(opened.events[0].event_name, "Start")
+        self.assertEqual(opened.subject.experiment.write(), 2)
+        provider.close()
+
+    def test_interleaved_appends(self):
+        session = create_channel(ZipFileArchiveProvider("experiment023C.zip")).session
+        for i in range(60):
+            session.addEvent(SessionEvent(time=(i * 7) % 10, event_name="E%d" % i))
+            self.assertEqual(len(session.eventsBetween(0, 9)), i + 1)
+        names = [event.event_name for event in session.events]
+        self.assertEqual([event.time for event in session.events], sorted((i * 7) % 10 for i in range(60)))
+        self.assertEqual(names, ["E%d" % i for i in sorted(range(60), key=lambda i: (i * 7) % 10)])
+
+    def test_legacy_events(self):
+        provider = ZipFileArchiveProvider("experiment023B.zip")
+        session = create_channel(provider).session
+        provider.add(session.pathname + [EventStore.LegacyFileName], json.dumps([{"time": 5, "event_name": "Start", "description": ""}]))
+        session.events = EventStore(session, stored=True)
+        self.assertEqual([(event.time, event.event_name) for event in session.events], [(5, "Start")])
+        session.subject.experiment.write()
+        self.assertFalse("/".join(session.pathname + [EventStore.LegacyFileName]) in provider.list())
+        self.assertEqual(EventStore(session, stored=True).eventsOfType("Start")[0].time, 5)
+        provider.close()
+
+
+class TestEpochs(unittest.TestCase):
+    def test_epochs(self):
+        provider = ZipFileArchiveProvider("experiment024.zip")
+        channel = create_channel(provider, np.arange(400.0), segment_size=10)
+        channel.metadata.update({"label": "A", "sampling-rate": 100})
+        other = add_channel(channel.session, -np.arange(400.0), 7, {"label": "B", "sampling-rate": 100, "time-offset": 0.5})
+        session = channel.session
+        for time in [1.0, 2.5, 0.02, 3.95]:
+            session.addEvent(SessionEvent(time=time, event_name="Stim"))
+        session.addEvent(SessionEvent(time=2.0, event_name="Other"))
+        decoded = []
+        read = channel.data.readSegment
+        channel.data.readSegment = lambda i: decoded.append(i) or read(i)
+        epochs = session.epochs("Stim", -0.05, 0.1)
+        self.assertEqual(epochs.shape, (4, 2, 16))
+        self.assertEqual(sorted(decoded), sorted(set(decoded)))
+        self.assertEqual(list(epochs[0, 0, 3:]), list(np.arange(0.0, 13.0)))
+        self.assertTrue(np.isnan(epochs[0, 0, :3]).all() and np.isnan(epochs[0, 1]).all())
+        self.assertEqual(list(epochs[1, 0]), list(np.arange(95.0, 111.0)))
+        self.assertEqual(list(epochs[2, 0]), list(np.arange(245.0, 261.0)))
+        self.assertEqual(list(epochs[2, 1]), list(-np.arange(195.0, 211.0)))
+        self.assertTrue(np.isnan(epochs[3, 0, -6:]).all() and epochs[3, 0, -7] == 399)
+        corrected = session.epochs("Stim", -0.05, 0.1, labels=["B"], baseline=(None, 0))
+        self.assertEqual(corrected.shape, (4, 1, 16))
+        self.assertEqual(list(corrected[2, 0, :6]), [2.5, 1.5, 0.5, -0.5, -1.5, -2.5])
+        self.assertEqual(session.epochs("Missing", 0, 0.1).shape, (0, 2, 11))
+        provider.close()
+
+
+class TestAsyncReads(unittest.TestCase):
+    def test_shared_and_cancelled_reads(self):
+        reader = AsyncReader(concurrency=1)
+        gate = threading.Event()
+        first = reader.submit("first", gate.wait, 5)
+        second = reader.submit("second", lambda: 2)
+        self.assertTrue(reader.submit("second", lambda: 3) is second)
+        self.assertFalse(second.cancel())
+        self.assertTrue(second.cancel())
+        gate.set()
+        self.assertTrue(first.result(5))
+        self.assertTrue(second.cancelled())
+        with self.assertRaises(CancelledRead):
+            second.result()
+        self.assertEqual(reader.submit("second", lambda: 3).result(5), 3)
+
+    def test_channel_reads(self):
+        provider = ZipFileArchiveProvider("experiment017.zip")
+        channel = create_channel(provider)
+        channel.metadata["label"] = "A"
+        other = add_channel(channel.session, [-float(c) for c in range(35)], metadata={"label": "B"})
+        reader = AsyncReader(concurrency=3)
+        futures = [channel.agetData(start, start + 12, reader) for start in range(0, 20, 4)]
+        for start, future in zip(range(0, 20, 4), futures):
+            self.assertEqual(list(future.result(5)), [float(c) for c in range(start, start + 13)])
+        a, b = channel.session.agetMany(["A", "B"], 30, None, reader).result(5)
+        self.assertEqual((list(a), list(b)), ([30.0, 31.0, 32.0, 33.0, 34.0], [-30.0, -31.0, -32.0, -33.0, -34.0]))
+        with self.assertRaises(KeyError):
+            channel.session.agetMany(["C"])
+        self.assertEqual(AsyncArchiveProvider(provider, reader).read(channel.data.segmentName(0)).result(5),
+            provider.read(channel.data.segmentName(0)))
+        provider.close()
+
+
+class TestHashing(unittest.TestCase):
+    def test_digests(self):
+        strdatas = [SegmentEncoder.encode(range(c, c + 100)) for c in range(200)]
+        self.assertEqual(MerkleHasher(workers=4).digestMany(strdatas), MerkleHasher().digestMany(strdatas))
+        self.assertEqual(MerkleHasher().digest(strdatas[0]), hashlib.sha224(strdatas[0]).hexdigest())
+
+    def test_segment_update(self):
+        if os.path.exists("experiment014.zip"):
+            os.remove("experiment014.zip")
+        provider = ZipFileArchiveProvider("experiment014.zip")
+        channel = create_channel(provider)
+        session = channel.session
+        other = Session()
+        session.subject.addSession(other)
+        experiment = session.subject.experiment
+        experiment.write()
+        digests = channel.data.index.digests
+        hashes = [node.objectHash for node in [experiment, session.subject, session, channel, other]]
+        channel.setSegment(1, [-1.0]*10)
+        self.assertEqual(experiment.write(), 6)
+        self.assertEqual([a == b for a, b in zip(digests, channel.data.index.digests)], [True, False, True, True])
+        changed = [node.objectHash for node in [experiment, session.subject, session, channel, other]]
+        self.assertEqual([a == b for a, b in zip(hashes, changed)], [False, False, False, False, True])
+        self.assertEqual(list(channel.getData(9, 11)), [9.0, -1.0, -1.0])
+        self.assertEqual(MerkleHasher().verify(experiment), [])
+        with self.assertRaises(Exception):
+            channel.setSegment(3, [1.0])
+        provider.close()
+
+    def test_verify_and_diff(self):
+        for name in ["experiment014A.zip", "experiment014B.zip"]:
+            if os.path.exists(name):
+                os.remove(name)
+        provider = ZipFileArchiveProvider("experiment014A.zip")
+        channel = create_channel(provider)
+        channel.session.subject.experiment.write()
+        provider.close()
+        shutil.copy("experiment014A.zip", "experiment014B.zip")
+        original = Experiment.open(ZipFileArchiveProvider("experiment014A.zip"))
+        modified = Experiment.open(ZipFileArchiveProvider("experiment014B.zip"))
+        self.assertEqual(MerkleHasher().diff(original, modified), [])
+        modified.subjects[0].sessions[0].channels[0].setSegment(2, [0.0]*10)
+        modified.write()
+        self.assertEqual(MerkleHasher().diff(original, modified), [channel.data.segmentName(2)])
+        modified.archiver.add(channel.data.segmentName(0), SegmentEncoder.encode([0.0]*10))
+        self.assertEqual(MerkleHasher(workers=2).verify(modified), [channel.data.segmentName(0)])
+        original.archiver.close()
+        modified.archiver.close()
+
+
+class TestSegmentCache(unittest.TestCase):
+    def test_hits_and_invalidation(self):
+        provider = ZipFileArchiveProvider("experiment009.zip")
+        channel = create_channel(provider)
+        channel.data.cache = SegmentCache(budget=2*10*8)
+        channel.getData(0, 15)
+        channel.getData(5, 12)
+        self.assertEqual((channel.data.cache.hits, channel.data.cache.misses), (2, 2))
+        channel.getData(25, 25)
+        self.assertEqual(channel.data.cache.evictions, 1)
+        channel.setData([1.0] * 35)
+        self.assertEqual(len(channel.data.cache.entries), 0)
+        self.assertEqual(channel.data.cache.segments, {})
+        self.assertEqual(list(channel.getData(20, 21)), [1.0, 1.0])
+        cache = SegmentCache()
+        for contentHash in ["a", "b"]:
+            cache.put(cache.key(provider, ["x", "y"], contentHash), np.zeros(4))
+        cache.put(cache.key(provider, ["x", "z"], "a"), np.zeros(4))
+        cache.invalidate(provider, ["x", "y"])
+        self.assertEqual([key[1:] for key in cache.entries], [("x/z", "a")])
+        self.assertEqual(cache.size, 32)
+        provider.close()
+
+
+class TestStreamingWriter(unittest.TestCase):
+    def test_chunks(self):
+        provider = ZipFileArchiveProvider("experiment010.zip")
+        channel = create_channel(provider)
+        expected = channel.data.objectHash
+        with channel.openWriter() as writer:
+            writer.append([0.0, 1.0, 2.0])
+            writer.append(3.0)
+            for start in range(4, 35, 7):
+                writer.append([float(c) for c in range(start, min(start + 7, 35))])
+            self.assertTrue(len(writer.buffer) == 10 and writer.buffered < 10)
+        self.assertEqual(channel.data.objectHash, expected)
+        self.assertEqual(list(channel.getData()), [float(c) for c in range(35)])
+        channel.setData(iter([[1.0, 2.0], [3.0]]))
+        self.assertEqual(list(channel.getData()), [1.0, 2.0, 3.0])
+        channel.metadata["codec"] = "delta-shuffle+zlib"
+        channel.setData([float(c) for c in range(35)])
+        self.assertEqual(list(channel.getData()), [float(c) for c in range(35)])
+        provider.close()
+
+
+def write_edf(filename, signals, samples_per_record, bdf=False, annotations=[]):
+    """Writes a small EDF+ (or BDF+) file with the given digital signals and annotations."""
+    bytes_per_sample = 3 if bdf else 2
+    records = len(signals[0]) // samples_per_record
+    labels = ["C%d" % i for i in range(len(signals))] + ["EDF Annotations"]
+    tal_size = 60 // bytes_per_sample
+    field = lambda value, length: str(value).ljust(length)[:length]
+    header = ("\xffBIOSEMI" if bdf else field("0", 8)) + \
+        field("MCH-0234567 F 02-MAY-1951 Haagse_Harry", 80) + \
+        field("Startdate 02-MAR-2002 EMG561 BK/JOP Sony", 80) + \
+        "02.03.02" + "14.25.33" + field(256*(len(labels)+1), 8) + \
+        field("BDF+C" if bdf else "EDF+C", 44) + field(records, 8) + field(1, 8) + field(len(labels), 4)
+    digital = (-2**23, 2**23-1) if bdf else (-2**15, 2**15-1)
+    for values, length in [(labels, 16), (["uV"]*len(labels), 80), (["uV"]*len(labels), 8),
+            (["-100"]*len(labels), 8), (["100"]*len(labels), 8),
+            ([digital[0]]*len(labels), 8), ([digital[1]]*len(labels), 8), ([""]*len(labels), 80),
+            ([samples_per_record]*len(signals) + [tal_size], 8), ([""]*len(labels), 32)]:
+        header += "".join(field(value, length) for value in values)
+    records_data = []
+    for record in range(records):
+        data = ""
+        for signal in signals:
+            values = np.asarray(signal[record*samples_per_record:(record+1)*samples_per_record], dtype="<i4")
+            if bdf:
+                data += values.view(np.uint8).reshape(-1, 4)[:, :3].tostring()
+            else:
+                data += values.astype("<i2").tostring()
+        tal = "+%d\x14\x14\x00" % record + "".join("+%g\x15%g\x14%s\x14\x00" % annotation
+            for annotation in annotations if int(annotation[0]) == record)
+        data += tal.ljust(tal_size*bytes_per_sample, "\x00")
+        records_data.append(data)
+    with open(filename, "wb") as f:
+        f.write(header + "".join(records_data))
+
 
 class TestPlugins(unittest.TestCase):
     def test_plugins(self):
         from biosignalformat.external import sample
         self.assertEqual(sample.ConstantVariable, 12)
 
+class TestPluginManifest(unittest.TestCase):
+    def test_cached_manifest(self):
+        shutil.rmtree("plugins025", ignore_errors=True)
+        os.makedirs("plugins025/sample025")
+        with open("plugins025/sample025/__init__.py", "w") as f:
+            f.write("from helper import *\n")
+        with open("plugins025/sample025/helper.py", "w") as f:
+            f.write("ConstantVariable = 25\nclass SampleImporter(object):\n    pass\n")
+        with open("plugins025/order.json", "w") as f:
+            f.write(json.dumps(["sample025", "missing"]))
+        structure = PluginStructure("plugins025")
+        manifest = structure.get_manifest()
+        self.assertEqual(manifest["order"], ["sample025"])
+        self.assertEqual(manifest["plugins"]["sample025"]["exports"], ["SampleImporter"])
+        cached = PluginStructure("plugins025")
+        cached.build_manifest = None
+        self.assertEqual(cached.get_manifest(), manifest)
+        self.assertEqual(cached.search_plugin("missing"), None)
+        self.assertEqual(cached.search_plugin("sample025"), True)
+        self.assertEqual(cached.search_export("SampleImporter", autoload=True).ConstantVariable, 25)
+        stat = os.stat("plugins025/sample025/helper.py")
+        os.utime("plugins025/sample025/helper.py", (stat.st_atime, stat.st_mtime + 10))
+        self.assertFalse(cached.is_current(manifest))
+        manifest = PluginStructure("plugins025").get_manifest()
+        with open("plugins025/order.json", "w") as f:
+            f.write(json.dumps(["missing"]))
+        stat = os.stat("plugins025/order.json")
+        os.utime("plugins025/order.json", (stat.st_atime, stat.st_mtime + 10))
+        self.assertFalse(PluginStructure("plugins025").is_current(manifest))
+        self.assertEqual(PluginStructure("plugins025").get_manifest()["order"], [])
+        shutil.rmtree("plugins025")
+
+
 class TestConverters(unittest.TestCase):
     def test_single_edf(self):
         from biosignalformat.external import base_converter
@@ -87,6 +990,122 @@ class TestConverters(unittest.TestCase):
         importer = base_converter.EDFImporter("ExampleEDF.edf", XArchiveProvider("ExampleEDFAscii.bif.zip"))
         importer.convert()
 
+    def test_native_edf_reader(self):
+        from biosignalformat.external import base_converter
+        for bdf in [False, True]:
+            maximum = 2**23-1 if bdf else 2**15-1
+            signals = [[maximum, -maximum-1, 0, 1000, -1000, 7], [5, 4, 3, 2, 1, 0]]
+            write_edf("ExampleNative.edf", signals, 3, bdf, [(1.5, 0.5, "Stimulus")])
+            reader = base_converter.EDFReader("ExampleNative.edf")
+            self.assertEqual(reader.is_bdf, bdf)
+            self.assertEqual(reader.records, 2)
+            self.assertEqual(list(reader.read_digital(0)), signals[0])
+            self.assertEqual(list(reader.read_digital(1, 1)), signals[1][3:])
+            self.assertAlmostEqual(reader.read_physical(0)[0], 100.0)
+            self.assertAlmostEqual(reader.read_physical(0)[1], -100.0)
+            self.assertEqual(reader.read_annotations(), [(1.5, 0.5, "Stimulus")])
+            info = reader.as_json()
+            self.assertEqual(info["Patient"]["Gender"], "Female")
+            self.assertEqual(info["Patient"]["Age"], 50)
+            self.assertEqual(info["StartOfRecording"], "2002-03-02 14:25:33")
+            reader.close()
+
+    def test_native_edf_importer(self):
+        from biosignalformat.external import base_converter
+        write_edf("ExampleNative.edf", [range(0, 3000, 10), range(300)], 100, annotations=[(1.5, 0, "Stimulus")])
+        importer = base_converter.EDFImporter("ExampleNative.edf", ZipFileArchiveProvider("ExampleNative.bif.zip"))
+        importer.convert()
+        session = importer.subject.sessions[0]
+        self.assertEqual([channel.metadata["label"] for channel in session.channels], ["C0", "C1"])
+        self.assertEqual(session.channels[0].metadata["sampling-rate"], 100)
+        self.assertEqual(session.channels[0].metadata["unit"], "V")
+        self.assertEqual(len(session.channels[1].getData()), 300)
+        self.assertEqual([event.event_name for event in session.events], ["Stimulus"])
+
+    def test_parallel_channels(self):
+        from biosignalformat.external import base_converter
+        signals = [[(i*7 + c*13) % 2000 - 1000 for i in range(5000)] for c in range(4)]
+        write_edf("ExampleParallel.edf", signals, 250)
+        sessions = []
+        segment_length = Channel.SegmentMaxLength
+        Channel.SegmentMaxLength = 1200
+        try:
+            for workers in [1, 3]:
+                importer = base_converter.EDFImporter("ExampleParallel.edf", ZipFileArchiveProvider("ExampleParallel%d.bif.zip" % workers), workers=workers)
+                importer.convert()
+                sessions.append(importer.subject.sessions[0])
+        finally:
+            Channel.SegmentMaxLength = segment_length
+        for serial, parallel in zip(*[session.channels for session in sessions]):
+            self.assertEqual(serial.data.index.asDict(), parallel.data.index.asDict())
+            self.assertEqual(serial.data.objectHash, parallel.data.objectHash)
+        self.assertEqual(len(serial.data.index.segments), 5)
+        base_converter.parallel.encode_edf_segment("ExampleParallel.edf", 1, 0, 1200, 1.0, "float64", "none")
+        reader = base_converter.parallel.OpenReaders["ExampleParallel.edf"]
+        base_converter.parallel.encode_edf_segment("ExampleParallel.edf", 1, 1200, 1200, 1.0, "float64", "none")
+        self.assertTrue(base_converter.parallel.OpenReaders["ExampleParallel.edf"] is reader)
+        base_converter.parallel.close_edf_readers()
+
+    def test_ascii_segments(self):
+        from biosignalformat.external import base_converter
+        with open("ExampleChannel.a01", "w") as f:
+            f.write("".join("%d\n" % (i*(-1)**i) for i in range(25)))
+        offsets = base_converter.parallel.ascii_segment_offsets("ExampleChannel.a01", 10)
+        self.assertEqual(len(offsets), 3)
+        values = [SegmentEncoder.decode(base_converter.parallel.encode_ascii_segment("ExampleChannel.a01", offset, 0.5, 10, "float64", "none")[0][0])
+            for offset in offsets]
+        self.assertEqual([len(v) for v in values], [10, 10, 5])
+        chunks = base_converter.parallel.read_ascii_chunks("ExampleChannel.a01", 0.5, 7)
+        self.assertEqual(list(np.concatenate(values)), [value for chunk in chunks for value in chunk])
+
+    def test_batch_resume(self):
+        from biosignalformat.external import base_converter
+        shutil.rmtree("Batch", ignore_errors=True)
+        for path in ["Batch.bif.zip", "Batch.bif.zip.journal"]:
+            if os.path.exists(path):
+                os.remove(path)
+        for path in ["Batch/sub01/a.edf", "Batch/sub01/b.edf", "Batch/sub02/c.edf"]:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            write_edf(path, [range(300)], 100)
+        converter = base_converter.BatchConverter("Batch", "Batch.bif.zip")
+        self.assertEqual(converter.convert()["files"], 3)
+        self.assertEqual(len(open("Batch.bif.zip.journal").readlines()), 3)
+        write_edf("Batch/sub02/d.edf", [range(300)], 100)
+        resumed = base_converter.BatchConverter("Batch/*/*.edf", "Batch.bif.zip", workers=2)
+        self.assertEqual(resumed.convert()["files"], 1)
+        self.assertEqual(resumed.subjects[("Batch.bif.zip", "sub02")].uniqueID,
+            converter.subjects[("Batch.bif.zip", "sub02")].uniqueID)
+        with open("Batch/broken.bif.zip", "w") as f:
+            f.write("not an archive")
+        with self.assertRaises(Exception):
+            base_converter.BatchConverter("Batch/sub01/a.edf", "Batch/broken.bif.zip").convert()
+        self.assertEqual(open("Batch/broken.bif.zip").read(), "not an archive")
+
+    def test_batch_interrupted(self):
+        shutil.rmtree("BatchCrash", ignore_errors=True)
+        for path in ["BatchCrash.bif.zip", "BatchCrash.bif.zip.journal"]:
+            if os.path.exists(path):
+                os.remove(path)
+        os.makedirs("BatchCrash/sub01")
+        for name, samples in [("a", range(300)), ("b", range(600, 0, -1))]:
+            write_edf("BatchCrash/sub01/%s.edf" % name, [samples], 100)
+        script = "import os\nfrom biosignalformat import *\nfrom biosignalformat.external import base_converter\n" \
+            "class Interrupted(base_converter.BatchConverter):\n" \
+            "    def write_journal(self, *args):\n" \
+            "        base_converter.BatchConverter.write_journal(self, *args)\n" \
+            "        Experiment.write = lambda experiment: os._exit(1)\n" \
+            "Interrupted('BatchCrash', 'BatchCrash.bif.zip').convert()\n"
+        self.assertEqual(subprocess.call([sys.executable, "-c", script]), 1)
+        self.assertEqual(len(open("BatchCrash.bif.zip.journal").readlines()), 1)
+        self.assertTrue(os.path.exists("BatchCrash.bif.zip" + ZipFileArchiveProvider.PendingSuffix))
+        from biosignalformat.external import base_converter
+        self.assertEqual(base_converter.BatchConverter("BatchCrash", "BatchCrash.bif.zip").convert()["files"], 1)
+        provider = ZipFileArchiveProvider("BatchCrash.bif.zip")
+        sessions = Experiment.open(provider).subjects[0].sessions
+        self.assertEqual(sorted(len(session.channels[0].getData()) for session in sessions), [300, 600])
+        provider.close()
+
     def atest_multiple_edf(self):
         from biosignalformat.external import base_converter
         importer = base_converter.EDFImporter("ExampleEDF.edf", XZipArchiveProvider("ExampleMultipleEDFAscii.bif.7z"))
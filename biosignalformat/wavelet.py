@@ -0,0 +1,226 @@
+#!/usr/bin/python
+import math
+import collections
+import numpy as np
+from calculated import AdditionalData, SegmentedAdditionalData
+
+
+class WaveletLevel(object):
+    """One level of a WaveletCascade: the full convolution of its input with the low and high pass
+    filters, keeping the odd outputs (as a zero-padded whole-signal transform). The last samples of
+    each block are carried as the filter state of the next one."""
+    def __init__(self, low, high):
+        super(WaveletLevel, self).__init__()
+        self.low = low
+        self.high = high
+        self.state = np.zeros(len(low) - 1)
+        self.consumed = 0
+
+    def add(self, values):
+        """Returns the approximation and detail coefficients which the samples complete. Without
+        samples there are none: the valid convolution of the state alone would swap its operands."""
+        if not len(values):
+            return np.zeros(0), np.zeros(0)
+        extended = np.concatenate([self.state, values])
+        first = 1 - self.consumed % 2
+        approximation = np.convolve(extended, self.low, "valid")[first::2]
+        detail = np.convolve(extended, self.high, "valid")[first::2]
+        self.state = extended[len(extended) - len(self.state):]
+        self.consumed += len(values)
+        return approximation, detail
+
+    def finish(self):
+        return self.add(np.zeros(len(self.state)))
+
+
+class WaveletCascade(object):
+    """Discrete wavelet decomposition of a stream of sample blocks, where the approximation of each
+    level is the input of the next one. It holds only the filter state of each level, so it can be
+    sent to another process along with the next block (see WaveletDecomposition.computeMany)."""
+    def __init__(self, low, levels):
+        super(WaveletCascade, self).__init__()
+        low = np.asarray(low, dtype="float64")
+        high = low[::-1] * (-1) ** np.arange(1, len(low) + 1)
+        self.levels = [WaveletLevel(low, high) for level in range(levels)]
+
+    def add(self, values, final=False):
+        """Returns the coefficients which the samples complete, as a list with the details of each
+        level and the approximation of the last one. With final, the remaining ones are returned."""
+        bands = []
+        for level in self.levels:
+            approximation, detail = level.add(values)
+            if final:
+                tail = level.finish()
+                approximation, detail = np.concatenate([approximation, tail[0]]), np.concatenate([detail, tail[1]])
+            bands.append(detail)
+            values = approximation
+        return bands + [values]
+
+
+def cascade_block(cascade, values, final):
+    return cascade, cascade.add(values, final)
+
+
+class WaveletBand(SegmentedAdditionalData):
+    Type = "dwt"
+    """Band of a WaveletDecomposition: the details of a level, or the approximation of the last one."""
+    def __init__(self, parent, key, band):
+        super(WaveletBand, self).__init__(parent, "data", WaveletDecomposition.SegmentLength)
+        self.uniqueID = "%s-%s" % (key, band)
+        self.metadata = {"feature": "dwt", "band": band, "segmented": True}
+        self.data = self.createDataHandler()
+
+    def remove(self):
+        super(WaveletBand, self).remove()
+        self.data.remove()
+
+    @classmethod
+    def removeStored(cls, parent, key):
+        """Removes the band of uniqueID key, which is made of the key of its decomposition and its name."""
+        prefix, band = key.rsplit("-", 1)
+        cls(parent, prefix, band).remove()
+
+
+class WaveletDecomposition(object):
+    SegmentLength = 4096
+    Wavelets = {
+        "haar": [0.7071067811865476, 0.7071067811865476],
+        "db2": [-0.12940952255092145, 0.22414386804185735, 0.836516303737469, 0.48296291314469025],
+        "db4": [-0.010597401784997278, 0.032883011666982945, 0.030841381835986965, -0.18703481171888114,
+            -0.02798376941698385, 0.6308807679295904, 0.7148465705525415, 0.23037781330885523],
+    }
+    """Discrete wavelet transform of a channel, computed block by block over its segments with the
+    same result as a whole-signal transform with zero padding. The details of each level ("d1" to
+    "dN") and the approximation of the last one ("aN") are stored as separate WaveletBands under the
+    channel, so a band is read for a time range alone. They are calculated again when the channel
+    hash differs from their targetHash."""
+    def __init__(self, channel, wavelet="db4", levels=None):
+        super(WaveletDecomposition, self).__init__()
+        self.channel = channel
+        self.wavelet = wavelet
+        self.low = self.Wavelets[wavelet]
+        if levels is None:
+            levels = max(1, int(math.log(max(channel.data_length, 1) / float(len(self.low) - 1), 2)))
+        self.levels = levels
+        self.key = "dwt-%s-%d" % (wavelet, levels)
+
+    @property
+    def names(self):
+        return ["d%d" % level for level in range(1, self.levels + 1)] + ["a%d" % self.levels]
+
+    def band(self, name):
+        return WaveletBand(self.channel, self.key, name)
+
+    def getBand(self, name, start=0, end=None, unit="samples"):
+        """Returns the coefficients of a band which cover samples start..end of the channel (times with
+        unit="seconds", see Session.getData). Coefficient k of level j is near sample k * 2**j."""
+        self.update()
+        if unit == "seconds":
+            rate = self.channel.metadata.get("sampling-rate", 0)
+            offset = self.channel.metadata.get("time-offset", 0)
+            start = int(round((start - offset) * rate))
+            end = None if end is None else int(round((end - offset) * rate))
+        level = int(name[1:])
+        return self.band(name).data.get(max(start, 0) >> level, None if end is None else end >> level)
+
+    def isStale(self):
+        band = self.band(self.names[-1])
+        try:
+            band.readMetadata()
+        except Exception:
+            return True
+        return band.isStale()
+
+    def update(self):
+        """Calculates the bands unless they are up to date."""
+        if self.isStale():
+            bands, writers = self.openBands()
+            cascade = self.cascade()
+            for values, final in self.blocks():
+                cascade, coefficients = cascade_block(cascade, values, final)
+                self.append(writers, coefficients)
+            self.closeBands(bands, writers)
+
+    def cascade(self):
+        return WaveletCascade(self.low, self.levels)
+
+    def blocks(self):
+        """Yields the segments of the channel, and if each one is the last one."""
+        data = self.channel.data
+        count = len(data.getIndex().segments)
+        for i in range(count):
+            yield data.readSegment(i), i == count - 1
+
+    def openBands(self):
+        bands = [self.band(name) for name in self.names]
+        return bands, [band.data.openWriter() for band in bands]
+
+    def append(self, writers, coefficients):
+        for writer, values in zip(writers, coefficients):
+            writer.append(values)
+
+    def closeBands(self, bands, writers):
+        self.channel.updateHash()
+        for band, writer in zip(bands, writers):
+            writer.close()
+            band.targetHash = self.channel.objectHash
+            band.write()
+            self.channel.addCalculatedInformation(band.uniqueID, band.Type)
+
+    @classmethod
+    def computeMany(cls, channels, wavelet="db4", levels=None, workers=1):
+        """Calculates the stale decompositions of many channels. Returns their WaveletDecompositions.
+        With workers > 1, the channels are transformed in a process pool, up to workers at once and in
+        turns: each one has a block in flight, sent with the filter state of its cascade, and its
+        coefficients are written here as they arrive."""
+        decompositions = [cls(channel, wavelet, levels) for channel in channels]
+        stale = collections.deque(d for d in decompositions if d.isStale())
+        if workers <= 1:
+            for decomposition in stale:
+                decomposition.update()
+            return decompositions
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        try:
+            running = collections.deque()
+            while stale or running:
+                while stale and len(running) < workers:
+                    decomposition = stale.popleft()
+                    bands, writers = decomposition.openBands()
+                    blocks = decomposition.blocks()
+                    job = [decomposition, blocks, bands, writers]
+                    if cls.submit(pool, job, decomposition.cascade()):
+                        running.append(job)
+                    else:
+                        decomposition.closeBands(bands, writers)
+                if not running:
+                    continue
+                job = running.popleft()
+                decomposition, blocks, bands, writers, result = job
+                cascade, coefficients = result.get()
+                decomposition.append(writers, coefficients)
+                job = job[:4]
+                if cls.submit(pool, job, cascade):
+                    running.append(job)
+                else:
+                    decomposition.closeBands(bands, writers)
+        finally:
+            pool.terminate()
+            pool.join()
+        return decompositions
+
+    @staticmethod
+    def submit(pool, job, cascade):
+        """Sends the next block of a job to the pool. Returns False if there are no more blocks."""
+        for values, final in job[1]:
+            job.append(pool.apply_async(cascade_block, (cascade, values, final)))
+            return True
+        return False
+
+    def remove(self):
+        """Removes the stored bands."""
+        for name in self.names:
+            self.band(name).remove()
+            self.channel.calculatedInformation.pop(self.band(name).uniqueID, None)
+
+AdditionalData.registerType(WaveletBand)
@@ -0,0 +1,4 @@
+#!/usr/bin/python
+import sys
+from biosignalformat.external import base_converter
+base_converter.BatchConverter.main(sys.argv[1:])
@@ -1,2 +1,6 @@
 #!/usr/bin/python
 from biosig_importer import *
+from edf_reader import *
+from parallel import *
+from edf_importer import *
+from batch import *
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+import ujson as json
+from biosignalformat import *
+from biosig_importer import XDFImporter
+from edf_importer import NativeXDFImporter
+from parallel import WorkerPool
+
+
+class BatchConverter(object):
+    JournalSuffix = ".journal"
+    Importers = {".edf": NativeXDFImporter, ".bdf": NativeXDFImporter, ".gdf": XDFImporter}
+    """Converts many EDF/BDF/GDF files into one or more BIF experiments.
+    The destination is an archive name, where {subject} and {directory} are replaced for each file,
+    so files can be spread over several experiments. The subject of a file is given by subject_rule:
+    a regular expression searched in the file path (its first group, or the whole match, is the
+    subject name), or a function of the path. By default, it is the name of the file directory.
+    Every converted file is recorded in a journal, so an interrupted run can be started again
+    without converting the finished files, adding the new sessions to the same subjects. The default
+    archiver_class drops the unwritten part of an interrupted conversion when the archive is opened
+    again (see ZipFileArchiveProvider), so the file which was being converted starts over.
+    codec is the segment codec specification of the channels (see CodecRegistry)."""
+    def __init__(self, sources, destination, subject_rule=None, workers=1, journal=None, archiver_class=ZipFileArchiveProvider, codec=None):
+        super(BatchConverter, self).__init__()
+        self.sources = sources
+        self.destination = destination
+        self.subject_rule = subject_rule
+        self.workers = workers
+        self.journal = journal or destination.replace("{subject}", "").replace("{directory}", "") + self.JournalSuffix
+        self.archiver_class = archiver_class
+        self.codec = codec
+        self.experiments = {}
+        self.subjects = {}
+        self.finished = set()
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def source_files(self):
+        """Lists the files to convert, given a directory, a glob pattern or a list of them."""
+        sources = [self.sources] if isinstance(self.sources, basestring) else self.sources
+        files = []
+        for source in sources:
+            if os.path.isdir(source):
+                for dirpath, dirnames, filenames in os.walk(source):
+                    files += [os.path.join(dirpath, f) for f in filenames]
+            else:
+                files += glob.glob(source)
+        return sorted(f for f in files if os.path.splitext(f)[1].lower() in self.Importers)
+
+    def subject_name(self, path):
+        if self.subject_rule is None:
+            return os.path.basename(os.path.dirname(os.path.abspath(path)))
+        if callable(self.subject_rule):
+            return self.subject_rule(path)
+        match = re.search(self.subject_rule, path)
+        if not match:
+            return ""
+        return match.group(1) if match.groups() else match.group(0)
+
+    def archive_name(self, path, subject_name):
+        directory = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        return self.destination.replace("{subject}", subject_name).replace("{directory}", directory)
+
+    def read_journal(self):
+        """Recovers the finished files, and the experiments and subjects they were written to."""
+        if not os.path.exists(self.journal):
+            return
+        with open(self.journal, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue #An interrupted write of the last line
+                self.finished.add(entry["file"])
+                experiment = self.get_experiment(entry["archive"], entry["experiment"])
+                self.get_subject(experiment, entry["archive"], entry["subject-name"], entry["subject"])
+
+    def write_journal(self, path, archive_name, subject):
+        with open(self.journal, "a") as f:
+            f.write(json.dumps({
+                "file": path,
+                "archive": archive_name,
+                "experiment": subject.experiment.uniqueID,
+                "subject": subject.uniqueID,
+                "subject-name": subject.metadata["name"],
+            }) + "\n")
+
+    def get_experiment(self, archive_name, uniqueID=None):
+        """Opens the experiment of an archive, creating it if the archive does not exist yet. An
+        existing archive which cannot be opened raises its error, so it is never written over."""
+        if archive_name not in self.experiments:
+            exists = os.path.exists(archive_name)
+            archiver = self.archiver_class(archive_name)
+            if exists:
+                experiment = Experiment.open(archiver)
+            else:
+                experiment = Experiment()
+                experiment.metadata[".creator"] = "BiosignalFormat Tools - Batch Converter"
+                experiment.setArchiver(archiver)
+                if uniqueID is not None:
+                    experiment.uniqueID = uniqueID
+            self.experiments[archive_name] = experiment
+        return self.experiments[archive_name]
+
+    def get_subject(self, experiment, archive_name, subject_name, uniqueID=None):
+        """Finds a subject of the experiment by its name, creating it if it is not found."""
+        if (archive_name, subject_name) not in self.subjects:
+            found = [s for s in experiment.subjects if s.metadata.get("name") == subject_name]
+            if found:
+                subject = found[0]
+            else:
+                subject = Subject({"name": subject_name})
+                if uniqueID is not None:
+                    subject.uniqueID = uniqueID
+                experiment.addSubject(subject)
+            self.subjects[(archive_name, subject_name)] = subject
+        return self.subjects[(archive_name, subject_name)]
+
+    def convert(self):
+        """Converts the files which are not in the journal yet."""
+        self.read_journal()
+        pending = [path for path in self.source_files() if path not in self.finished]
+        with WorkerPool(self.workers) as pool:
+            for path in pending:
+                self.convert_file(path, pool)
+        return self.statistics
+
+    def convert_file(self, path, pool):
+        start = time.time()
+        subject_name = self.subject_name(path)
+        archive_name = self.archive_name(path, subject_name)
+        experiment = self.get_experiment(archive_name)
+        subject = self.get_subject(experiment, archive_name, subject_name)
+        importer_class = self.Importers[os.path.splitext(path)[1].lower()]
+        importer_class(path, experiment=experiment, subject=subject, pool=pool, codec=self.codec).convert()
+        self.write_journal(path, archive_name, subject)
+        self.finished.add(path)
+        self.files += 1
+        self.bytes += os.path.getsize(path)
+        self.seconds += time.time() - start
+        print "Converted", path, "->", archive_name, "(%.1f files/s, %.1f MB/s)" % (
+            self.statistics["files/s"], self.statistics["MB/s"])
+
+    @property
+    def statistics(self):
+        seconds = self.seconds or 1e-9
+        return {"files": self.files, "bytes": self.bytes, "seconds": self.seconds,
+            "files/s": self.files / seconds, "MB/s": self.bytes / seconds / 1024 / 1024}
+
+    @classmethod
+    def main(cls, argv=None):
+        """Command line entry point."""
+        parser = argparse.ArgumentParser(description="Converts EDF/BDF/GDF files into BIF experiments.")
+        parser.add_argument("sources", nargs="+", help="Directories or glob patterns of the files to convert.")
+        parser.add_argument("destination", help="Archive name. {subject} and {directory} are replaced for each file.")
+        parser.add_argument("--subject", default=None, help="Regular expression which extracts the subject name from a file path.")
+        parser.add_argument("--workers", type=int, default=1, help="Number of worker processes.")
+        parser.add_argument("--journal", default=None, help="Journal file, to resume interrupted conversions.")
+        parser.add_argument("--codec", default=None, help="Segment codec, e.g. zlib:1 (fast) or delta-shuffle+lzma:9 (small).")
+        args = parser.parse_args(argv)
+        converter = cls(args.sources, args.destination, args.subject, args.workers, args.journal, codec=args.codec)
+        statistics = converter.convert()
+        print "Converted %(files)d files (%(bytes)d bytes) in %(seconds).1f s: %(files/s).2f files/s, %(MB/s).2f MB/s" % statistics
+        return statistics
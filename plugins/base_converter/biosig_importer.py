@@ -8,8 +8,10 @@ import ujson as json
 from plumbum import local as local_cmd
 from biosignalformat import *
 import biosig_constant
+import parallel
 
 class BiosigCaller(object):
+    ChunkLength = 512*60
     """docstring for BiosigCaller"""
     def __init__(self, origin_file, archiver):
         super(BiosigCaller, self).__init__()
@@ -29,7 +31,7 @@ class BiosigCaller(object):
 
     def recognize_scale(self, unit):
         """Recognize a scale, and the unit from a scaled-unit. For example, for uV returns [1e-6, 'V']."""
-        if unit[0] in biosig_constant.unit_scales.keys():
+        if unit and unit[0] in biosig_constant.unit_scales.keys():
             return 10**biosig_constant.unit_scales[unit[0]], unit[1:]
         return 1, unit
 
@@ -45,6 +47,10 @@ class BiosigCaller(object):
         except:
             return default_value
 
+    def read_ascii_chunks(self, channel_name, scale):
+        """Reads a channel file generated by save2gdf, yielding chunks of scaled values."""
+        return parallel.read_ascii_chunks(channel_name, scale, self.ChunkLength)
+
     def execute_command(self):
         """Defines the command to execute with save2gdf."""
         if not os.path.exists(self.__dest_dirname):
@@ -91,13 +97,20 @@ class BiosigCaller(object):
 
 
 class XDFImporter(BiosigCaller):
-    """docstring for XDFImporter"""
-    def __init__(self, origin_file, archiver=None, experiment=None, subject=None):
+    """docstring for XDFImporter
+    With workers > 1, the channels are decoded, scaled and encoded in a process pool, while this
+    process stores the encoded segments in channel order. The archive does not depend on workers.
+    An existing parallel.WorkerPool can be shared through pool, instead of indicating workers.
+    codec is the segment codec specification of the channels (see CodecRegistry)."""
+    def __init__(self, origin_file, archiver=None, experiment=None, subject=None, workers=1, pool=None, codec=None):
         super(XDFImporter, self).__init__(origin_file, archiver)
         if archiver is None and experiment is None and subject is None:
             raise Exception("Must be indicate a destination file name for XDFImporter!")
         self.experiment = experiment
         self.subject = subject
+        self.pool = pool
+        self.workers = pool.workers if pool is not None else workers
+        self.codec = codec
 
     def create_file(self):
         if self.experiment is None and self.subject is not None:
@@ -141,32 +154,54 @@ class XDFImporter(BiosigCaller):
             session.addEvent(session_event)
 
     def _create_channel(self, session, json_data):
+        tasks = []
         for channel_info in json_data["CHANNEL"]:
             if "annotations" in channel_info["Label"].lower():
                 continue
             channel_id = "{0:02}".format(channel_info["ChannelNumber"])
             channel_name = self.channel_data_basename + ".a" + channel_id
-            channel_label = channel_info["Label"].upper().replace(".", "")
             scale, unit = self.recognize_scale(channel_info["PhysicalUnit"])
             #Unnecesary: #offset = self.get_number(channel_info, "offset", 0)
             scale *= self.get_number(channel_info, "scaling", 1)
             if not os.path.exists(channel_name):
-                print "Warning:", channel_name, "(", channel_label, ") cannot be processed!"
+                print "Warning:", channel_name, "(", channel_info["Label"], ") cannot be processed!"
                 continue
-            channel = Channel()
-            session.addChannel(channel)
-            channel.metadata["manufacturer"] = json_data["Manufacturer"].get("Name", "unknown")
-            channel.metadata["label"] = channel_label
-            channel.metadata["unit"] = unit
-            channel.metadata["time-offset"] = self.get_number(channel_info, "TimeDelay", 0)
-            channel.metadata["impedance"] = self.get_number(channel_info, "Impedance", 0)
-            channel.metadata["sampling-rate"] = self.get_number(channel_info, "Samplingrate", 0)
-            channel_data = [float(val.strip())*scale for val in open(channel_name, "r").readlines()]
-            channel.setData(channel_data)
-            del channel_data
-            channel_data = None
+            channel = self._add_channel(session, json_data, channel_info, unit)
+            if self.workers > 1:
+                data = channel.prepareData()
+                tasks.append((channel, [(parallel.encode_ascii_segment,
+                    (channel_name, offset, scale, channel.SegmentMaxLength, data.dtype, data.codec))
+                    for offset in parallel.ascii_segment_offsets(channel_name, channel.SegmentMaxLength)]))
+            else:
+                channel.setData(self.read_ascii_chunks(channel_name, scale))
+        self._store_channels(tasks)
+
+    def _store_channels(self, tasks):
+        """Runs the (channel, calls) tasks, which encode the segments of each channel (see parallel),
+        storing the segments in the order of the tasks."""
+        calls = [call for channel, calls in tasks for call in calls]
+        if self.pool is not None:
+            results = self.pool.map(calls)
+        else:
+            results = parallel.ordered_map(calls, self.workers)
+        for channel, calls in tasks:
+            with channel.openWriter() as writer:
+                for call in calls:
+                    for strdata, count, digest in next(results):
+                        writer.appendEncoded(strdata, count, digest)
+
+    def _add_channel(self, session, json_data, channel_info, unit):
+        channel = Channel()
+        session.addChannel(channel)
+        channel.metadata["manufacturer"] = json_data["Manufacturer"].get("Name", "unknown")
+        channel.metadata["label"] = channel_info["Label"].upper().replace(".", "")
+        channel.metadata["unit"] = unit
+        channel.metadata["time-offset"] = self.get_number(channel_info, "TimeDelay", 0)
+        channel.metadata["impedance"] = self.get_number(channel_info, "Impedance", 0)
+        channel.metadata["sampling-rate"] = self.get_number(channel_info, "Samplingrate", 0)
+        if self.codec is not None:
+            channel.metadata["codec"] = self.codec
+        return channel
 
 # Creating aliases:
-EDFImporter = XDFImporter
-EDFPlusImporter = XDFImporter
-BDFImporter = XDFImporter
+GDFImporter = XDFImporter
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+from biosignalformat import *
+from biosig_importer import XDFImporter
+from edf_reader import EDFReader
+import biosig_constant
+import parallel
+
+class NativeXDFImporter(XDFImporter):
+    """Imports EDF, EDF+ and BDF files with EDFReader, so neither save2gdf nor temporal files are needed.
+    It creates the same Experiment/Subject/Session/Channel tree than XDFImporter."""
+    def __init__(self, origin_file, archiver=None, experiment=None, subject=None, workers=1, pool=None, codec=None):
+        super(NativeXDFImporter, self).__init__(origin_file, archiver, experiment, subject, workers, pool, codec)
+        self.reader = None
+
+    def execute_command(self):
+        """Reads the headers and annotations of the file."""
+        self.reader = EDFReader(self.origin_file)
+        self.json_data = self.reader.as_json()
+
+    def convert(self):
+        try:
+            super(NativeXDFImporter, self).convert()
+        finally:
+            if self.reader is not None:
+                self.reader.close()
+
+    def recognize_event(self, event):
+        event_type = biosig_constant.event_codes.get(event["TYP"], event["TYP"])
+        event_time = self.get_number(event, "POS", -1)
+        return event_time, event_type
+
+    def _create_channel(self, session, json_data):
+        tasks = []
+        for index, channel_info in enumerate(json_data["CHANNEL"]):
+            if self.reader.is_annotation(index):
+                continue
+            scale, unit = self.recognize_scale(channel_info["PhysicalUnit"])
+            channel = self._add_channel(session, json_data, channel_info, unit)
+            data = channel.prepareData()
+            if self.workers > 1:
+                function, source = parallel.encode_edf_segment, self.origin_file
+            else:
+                function, source = parallel.encode_edf_samples, self.reader #Calls run in this process
+            tasks.append((channel, [(function, (source, index, start, channel.SegmentMaxLength, scale, data.dtype, data.codec))
+                for start in range(0, self.reader.sample_count(index), channel.SegmentMaxLength)]))
+        self._store_channels(tasks)
+
+# Creating aliases:
+EDFImporter = NativeXDFImporter
+EDFPlusImporter = NativeXDFImporter
+BDFImporter = NativeXDFImporter
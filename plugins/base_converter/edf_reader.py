@@ -0,0 +1,196 @@
+#!/usr/bin/python
+import os
+import re
+import mmap
+import datetime
+import numpy as np
+
+
+class EDFReader(object):
+    AnnotationLabels = ("EDF Annotations", "BDF Annotations")
+    SignalFields = [
+        ("Label", 16), ("Transducer", 80), ("PhysicalUnit", 8),
+        ("PhysicalMinimum", 8), ("PhysicalMaximum", 8),
+        ("DigitalMinimum", 8), ("DigitalMaximum", 8),
+        ("Prefiltering", 80), ("SamplesPerRecord", 8), ("Reserved", 32),
+    ]
+    Months = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+    """Reads EDF, EDF+ and BDF files directly, without external tools.
+    Data records are read from a memory map of the file, and each signal is de-multiplexed
+    with a strided NumPy view over the records, so no sample goes through Python objects."""
+    def __init__(self, filename):
+        super(EDFReader, self).__init__()
+        self.filename = filename
+        self.file = open(filename, "rb")
+        self.read_header()
+        self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_header(self):
+        """Parses the fixed header and the signal headers."""
+        header = self.file.read(256)
+        self.version = header[0:8]
+        self.patient = header[8:88].strip()
+        self.recording = header[88:168].strip()
+        self.start_date = header[168:176].strip()
+        self.start_time = header[176:184].strip()
+        self.header_bytes = int(header[184:192])
+        self.reserved = header[192:236].strip()
+        self.records = int(header[236:244])
+        self.record_duration = float(header[244:252])
+        signal_number = int(header[252:256])
+        self.bytes_per_sample = 3 if self.is_bdf else 2
+        self.signals = [{} for i in range(signal_number)]
+        for name, length in self.SignalFields:
+            for signal in self.signals:
+                signal[name] = self.file.read(length).strip()
+        offset = 0
+        for signal in self.signals:
+            for name in ["PhysicalMinimum", "PhysicalMaximum", "DigitalMinimum", "DigitalMaximum"]:
+                signal[name] = float(signal[name])
+            signal["SamplesPerRecord"] = int(signal["SamplesPerRecord"])
+            signal["Offset"] = offset
+            offset += signal["SamplesPerRecord"] * self.bytes_per_sample
+            digital_range = signal["DigitalMaximum"] - signal["DigitalMinimum"]
+            signal["Gain"] = (signal["PhysicalMaximum"] - signal["PhysicalMinimum"]) / (digital_range or 1)
+            signal["PhysicalOffset"] = signal["PhysicalMinimum"] - signal["DigitalMinimum"] * signal["Gain"]
+        self.record_bytes = offset
+        available = (os.path.getsize(self.filename) - self.header_bytes) // (self.record_bytes or 1)
+        if self.records < 0 or self.records > available:
+            self.records = available
+
+    @property
+    def is_bdf(self):
+        return self.version[0] == "\xff" or self.reserved.startswith("24BIT") or self.reserved.startswith("BDF")
+
+    @property
+    def is_edf_plus(self):
+        return self.reserved.startswith("EDF+") or self.reserved.startswith("BDF+")
+
+    def is_annotation(self, i):
+        return self.signals[i]["Label"] in self.AnnotationLabels
+
+    def sampling_rate(self, i):
+        return self.signals[i]["SamplesPerRecord"] / self.record_duration
+
+    def read_digital(self, i, first_record=0, count=None):
+        """Returns the digital values of the signal i in records [first_record, first_record+count)."""
+        if count is None:
+            count = self.records - first_record
+        count = max(min(count, self.records - first_record), 0)
+        signal = self.signals[i]
+        offset = self.header_bytes + first_record * self.record_bytes + signal["Offset"]
+        samples = signal["SamplesPerRecord"]
+        if count == 0:
+            return np.zeros(0, dtype=np.int32)
+        if self.bytes_per_sample == 2:
+            values = np.ndarray((count, samples), dtype="<i2", buffer=self.mapping,
+                offset=offset, strides=(self.record_bytes, 2))
+            return values.astype(np.int32).ravel()
+        raw = np.ndarray((count, samples, 3), dtype=np.uint8, buffer=self.mapping,
+            offset=offset, strides=(self.record_bytes, 3, 1)).astype(np.int32)
+        values = raw[:, :, 0] | (raw[:, :, 1] << 8) | (raw[:, :, 2] << 16)
+        return ((values ^ 0x800000) - 0x800000).ravel()
+
+    def read_physical(self, i, first_record=0, count=None):
+        """Returns the physical values of the signal i, as indicated by its header."""
+        signal = self.signals[i]
+        return self.read_digital(i, first_record, count) * signal["Gain"] + signal["PhysicalOffset"]
+
+    def read_samples(self, i, start, count, scale=1):
+        """Returns count physical values of the signal i from the sample start, multiplied by scale."""
+        samples = self.signals[i]["SamplesPerRecord"]
+        first_record = start // samples
+        last_record = (start + count - 1) // samples
+        values = self.read_physical(i, first_record, last_record - first_record + 1)
+        values = values[start - first_record * samples:start - first_record * samples + count]
+        if scale != 1:
+            values *= scale
+        return values
+
+    def sample_count(self, i):
+        return self.records * self.signals[i]["SamplesPerRecord"]
+
+    def iter_physical(self, i, chunk_length, scale=1):
+        """Yields the physical values of the signal i in chunks of about chunk_length samples."""
+        records_per_chunk = max(chunk_length // (self.signals[i]["SamplesPerRecord"] or 1), 1)
+        for first_record in range(0, self.records, records_per_chunk):
+            values = self.read_physical(i, first_record, records_per_chunk)
+            if scale != 1:
+                values *= scale
+            yield values
+
+    def read_annotations(self):
+        """Returns the (onset, duration, text) annotations of EDF+/BDF+ files, skipping time-keeping ones."""
+        annotations = []
+        for i in range(len(self.signals)):
+            if not self.is_annotation(i):
+                continue
+            signal = self.signals[i]
+            size = signal["SamplesPerRecord"] * self.bytes_per_sample
+            for record in range(self.records):
+                offset = self.header_bytes + record * self.record_bytes + signal["Offset"]
+                for tal in self.mapping[offset:offset + size].split("\x00"):
+                    match = re.match("([+-][0-9.]+)(?:\x15([0-9.]+))?\x14(.*)", tal, re.DOTALL)
+                    if not match:
+                        continue
+                    onset = float(match.group(1))
+                    duration = float(match.group(2) or 0)
+                    for text in match.group(3).split("\x14"):
+                        if text:
+                            annotations.append((onset, duration, text))
+        return annotations
+
+    def start_datetime(self):
+        """Returns the start of the recording, with the EDF clipping date convention (1985-2084)."""
+        try:
+            day, month, year = [int(v) for v in self.start_date.split(".")]
+            hour, minute, second = [int(v) for v in self.start_time.split(".")]
+        except ValueError:
+            return None
+        year += 1900 if year >= 85 else 2000
+        return datetime.datetime(year, month, day, hour, minute, second)
+
+    def patient_info(self):
+        """Splits the EDF+ patient field (code, sex, birthdate, name). Plain EDF uses the whole field as name."""
+        info = {"Name": self.patient, "Gender": "", "Age": -1}
+        fields = self.patient.split(" ")
+        if not self.is_edf_plus or len(fields) < 4:
+            return info
+        info["Name"] = fields[3].replace("_", " ") if fields[3] != "X" else ""
+        info["Gender"] = {"M": "Male", "F": "Female"}.get(fields[1], "")
+        birthdate = re.match("(\d+)-([A-Za-z]+)-(\d+)", fields[2])
+        start = self.start_datetime()
+        if birthdate and start and birthdate.group(2).upper() in self.Months:
+            born = datetime.date(int(birthdate.group(3)), self.Months.index(birthdate.group(2).upper()) + 1, int(birthdate.group(1)))
+            info["Age"] = start.year - born.year - ((start.month, start.day) < (born.month, born.day))
+        return info
+
+    def equipment(self):
+        """Returns the equipment of the EDF+ recording field, or unknown."""
+        fields = self.recording.split(" ")
+        if self.is_edf_plus and len(fields) >= 5 and fields[4] != "X":
+            return fields[4].replace("_", " ")
+        return "unknown"
+
+    def as_json(self):
+        """Describes the file with the same structure than the JSON generated by save2gdf."""
+        start = self.start_datetime() or datetime.datetime.now()
+        return {
+            "Patient": self.patient_info(),
+            "Manufacturer": {"Name": self.equipment()},
+            "StartOfRecording": start.strftime("%Y-%m-%d %H:%M:%S"),
+            "NumberOfSweeps": self.records,
+            "EVENT": [{"TYP": text, "POS": onset, "DUR": duration} for onset, duration, text in self.read_annotations()],
+            "CHANNEL": [{
+                "ChannelNumber": i + 1,
+                "Label": signal["Label"],
+                "PhysicalUnit": signal["PhysicalUnit"],
+                "Samplingrate": self.sampling_rate(i),
+                "Transducer": signal["Transducer"],
+                "Filter": signal["Prefiltering"],
+            } for i, signal in enumerate(self.signals)],
+        }
+
+    def close(self):
+        self.mapping.close()
+        self.file.close()
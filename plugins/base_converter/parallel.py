@@ -0,0 +1,115 @@
+#!/usr/bin/python
+import itertools
+import collections
+import multiprocessing
+from biosignalformat import SegmentEncoder, MerkleHasher
+from edf_reader import EDFReader
+
+#===================================================================================================
+# Tasks for the worker processes. They must be module-level functions to be sent to a process pool,
+# and each one returns a list of (encoded segment, sample count, digest) tuples, so the segment
+# digests (see MerkleHasher) are computed in parallel too. Each task encodes a single segment, so
+# the memory in use is bounded by the window of the WorkerPool, whatever the channel length.
+#===================================================================================================
+
+def read_ascii_chunks(channel_name, scale, chunk_length):
+    """Reads a channel file generated by save2gdf, yielding chunks of scaled values."""
+    with open(channel_name, "r") as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_length))
+            if not lines:
+                break
+            yield [float(val.strip())*scale for val in lines]
+
+def ascii_segment_offsets(channel_name, segment_size):
+    """Returns the byte offset of the first line of each segment of a channel file generated by
+    save2gdf, so its segments can be encoded by separate tasks (see encode_ascii_segment)."""
+    offsets = []
+    position = 0
+    with open(channel_name, "rb") as f:
+        for number, line in enumerate(f):
+            if number % segment_size == 0:
+                offsets.append(position)
+            position += len(line)
+    return offsets
+
+def encode_ascii_segment(channel_name, offset, scale, segment_size, dtype, codec):
+    """Encodes the segment of a channel file generated by save2gdf which begins at the byte offset."""
+    with open(channel_name, "rb") as f:
+        f.seek(offset)
+        values = [float(line.strip())*scale for line in itertools.islice(f, segment_size)]
+    return [encoded_segment(values, dtype, codec)]
+
+OpenReaders = {}
+
+def open_edf_reader(filename):
+    """Returns the EDFReader of a file in this process, opening it once. Only the reader of the last
+    file is kept, because files are converted one after another."""
+    reader = OpenReaders.get(filename)
+    if reader is None:
+        close_edf_readers()
+        reader = OpenReaders[filename] = EDFReader(filename)
+    return reader
+
+def close_edf_readers():
+    for reader in OpenReaders.values():
+        reader.close()
+    OpenReaders.clear()
+
+def encode_edf_segment(filename, index, start, segment_size, scale, dtype, codec):
+    """Encodes the segment of an EDF/BDF signal which begins at the sample start, with the reader of
+    the file kept open by this worker process."""
+    return encode_edf_samples(open_edf_reader(filename), index, start, segment_size, scale, dtype, codec)
+
+def encode_edf_samples(reader, index, start, segment_size, scale, dtype, codec):
+    """Encodes the segment of an EDF/BDF signal which begins at the sample start, with an open reader."""
+    values = reader.read_samples(index, start, min(segment_size, reader.sample_count(index) - start), scale)
+    return [encoded_segment(values, dtype, codec)]
+
+def encoded_segment(values, dtype, codec):
+    strdata = SegmentEncoder.encode(values, dtype, 1.0, codec)
+    return strdata, len(values), MerkleHasher.Default.digest(strdata)
+
+#===================================================================================================
+
+class WorkerPool(object):
+    """Runs (function, arguments) calls in a process pool, yielding their results in the same order.
+    At most window calls are in flight, so results wait in memory only while an earlier call is
+    unfinished. With a single worker, the calls run in this process. The pool can be reused."""
+    def __init__(self, workers=1, window=None):
+        super(WorkerPool, self).__init__()
+        self.workers = workers
+        self.window = window or 4*workers
+        self.pool = multiprocessing.Pool(workers) if workers > 1 else None
+
+    def map(self, calls):
+        if self.pool is None:
+            for function, arguments in calls:
+                yield function(*arguments)
+            return
+        pending = collections.deque()
+        for function, arguments in calls:
+            pending.append(self.pool.apply_async(function, arguments))
+            if len(pending) >= self.window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def ordered_map(calls, workers=1, window=None):
+    """Runs calls in a temporal WorkerPool."""
+    with WorkerPool(workers, window) as pool:
+        for result in pool.map(calls):
+            yield result
@@ -0,0 +1,22 @@
+#!/usr/bin/python
+import sys
+from biosignalformat import *
+
+def main(argv):
+    """Writes the catalog of archives created before it existed."""
+    if not argv:
+        print "Usage: rebuild_catalog.py archive [archive ...]"
+        return 1
+    for archivename in argv:
+        if archivename.lower().endswith(".zip"):
+            archiver = ZipFileArchiveProvider(archivename)
+        else:
+            archiver = XArchiveProvider(archivename)
+        experiment = Experiment.rebuildCatalog(archiver)
+        if hasattr(archiver, "close"):
+            archiver.close()
+        print "Rebuilt the catalog of", archivename, "(%d subjects)" % len(experiment.subjects)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))